@@ -45,4 +45,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=Requirements(),
+    entry_points={
+        'console_scripts': [
+            'uweb3-prewarm-templates=uweb3.templateparser:PrewarmCache']},
     python_requires='>=3.5')
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+"""Runner for the micro-benchmark suites of uWeb3.
+
+A suite registers its benchmarks on a Suite, with the Benchmark decorator. Every
+benchmark returns a dictionary of cases, each a function without arguments
+that is timed. The fastest time per call of every case is written as JSON, so
+the timings of a change can be compared against those of a baseline:
+
+  python3 -m test.benchmark_<suite> --output baseline.json
+  python3 -m test.benchmark_<suite> --compare baseline.json
+"""
+
+# Standard modules
+import argparse
+import json
+import platform
+import sys
+import timeit
+import types
+
+
+class Suite:
+  """A named set of benchmarks, and the command line to run them."""
+  def __init__(self, description, version=None):
+    """Initializes an empty Suite.
+
+    Arguments:
+      @ description: str
+        The description of the suite, shown in its command line help.
+      % version: str ~~ None
+        The version of the benchmarked code, stored with the results.
+    """
+    self.description = description
+    self.version = version
+    self.benchmarks = {}
+
+  def Benchmark(self, name, number):
+    """Registers a benchmark of which every case is run `number` times.
+
+    The decorated function returns a dictionary of cases. It may also yield
+    them instead, to clean up what the cases use once they are timed.
+    """
+    def _Register(function):
+      self.benchmarks[name] = function, number
+      return function
+    return _Register
+
+  def Run(self, name, repeat):
+    """Returns the fastest time per call for every case of the named benchmark."""
+    setup, number = self.benchmarks[name]
+    cases = setup()
+    generator = cases if isinstance(cases, types.GeneratorType) else None
+    if generator is not None:
+      cases = next(generator)
+    try:
+      return {case: min(timeit.repeat(function, number=number, repeat=repeat))
+              / number for case, function in cases.items()}
+    finally:
+      if generator is not None:
+        generator.close()
+
+  def main(self, args=None):
+    """Runs the benchmarks and writes their results as JSON."""
+    argparser = argparse.ArgumentParser(description=self.description)
+    argparser.add_argument('benchmarks', nargs='*',
+                           help='benchmarks to run, all by default: %s' % (
+                               ', '.join(self.benchmarks)))
+    argparser.add_argument('--repeat', type=int, default=5,
+                           help='number of timed repetitions per case')
+    argparser.add_argument('--output', help='file to write the JSON results to')
+    argparser.add_argument('--compare', help='JSON results of a baseline run, '
+                           'to compare the results against')
+    args = argparser.parse_args(args)
+    unknown = set(args.benchmarks) - set(self.benchmarks)
+    if unknown:
+      argparser.error('unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+    results = {'python': platform.python_version(),
+               'benchmarks': {name: self.Run(name, args.repeat)
+                              for name in args.benchmarks or self.benchmarks}}
+    if self.version is not None:
+      results['version'] = self.version
+    if args.output:
+      with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    else:
+      json.dump(results, sys.stdout, indent=2, sort_keys=True)
+      print()
+    if args.compare:
+      with open(args.compare) as baseline:
+        print('\n'.join(Compare(results, json.load(baseline))), file=sys.stderr)
+    return results
+
+
+def Compare(results, baseline):
+  """Returns a line per case with its speed relative to the `baseline`."""
+  lines = []
+  for name, cases in sorted(results['benchmarks'].items()):
+    base = baseline.get('benchmarks', {}).get(name, {})
+    for case, timing in sorted(cases.items()):
+      if case not in base:
+        lines.append('%-20s %-20s %12.3f us  (no baseline)' % (
+            name, case, timing * 1e6))
+        continue
+      lines.append('%-20s %-20s %12.3f us  %12.3f us  %6.2fx' % (
+          name, case, base[case] * 1e6, timing * 1e6, base[case] / timing))
+  return lines
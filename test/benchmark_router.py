@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+"""Benchmarks of the routing engines of the uWeb3 Router.
+
+Every engine routes the same requests, on route tables of 50, 500 and 5000
+routes. The requests hit the first route, a route halfway the table, the last
+route before the catch-all, and the catch-all itself. The time to set up the
+router is benchmarked separately. The results are written as JSON, so that the
+engines and changes to them can be compared:
+
+  python3 -m test.benchmark_router --output baseline.json
+  python3 -m test.benchmark_router --compare baseline.json
+"""
+
+# Standard modules
+import itertools
+
+# Benchmark runner
+from test import benchmark
+
+# Benchmark target
+import uweb3
+
+SIZES = 50, 500, 5000
+SUITE = benchmark.Suite(
+    'Benchmarks the routing engines on growing route tables.',
+    uweb3.__version__)
+
+
+class Pages:
+  """PageMaker with the handlers of the generated routes."""
+  Item = Edit = Create = Catchall = None
+
+  @classmethod
+  def LoadModules(cls):
+    return []
+
+
+def Routes(size):
+  """Returns `size` routes in the style of an application, and a catch-all."""
+  routes = []
+  for number in range(size // 3 + 1):
+    routes.append(('/section%d/(\\d+)' % number, 'Item'))
+    routes.append(('/section%d/edit/(\\w+)' % number, 'Edit'))
+    routes.append(('/api/v1/item%d' % number, 'Create', 'POST'))
+  return routes[:size - 1] + [('/(.*)', 'Catchall')]
+
+
+def Requests(size):
+  """Returns the requests to route, by name, as (url, method) tuples."""
+  last = (size - 2) // 3
+  return {'first': ('/section0/1', 'GET'),
+          'middle': ('/section%d/edit/x' % (size // 6), 'GET'),
+          'last': ('/section%d/1' % last, 'GET'),
+          'catchall': ('/unknown/page', 'GET')}
+
+
+def RouteCases(engine):
+  """Returns a case for every request, on every size of route table."""
+  cases = {}
+  for size in SIZES:
+    router = uweb3.Router(Pages, engine=engine).router(Routes(size))
+    for name, (url, method) in Requests(size).items():
+      cases['%d_%s' % (size, name)] = (
+          lambda router=router, url=url, method=method:
+          router(url, method, 'localhost'))
+  return cases
+
+
+@SUITE.Benchmark('setup', 1)
+def Setup():
+  """Setting up the router of every engine, for every size of route table."""
+  cases = {}
+  for engine, size in itertools.product(uweb3.Router.ENGINES, SIZES):
+    cases['%s_%d' % (engine, size)] = (
+        lambda engine=engine, routes=Routes(size):
+        uweb3.Router(Pages, engine=engine).router(routes))
+  return cases
+
+
+@SUITE.Benchmark('index', 2000)
+def Index():
+  """Routing with the RouteIndex, which only tries routes matching the path."""
+  return RouteCases('index')
+
+
+@SUITE.Benchmark('combined', 2000)
+def Combined():
+  """Routing with CombinedRoutes, which tries all routes in a single regex."""
+  return RouteCases('combined')
+
+
+if __name__ == '__main__':
+  SUITE.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+"""Micro-benchmarks for the escaping done by the safestring module.
+
+Every benchmark times a number of escape paths on the same inputs, and reports
+the fastest time per call. The results are written as JSON, so the timings of a
+change can be compared against those of a baseline:
+
+  python3 -m test.benchmark_safestring --output baseline.json
+  python3 -m test.benchmark_safestring --compare baseline.json
+"""
+
+# Benchmark runner
+from test import benchmark
+
+# Benchmark target
+from uweb3.libs.safestring import HTMLsafestring, SQLSAFE
+from uweb3.libs.safestring.test import LegacySanitize
+
+SUITE = benchmark.Suite('Benchmarks the escaping of safe strings.')
+
+
+@SUITE.Benchmark('html_tag', 20000)
+def HTMLTag():
+  """The add and upgrade paths to escape a single template tag value."""
+  values = {'str': 'A plain text value',
+            'escaped_str': 'Tom & Jerry <3',
+            'int': 123456,
+            'float': 3.14,
+            'safestring': HTMLsafestring('<b>bold</b>')}
+  cases = {}
+  for name, value in values.items():
+    cases['add_' + name] = lambda value=value: HTMLsafestring('') + value
+    cases['upgrade_' + name] = lambda value=value: HTMLsafestring.upgrade(value)
+  return cases
+
+
+@SUITE.Benchmark('sql_sanitize', 5)
+def SQLSanitize():
+  """Sanitizing growing text blobs, with the previous and current SQLSAFE."""
+  chunk = 'A user\'s "text" blob,\n with \\ and \t in it. '
+  cases = {}
+  for size in (1000, 10000, 50000):
+    value = chunk * (size // len(chunk))
+    cases['legacy_%d' % size] = lambda value=value: LegacySanitize(value)
+    cases['linear_%d' % size] = lambda value=value: SQLSAFE.sanitize(value)
+  return cases
+
+
+if __name__ == '__main__':
+  SUITE.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+"""Micro-benchmarks for the templateparser module.
+
+Every benchmark parses a template by name with Parser.Parse, as a PageMaker
+does. The results are written as JSON, so the timings of a change can be
+compared against those of a baseline:
+
+  python3 -m test.benchmark_templateparser --output baseline.json
+  python3 -m test.benchmark_templateparser --compare baseline.json
+"""
+
+# Standard modules
+import os
+import tempfile
+
+# Benchmark runner
+from test import benchmark
+
+# Benchmark target
+from uweb3 import templateparser
+
+SUITE = benchmark.Suite(
+    'Benchmarks template parsing with representative templates.',
+    templateparser.__version__)
+
+
+def Benchmark(name, number):
+  """Registers a benchmark that is parsed `number` times per repetition.
+
+  The decorated function receives a Parser on a directory with the template
+  files, and returns the name of the template and its replacements. The
+  template is parsed once before timing, so that it is loaded and compiled.
+  """
+  def _Register(function):
+    @SUITE.Benchmark(name, number)
+    def _Cases():
+      with tempfile.TemporaryDirectory() as template_dir:
+        parser = templateparser.Parser(template_dir)
+        template, replacements = function(parser)
+        parser.Parse(template, **replacements)
+        yield {'parse': lambda: parser.Parse(template, **replacements)}
+    return function
+  return _Register
+
+
+def WriteTemplate(parser, name, content):
+  """Writes a template file in the template directory of the parser."""
+  with open(os.path.join(parser.template_dir, name), 'w') as template:
+    template.write(content)
+  return name
+
+
+@Benchmark('deep_indices', 2000)
+def DeepIndices(parser):
+  """Tags with several levels of indices, on dicts, lists and attributes."""
+  class Node:
+    def __init__(self, value):
+      self.value = value
+  name = WriteTemplate(parser, 'deep_indices.html', ' '.join(
+      '[a:b:c:%d:value] [a:b:d:e:f]' % index for index in range(20)))
+  return name, {'a': {'b': {'c': [Node(index) for index in range(20)],
+                            'd': {'e': {'f': 'deep'}}}}}
+
+
+@Benchmark('loop_10k', 5)
+def LargeLoop(parser):
+  """A {{ for }} loop over 10000 rows, with two tags per row."""
+  name = WriteTemplate(parser, 'loop_10k.html', (
+      '<table>{{ for row in [rows] }}'
+      '<tr><td>[row:id]</td><td>[row:name]</td></tr>'
+      '{{ endfor }}</table>'))
+  return name, {'rows': [{'id': index, 'name': 'row <%d>' % index}
+                         for index in range(10000)]}
+
+
+@Benchmark('loop_10k_scope', 5)
+def LargeLoopScope(parser):
+  """A 10000 row loop with a conditional, among 100 outer replacements."""
+  name = WriteTemplate(parser, 'loop_10k_scope.html', (
+      '{{ for row in [rows] }}<tr><td>[row:0]</td><td>[row:1]</td>'
+      '{{ if [row:0] > 5 }}<td>[tag1]</td>{{ endif }}</tr>{{ endfor }}'))
+  replacements = {'tag%d' % tag: tag for tag in range(100)}
+  replacements['rows'] = [(row, 'x') for row in range(10000)]
+  return name, replacements
+
+
+@Benchmark('nested_conditionals', 2000)
+def NestedConditionals(parser):
+  """Conditionals nested three deep, with elif chains on every level."""
+  branch = ('{{ if [level] > 3 }}high{{ elif [level] > 1 }}medium'
+            '{{ else }}low{{ endif }}')
+  name = WriteTemplate(parser, 'nested_conditionals.html', ''.join(
+      '{{ if [a] }}{{ if [b] == "x" }}%s{{ elif [c] }}c{{ endif }}'
+      '{{ else }}none{{ endif }}' % branch for _index in range(10)))
+  return name, {'a': True, 'b': 'x', 'c': False, 'level': 2}
+
+
+@Benchmark('function_closures', 2000)
+def FunctionClosures(parser):
+  """Tag functions with closure arguments, chained after one another."""
+  parser.RegisterFunction('cut', lambda length: lambda value: value[:length])
+  parser.RegisterFunction('wrap', lambda tag: lambda value: '<%s>%s</%s>' % (
+      tag, value, tag))
+  name = WriteTemplate(parser, 'function_closures.html', ' '.join(
+      '[text|cut(20)|wrap("b")|html] [text|cut(%d)|url]' % index
+      for index in range(1, 21)))
+  return name, {'text': 'The quick brown fox jumps over the lazy dog.'}
+
+
+@Benchmark('inline', 2000)
+def Inline(parser):
+  """A template that inlines other templates, one of them repeatedly."""
+  WriteTemplate(parser, 'inline_header.html', '<h1>[title]</h1>')
+  WriteTemplate(parser, 'inline_item.html', '<li>[item|html]</li>')
+  name = WriteTemplate(parser, 'inline.html', (
+      '{{ inline inline_header.html }}<ul>{{ for item in [items] }}'
+      '{{ inline inline_item.html }}{{ endfor }}</ul>'))
+  return name, {'title': 'Inlined', 'items': ['item %d' % index
+                                              for index in range(20)]}
+
+
+@Benchmark('dictoutput', 2000)
+def DictOutput(parser):
+  """The dictionary output mode, used for JSON responses."""
+  parser.dictoutput = True
+  name = WriteTemplate(parser, 'dictoutput.html', ' '.join(
+      '[tag%d] {{ if [flag] }}[tag%d|len]{{ endif }}' % (index, index)
+      for index in range(20)))
+  replacements = {'tag%d' % index: 'value %d' % index for index in range(20)}
+  replacements['flag'] = True
+  return name, replacements
+
+
+if __name__ == '__main__':
+  SUITE.main()
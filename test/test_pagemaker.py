@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+"""Tests for the discovery of PageMakers by the pagemaker module."""
+
+# Too many public methods
+# pylint: disable=R0904
+
+# Standard modules
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# Unittest target
+from uweb3 import pagemaker
+from uweb3 import response
+from uweb3 import templateparser
+
+# The route files don't import uweb3, to keep pyclbr from parsing all of it.
+PAGES = '''
+class PageMaker(object):
+  """Stands in for uweb3.PageMaker."""
+
+class Pages(PageMaker):
+  """PageMaker that is found by LoadModules."""
+
+class DebugPages(Pages):
+  """PageMaker whose first base is in the same module."""
+
+class Helper(object):
+  """Class that is no PageMaker."""
+'''
+
+
+class LoadModules(unittest.TestCase):
+  """Tests the discovery of PageMakers in the route files."""
+  def setUp(self):
+    """Creates a route directory with a single route file, and enters it."""
+    self.cwd = os.getcwd()
+    self.directory = tempfile.TemporaryDirectory()
+    os.chdir(self.directory.name)
+    sys.path.insert(0, self.directory.name)
+    self.routes = 'routes_%s' % os.path.basename(self.directory.name)
+    os.mkdir(self.routes)
+    with open(os.path.join(self.routes, '__init__.py'), 'w'):
+      pass
+    with open(os.path.join(self.routes, 'pages.py'), 'w') as pages:
+      pages.write(PAGES)
+    pagemaker.DISCOVERED_PAGEMAKERS.clear()
+
+  def tearDown(self):
+    """Leaves and removes the route directory."""
+    os.chdir(self.cwd)
+    sys.path.remove(self.directory.name)
+    self.directory.cleanup()
+    pagemaker.DISCOVERED_PAGEMAKERS.clear()
+
+  def Names(self, classes):
+    return sorted(cls.__name__ for cls in classes)
+
+  def testDiscovery(self):
+    """PageMaker classes are imported from the route files"""
+    classes = pagemaker.BasePageMaker.LoadModules(self.routes + '/*.py')
+    self.assertEqual(self.Names(classes), ['DebugPages', 'Pages'])
+    self.assertEqual(classes[0].__module__, self.routes + '.pages')
+
+  def testOncePerProcess(self):
+    """Discovery runs once, also when the routes are given as a directory"""
+    first = pagemaker.BasePageMaker.LoadModules(self.routes + '/*.py')
+    with mock.patch('pyclbr.readmodule_ex') as readmodule, \
+         mock.patch('glob.glob') as find:
+      second = pagemaker.BasePageMaker.LoadModules(self.routes)
+    self.assertFalse(readmodule.called or find.called)
+    self.assertEqual(first, second)
+    second.append(None)
+    self.assertNotIn(None, pagemaker.BasePageMaker.LoadModules(self.routes))
+
+  def testCacheFile(self):
+    """Unchanged files are not parsed again by a new process"""
+    pagemaker.BasePageMaker.LoadModules(self.routes)
+    cache_file = os.path.join(
+        self.routes, '__pycache__', 'uweb3-pagemakers.json')
+    with open(cache_file) as cached:
+      files = json.load(cached)['files']
+    self.assertEqual(files[os.path.join(self.routes, 'pages.py')]['classes'],
+                     ['Pages', 'DebugPages'])
+    pagemaker.DISCOVERED_PAGEMAKERS.clear()
+    with mock.patch('pyclbr.readmodule_ex') as readmodule:
+      classes = pagemaker.BasePageMaker.LoadModules(self.routes)
+    self.assertFalse(readmodule.called)
+    self.assertEqual(self.Names(classes), ['DebugPages', 'Pages'])
+
+  def testCacheInvalidated(self):
+    """Files that changed since they were cached are parsed again"""
+    pagemaker.BasePageMaker.LoadModules(self.routes)
+    with open(os.path.join(self.routes, 'more.py'), 'w') as more:
+      more.write('class PageMaker(object):\n  pass\n\n'
+                 'class More(PageMaker):\n  pass\n')
+    pagemaker.DISCOVERED_PAGEMAKERS.clear()
+    classes = pagemaker.BasePageMaker.LoadModules(self.routes)
+    self.assertEqual(self.Names(classes), ['DebugPages', 'More', 'Pages'])
+
+  def testCacheNotWritten(self):
+    """No temporary file is left behind if the cache file can't be replaced"""
+    with mock.patch('os.replace', side_effect=OSError):
+      pagemaker.BasePageMaker.LoadModules(self.routes)
+    self.assertEqual([name for name in os.listdir(
+        os.path.join(self.routes, '__pycache__')) if not name.endswith('.pyc')],
+                     [])
+
+  def testCacheKept(self):
+    """The cache file is kept if its replacement can't be created"""
+    pagemaker.BasePageMaker.LoadModules(self.routes)
+    with open(os.path.join(self.routes, 'more.py'), 'w') as more:
+      more.write('class More(object):\n  pass\n')
+    pagemaker.DISCOVERED_PAGEMAKERS.clear()
+    with mock.patch('tempfile.NamedTemporaryFile', side_effect=OSError):
+      pagemaker.BasePageMaker.LoadModules(self.routes)
+    self.assertTrue(os.path.exists(os.path.join(self.routes, '__pycache__',
+                                                'uweb3-pagemakers.json')))
+
+  def testNoCache(self):
+    """No cache file is written if the cache is disabled"""
+    pagemaker.BasePageMaker.LoadModules(self.routes, cache=False)
+    self.assertFalse(os.path.exists(os.path.join(self.routes, '__pycache__',
+                                                 'uweb3-pagemakers.json')))
+
+
+class DebuggerPostRequest(unittest.TestCase):
+  """Tests the PostRequest hook of the DebuggerMixin."""
+  class Hooked(object):
+    """Class after the DebuggerMixin in the MRO, with its own hook."""
+    PERSISTENT = pagemaker.CacheStorage()
+
+    def PostRequest(self, response):
+      response.headers['X-Hooked'] = 'yes'
+      return response
+
+  class Pages(pagemaker.DebuggerMixin, Hooked):
+    """PageMaker-like class using the DebuggerMixin."""
+
+  def setUp(self):
+    self.parser = templateparser.Parser()
+    self.Pages.PERSISTENT.Set('__parser', self.parser)
+
+  def tearDown(self):
+    self.Pages.PERSISTENT.Del('__parser')
+
+  def testChained(self):
+    """The PostRequest further along the MRO is called"""
+    page = response.Response('<html><body></body></html>')
+    self.assertIs(self.Pages().PostRequest(page), page)
+    self.assertEqual(page.headers['X-Hooked'], 'yes')
+    self.assertEqual(page.text, '<html><body></body></html>')
+
+  def testProfileTable(self):
+    """The template profile is added to the page of the chained hook"""
+    self.parser.SetProfiling()
+    page = self.Pages().PostRequest(
+        response.Response('<html><body></body></html>'))
+    self.assertEqual(page.headers['X-Hooked'], 'yes')
+    self.assertIn('<table', page.text)
+    self.assertTrue(page.text.endswith('</body></html>'))
+
+
+if __name__ == '__main__':
+  unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+"""Tests for the request router of uWeb3."""
+
+# Too many public methods
+# pylint: disable=R0904
+
+# Standard modules
+import itertools
+import random
+import re
+import unittest
+
+# Unittest target
+import uweb3
+
+
+class PageMaker:
+  """Minimal PageMaker with a handler for every route used in the tests."""
+  @classmethod
+  def LoadModules(cls):
+    return []
+
+  def __getattr__(self, name):
+    return name
+
+
+class Pages(PageMaker):
+  """PageMaker whose handlers are found by the router."""
+  Index = UserPage = UserList = Static = Api = Catchall = Post = Host = None
+
+
+def LinearRouter(routes):
+  """Returns a router that tries every route in order, without any index."""
+  compiled = [(re.compile(pattern + '$'), handler,
+               details[0].upper() if details else 'ALL')
+              for pattern, handler, *details in routes]
+  def _Route(url, method):
+    for pattern, handler, routemethod in compiled:
+      if routemethod not in ('ALL', method):
+        continue
+      match = pattern.match(url)
+      if match:
+        return handler, tuple(group for group in match.groups() if group)
+    return None
+  return _Route
+
+
+class RouterTest(unittest.TestCase):
+  """Tests the matching of requests against the routes."""
+  ENGINE = 'index'
+  OPTIONS = {}
+  ROUTES = [
+      ('/', 'Index'),
+      ('/user/(\\d+)', 'UserPage'),
+      ('/users?/', 'UserList'),
+      ('/static/(.*)', 'Static'),
+      ('/api/(\\w+)', 'Post', 'POST'),
+      ('/api/(\\w+)', 'Api'),
+      ('/(us)er/(.*)', 'Catchall'),
+      ('/(.*)', 'Catchall')]
+
+  def Route(self, routes, url, method='GET', host='localhost'):
+    """Returns the handler and groups for `url`, or None if there's no route."""
+    router = uweb3.Router(Pages, engine=self.ENGINE, **self.OPTIONS).router(
+        routes)
+    for _request in range(2 if self.OPTIONS else 1):
+      try:
+        handler, groups, _hostmatch, _page_maker = router(url, method, host)
+      except uweb3.NoRouteError:
+        result = None
+      else:
+        result = handler, tuple(groups)
+    return result
+
+  def testFirstMatch(self):
+    """The first route that matches the url is used"""
+    self.assertEqual(self.Route(self.ROUTES, '/'), ('Index', ()))
+    self.assertEqual(self.Route(self.ROUTES, '/user/12'), ('UserPage', ('12',)))
+    self.assertEqual(self.Route(self.ROUTES, '/user/me'),
+                     ('Catchall', ('us', 'me')))
+    self.assertEqual(self.Route(self.ROUTES, '/users/'), ('UserList', ()))
+    self.assertEqual(self.Route(self.ROUTES, '/user/'), ('UserList', ()))
+    self.assertEqual(self.Route(self.ROUTES, '/other'), ('Catchall', ('other',)))
+
+  def testMethod(self):
+    """Routes for a specific method are skipped for other methods"""
+    self.assertEqual(self.Route(self.ROUTES, '/api/x', 'POST'), ('Post', ('x',)))
+    self.assertEqual(self.Route(self.ROUTES, '/api/x', 'GET'), ('Api', ('x',)))
+    self.assertEqual(self.Route(self.ROUTES, '/api/x', 'PATCH'), ('Api', ('x',)))
+
+  def testNoRoute(self):
+    """Urls that match no route raise NoRouteError"""
+    self.assertIsNone(self.Route(self.ROUTES[:2], '/user/me'))
+    self.assertIsNone(self.Route([('/api/(\\w+)', 'Post', 'POST')], '/api/x'))
+
+  def testUnknownHandler(self):
+    """Routes to handlers that no PageMaker has are refused"""
+    self.assertRaises(uweb3.NoRouteError,
+                      uweb3.Router(Pages).router, [('/', 'Missing')])
+
+  def testOrderingEquivalence(self):
+    """The router picks the same route as trying all of them in order"""
+    rand = random.Random(1)
+    pieces = ['/', '/user', '/user/', '/users?/', '/static/', '/a', '/ab/',
+              '(\\d+)', '(\\w*)', '(.*)', '/?', '\\.html', 'x|/y',
+              '(?P<name>\\w)', '(/)\\1']
+    urls = ['/', '/user', '/user/', '/users/', '/user/1', '/static/a.css',
+            '/a', '/ab/', '/ab/1', '/y', '/x', '/user/x.html', '/a1', '//',
+            '/a\n', '/\n', '/user\n', '/ab/\n']
+    handlers = ['Index', 'UserPage', 'UserList', 'Static', 'Api', 'Catchall']
+    for _routeset in range(50):
+      routes = []
+      for _route in range(rand.randint(1, 12)):
+        pattern = ''.join(rand.choice(pieces)
+                          for _piece in range(rand.randint(1, 3)))
+        if pattern.count('(?P<name>') > 1:
+          continue
+        route = (pattern, rand.choice(handlers))
+        if rand.random() < 0.3:
+          route += (rand.choice(['GET', 'post']),)
+        routes.append(route)
+      linear = LinearRouter(routes)
+      for url, method in itertools.product(urls, ('GET', 'POST', 'PUT')):
+        self.assertEqual(self.Route(routes, url, method), linear(url, method),
+                         (routes, url, method))
+
+  def testConditionalGroups(self):
+    """Conditional groups refer to the groups of their own route"""
+    for pattern in ('/(a)?(?(1)b|c)', '/(?P<x>a)?(?(x)b|c)'):
+      routes = [('/(x)', 'Api'), (pattern, 'Index'), ('/(.*)', 'Catchall')]
+      linear = LinearRouter(routes)
+      for url in ('/ab', '/ac', '/c', '/b', '/x'):
+        self.assertEqual(self.Route(routes, url), linear(url, 'GET'),
+                         (pattern, url))
+
+  def testHost(self):
+    """Routes for a host are only used for requests on that host"""
+    routes = [('/', 'Host', 'ALL', 'example.com'), ('/', 'Index')]
+    self.assertEqual(self.Route(routes, '/', host='example.com'), ('Host', ()))
+    self.assertEqual(self.Route(routes, '/', host='example.org'), ('Index', ()))
+    self.assertEqual(self.Route(routes, '/', host='example.com.evil'),
+                     ('Index', ()))
+
+  def testHostCase(self):
+    """Hosts are matched regardless of their case, and of their port"""
+    routes = [('/', 'Host', 'GET', 'Example.com'), ('/', 'Index')]
+    self.assertEqual(self.Route(routes, '/', host='example.COM:8080'),
+                     ('Host', ()))
+
+  def testHostPattern(self):
+    """Host patterns are regexes, their groups are returned by the router"""
+    router = uweb3.Router(Pages, engine=self.ENGINE).router([
+        ('/', 'Host', 'ALL', '(\\w+)\\.example\\.com'), ('/', 'Index')])
+    self.assertEqual(router('/', 'GET', 'shop.example.com')[::2],
+                     ('Host', ('shop',)))
+    self.assertEqual(router('/', 'GET', '.*')[::2], ('Index', None))
+    router = uweb3.Router(Pages, engine=self.ENGINE).router([
+        ('/', 'Host', 'GET', '(\\S+)\\.example\\.com'), ('/', 'Index')])
+    self.assertEqual(router('/', 'GET', 'Shop.Example.com')[::2],
+                     ('Host', ('shop',)))
+    self.assertEqual(router('/', 'GET', 'a b.example.com')[::2],
+                     ('Index', None))
+
+  def testUnknownEngine(self):
+    """Unknown routing engines are refused"""
+    self.assertRaises(ValueError, uweb3.Router, Pages, engine='guess')
+
+
+class CombinedRouterTest(RouterTest):
+  """Tests the matching of requests with the combined regex engine."""
+  ENGINE = 'combined'
+
+  def testNamedGroups(self):
+    """Named groups of different routes don't clash"""
+    routes = [('/a/(?P<id>\\d+)', 'Api'), ('/b/(?P<id>\\w+)/(?P=id)', 'Index')]
+    self.assertEqual(self.Route(routes, '/b/x/x'), ('Index', ('x',)))
+
+  def testCombinedSteps(self):
+    """Routes are combined, except those that can't be"""
+    engine = uweb3.CombinedRoutes([
+        ('/a', (re.compile('/a$'), 'A', 'ALL', '*')),
+        ('/b', (re.compile('/b$'), 'B', 'ALL', '*')),
+        ('(/)\\1', (re.compile('(/)\\1$'), 'C', 'ALL', '*')),
+        ('/d', (re.compile('/d$'), 'D', 'ALL', 'example.com')),
+        ('(a)?(?(1)b|c)', (re.compile('(a)?(?(1)b|c)$'), 'C', 'ALL', '*')),
+        ('/e', (re.compile('/e$'), 'E', 'ALL', '*'))])
+    self.assertEqual([len(routes) for _regex, routes in engine.methods[None]],
+                     [2, 1, 1, 1, 1])
+
+
+class CachedRouterTest(RouterTest):
+  """Tests the matching of requests with a cache of the resolved routes.
+
+  The router is used twice for every request, to get the result from the cache.
+  """
+  OPTIONS = {'cache_size': 2, 'miss_cache_size': 1}
+
+  def setUp(self):
+    """Sets up a router with a small cache."""
+    self.routing = uweb3.Router(Pages, **self.OPTIONS)
+    self.router = self.routing.router(self.ROUTES[:2])
+
+  def testCacheHits(self):
+    """Resolved routes are returned from the cache"""
+    for _request in range(3):
+      self.assertEqual(self.router('/user/1', 'GET', 'localhost')[:2],
+                       ('UserPage', ('1',)))
+    self.assertEqual(self.routing.cache.Stats(), {
+        'hits': 2, 'negative_hits': 0, 'misses': 1, 'hit_rate': 2 / 3,
+        'routes': 1, 'candidates': 0, 'no_routes': 0})
+
+  def testNegativeCache(self):
+    """Requests without a route are cached, apart from the routes"""
+    for _request in range(2):
+      self.assertRaises(uweb3.NoRouteError,
+                        self.router, '/missing', 'GET', 'localhost')
+    self.router('/', 'GET', 'localhost')
+    for url in '/a', '/b', '/c':
+      self.assertRaises(uweb3.NoRouteError,
+                        self.router, url, 'GET', 'localhost')
+    self.router('/', 'GET', 'localhost')
+    stats = self.routing.cache.Stats()
+    self.assertEqual((stats['hits'], stats['negative_hits']), (1, 1))
+    self.assertEqual((stats['routes'], stats['no_routes']), (1, 1))
+
+  def testAdmission(self):
+    """Routes requested once can't evict the routes requested repeatedly"""
+    for _request in range(2):
+      self.router('/user/1', 'GET', 'localhost')
+    for number in range(10):
+      self.router('/user/%d' % (number + 2), 'GET', 'localhost')
+      self.router('/user/1', 'GET', 'host%d' % number)
+    self.assertEqual(list(self.routing.cache._routes),
+                     [('/user/1', 'GET', 'localhost')])
+    self.assertEqual(self.routing.cache.Stats()['candidates'], 1)
+    self.router('/user/1', 'GET', 'host9')
+    self.assertEqual(self.routing.cache.Stats()['routes'], 2)
+
+  def testKeyedByMethodAndHost(self):
+    """Routes are cached for the method and host of the request"""
+    router = uweb3.Router(Pages, cache_size=10).router(self.ROUTES)
+    self.assertEqual(router('/api/x', 'POST', 'a')[0], 'Post')
+    self.assertEqual(router('/api/x', 'GET', 'a')[0], 'Api')
+
+  def testClear(self):
+    """Clearing the cache removes the routes and resets the counters"""
+    self.router('/', 'GET', 'localhost')
+    self.routing.cache.Clear()
+    self.assertEqual(self.routing.cache.Stats()['misses'], 0)
+    self.assertEqual(self.routing.cache.Stats()['routes'], 0)
+
+
+class HostMatcherTest(unittest.TestCase):
+  """Tests the matching of request hosts with the host patterns of routes."""
+  def testMatch(self):
+    """Host names and regexes give the groups of the matching patterns"""
+    matcher = uweb3.HostMatcher(['example.com', '(\\w+)\\.example\\.com'])
+    self.assertEqual(matcher.hostnames, {'example.com': ['example.com']})
+    self.assertEqual(matcher.Match('example.com'), {'example.com': ()})
+    self.assertEqual(matcher.Match('www.example.com'),
+                     {'(\\w+)\\.example\\.com': ('www',)})
+    self.assertEqual(matcher.Match('example.org'), {})
+
+  def testHost(self):
+    """Hosts are matched in lowercase, without their port"""
+    self.assertEqual(uweb3.HostMatcher.Host('Shop.Example.com:8080'),
+                     'shop.example.com')
+    self.assertEqual(uweb3.HostMatcher.Host('[::1]:80'), '[::1]')
+
+  def testCache(self):
+    """The matches are kept for the most recently requested hosts"""
+    matcher = uweb3.HostMatcher(['(\\w+)\\.example\\.com'], cache_size=2)
+    first = matcher.Match('a.example.com')
+    self.assertIs(matcher.Match('a.example.com'), first)
+    matcher.Match('b.example.com')
+    matcher.Match('c.example.com')
+    self.assertEqual(list(matcher._cache), ['b.example.com', 'c.example.com'])
+
+
+class RouteIndexTest(unittest.TestCase):
+  """Tests the literal prefixes and segments the RouteIndex uses."""
+  def testLiteralPrefix(self):
+    """The prefix ends at regex syntax, and excludes optional characters"""
+    prefix = uweb3.RouteIndex.LiteralPrefix
+    self.assertEqual(prefix('/user/(\\d+)'), ('/user/', False))
+    self.assertEqual(prefix('/users?/'), ('/user', False))
+    self.assertEqual(prefix('/about'), ('/about', True))
+    self.assertEqual(prefix('/a|/b'), ('', False))
+    self.assertEqual(prefix('(?i)/a'), ('', False))
+
+  def testSegment(self):
+    """Routes have a segment only if their prefix holds all of it"""
+    segment = uweb3.RouteIndex.Segment
+    self.assertEqual(segment('/user/', False), 'user')
+    self.assertEqual(segment('/about', True), 'about')
+    self.assertEqual(segment('/', True), '')
+    self.assertIsNone(segment('/user', False))
+    self.assertIsNone(segment('', False))
+
+  def testCandidates(self):
+    """Only routes that can match the segment and method are candidates"""
+    index = uweb3.RouteIndex([
+        ('/user/(\\d+)', ('user', 'User', 'ALL')),
+        ('/api/(\\w+)', ('api', 'Api', 'POST')),
+        ('/(.*)', ('all', 'All', 'ALL'))])
+    names = lambda url, method: [route[1] for route in
+                                 index.Candidates(url, method)]
+    self.assertEqual(names('/user/1', 'GET'), ['user', 'all'])
+    self.assertEqual(names('/api/x', 'GET'), ['all'])
+    self.assertEqual(names('/api/x', 'POST'), ['api', 'all'])
+    self.assertEqual(names('/other', 'PUT'), ['all'])
+
+
+if __name__ == '__main__':
+  unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
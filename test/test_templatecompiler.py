@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+"""Tests for the compiled templates of the templateparser module.
+
+The full templateparser test suite is run twice more: once with every template
+compiled before its first parse, and once with compilation disabled. On top of
+that, the output of both render paths is compared directly.
+"""
+
+# Too many public methods
+# pylint: disable=R0904
+
+# Standard modules
+import unittest
+
+# Unittest target
+from uweb3 import templateparser
+from test import test_templateparser
+
+
+def RenderMode(compile_after):
+  """Returns a TestCase mixin that sets Template.COMPILE_AFTER for its tests."""
+  class RenderModeMixin:
+    """Sets the compilation threshold for the duration of a test."""
+    def setUp(self):
+      self.compile_after = templateparser.Template.COMPILE_AFTER
+      templateparser.Template.COMPILE_AFTER = compile_after
+      super().setUp()
+
+    def tearDown(self):
+      super().tearDown()
+      templateparser.Template.COMPILE_AFTER = self.compile_after
+  return RenderModeMixin
+
+
+Compiled = RenderMode(0)
+Interpreted = RenderMode(None)
+
+# Rerun every templateparser testcase in both compiled and interpreted mode.
+for _name, _case in list(vars(test_templateparser).items()):
+  if (isinstance(_case, type) and issubclass(_case, unittest.TestCase) and
+      _case.__module__ == test_templateparser.__name__):
+    for _mode, _mixin in (('Compiled', Compiled), ('Interpreted', Interpreted)):
+      globals()[_mode + _name] = type(_mode + _name, (_mixin, _case), {})
+
+
+class CompiledParity(unittest.TestCase):
+  """Compiled templates give the same output and errors as interpreted ones."""
+  TEMPLATES = (
+      ('Hello [name], [name|raw] [name|url]', {'name': '<"Elmer">'}),
+      ('[missing] [obj:key] [obj:absent] [obj:0:1]', {'obj': {'key': 'value'}}),
+      ('[number] [none] [safe]', {'number': 12, 'none': None,
+                                   'safe': templateparser.HTMLsafestring('<b>')}),
+      ('{{ for item in [items] }}<li>[item]</li>{{ endfor }}',
+       {'items': ['a', '<b>', 3]}),
+      ('{{ for key, val in [items|items|sorted] }}[key]=[val] {{ endfor }}',
+       {'items': {'b': 2, 'a': 1}}),
+      ('[x] {{ for x in [xs] }}{{ for y in [x] }}[x][y]{{ endfor }}{{ endfor }} [x]',
+       {'x': 'out', 'xs': ['ab', 'cd']}),
+      ('{{ if [a] == 1 }}one{{ elif [a] > 1 and len([b]) }}many'
+       '{{ else }}none [b]{{ endif }}', {'a': 3, 'b': 'text'}),
+      ('{{ if [a] == 1 }}one{{ elif [a] > 1 and len([b]) }}many'
+       '{{ else }}none [b]{{ endif }}', {'a': 0, 'b': 'text'}),
+      ('{{ if [a|len] > 2 }}long{{ endif }}', {'a': 'abc'}),
+      ('{{ if isinstance([a], int) and pi > 3 }}int{{ endif }}', {'a': 1}),
+      ('{{ if [present] or [absent] }}lazy{{ endif }}', {'present': True}),
+      ('{{ ifpresent [a] [b:c] }}yes{{ elif [d] }}d{{ else }}no{{ endif }}',
+       {'a': 1, 'b': {'c': 2}}),
+      ('{{ ifnotpresent [a] }}absent{{ endif }}', {}),
+      ('text {{ comment hidden }}[a]{{ endcomment }} more', {'a': 'x'}),
+      ('{{ if [absent] }}x{{ endif }}', {}),
+      ('{{ if undefined }}x{{ endif }}', {}),
+      ('{{ if open([a]) }}x{{ endif }}', {'a': 'file'}),
+      ('{{ for a, b in [items] }}[a]{{ endfor }}', {'items': ['abc']}),
+      ('{{ for a in [absent] }}[a]{{ endfor }}', {}),
+      ('[a|nonexistant]', {'a': 1}),
+  )
+
+  def Render(self, template, replacements, compile_after):
+    """Returns the output, or the type of error raised, in the given mode."""
+    tmpl = templateparser.Template(template, parser=templateparser.Parser())
+    tmpl.COMPILE_AFTER = compile_after
+    try:
+      return tmpl.Parse(**replacements)
+    except templateparser.Error as error:
+      return type(error), str(error)
+
+  def testParity(self):
+    """[Compiled] Compiled and interpreted templates give equal results"""
+    for template, replacements in self.TEMPLATES:
+      compiled = self.Render(template, replacements, 0)
+      interpreted = self.Render(template, replacements, None)
+      self.assertEqual(compiled, interpreted, template)
+      self.assertEqual(type(compiled), type(interpreted), template)
+
+  def testJITTagParity(self):
+    """[Compiled] JITTags receive the same replacements in both modes"""
+    template = '{{ for item in [items] }}[jit] {{ endfor }}'
+    jit = templateparser.JITTag(lambda **kwds: sorted(kwds))
+    replacements = {'items': (1, 2), 'jit': jit}
+    self.assertEqual(self.Render(template, replacements, 0),
+                     self.Render(template, replacements, None))
+
+
+class TemplateCompilation(unittest.TestCase):
+  """Tests the code generated for, and the compilation of Templates."""
+  def setUp(self):
+    """Makes the Template and TemplateCompiler available on the instance."""
+    self.tmpl = templateparser.Template
+    self.source = lambda template: templateparser.TemplateCompiler(
+        self.tmpl(template)).Source()
+
+  def testLiteralTextJoined(self):
+    """[Compiled] Adjacent literal text is added as one constant"""
+    source = self.source('Hello {{ comment x }}[a]{{ endcomment }}world')
+    self.assertIn("_tmpl_a('Hello world')", source)
+
+  def testTagLocalVariables(self):
+    """[Compiled] Tag names are retrieved once, into local variables"""
+    source = self.source('[name] and [name] and [name:first]')
+    self.assertEqual(source.count("_tmpl_r0.get('name'"), 1)
+
+  def testNativeConditional(self):
+    """[Compiled] Conditionals without tag functions are native Python"""
+    source = self.source('{{ if [a] > 1 }}x{{ elif [b] }}y{{ endif }}')
+    self.assertIn('if (', source)
+    self.assertIn('elif (', source)
+    self.assertNotIn('.Expression(', source)
+
+  def testFunctionConditionalEvaluated(self):
+    """[Compiled] Conditionals with tag functions use the Expression method"""
+    source = self.source('{{ if [a|len] > 1 }}x{{ endif }}')
+    self.assertIn('.Expression(', source)
+
+  def testCompileAfter(self):
+    """[Compiled] Templates are compiled after COMPILE_AFTER interpretations"""
+    template = self.tmpl('Hello [name]')
+    template.COMPILE_AFTER = 2
+    for _parse in range(2):
+      self.assertEqual(template.Parse(name='a'), 'Hello a')
+      self.assertIsNone(template._compiled)
+    self.assertEqual(template.Parse(name='b'), 'Hello b')
+    self.assertTrue(template._compiled)
+
+  def testNoCompilation(self):
+    """[Compiled] Templates are never compiled if COMPILE_AFTER is None"""
+    template = self.tmpl('Hello [name]')
+    template.COMPILE_AFTER = None
+    for _parse in range(5):
+      template.Parse(name='a')
+    self.assertIsNone(template._compiled)
+
+  def testRecompileAfterChange(self):
+    """[Compiled] Extending a template discards its compiled version"""
+    template = self.tmpl('Hello [name]')
+    template.Compile()
+    template.AddString(', bye')
+    self.assertIsNone(template._compiled)
+    self.assertEqual(template.Parse(name='a'), 'Hello a, bye')
+
+  def testCompileFallback(self):
+    """[Compiled] Templates that Python can't compile are interpreted"""
+    depth = 30
+    template = self.tmpl('{{ for x in [x] }}' * depth + '[x]' +
+                         '{{ endfor }}' * depth)
+    value = 'deep'
+    for _level in range(depth):
+      value = [value]
+    self.assertIsNone(template.Compile())
+    self.assertEqual(template.Parse(x=value), 'deep')
+
+  def testStreamLiteralTextEncoded(self):
+    """[Compiled] Streamed literal text is encoded when compiling"""
+    compiler = templateparser.TemplateCompiler(
+        self.tmpl('Héllo [name]'), encoding='utf-8', stream=True)
+    source = compiler.Source()
+    self.assertIn("yield %r" % 'Héllo '.encode('utf-8'), source)
+    self.assertIn(".encode('utf-8')", source)
+    self.assertNotIn('_tmpl_a(', source)
+
+  def testStreamCompiled(self):
+    """[Compiled] Compiled templates stream from a generator function"""
+    template = self.tmpl('Hello [name]')
+    template.Compile()
+    self.assertEqual(list(template.Stream({'name': '<b>'})),
+                     [b'Hello &lt;b&gt;'])
+    self.assertTrue(template._encoded['utf-8', True])
+    template.AddString('!')
+    self.assertEqual(list(template.Stream({'name': 'b'})), [b'Hello b!'])
+
+  def testBytesLiteralText(self):
+    """[Compiled] Literal text is added as the bytes encoded when parsing"""
+    template = self.tmpl('Héllo [name]')
+    template[0].encoded = b'pre-encoded '
+    source = templateparser.TemplateCompiler(template, 'utf-8').Source()
+    self.assertIn("_tmpl_a(b'pre-encoded ')", source)
+    self.assertIn(".ParseValue(_tmpl_v0_0, _tmpl_r0)).encode('utf-8'))", source)
+
+  def testCompiledOutputSafeString(self):
+    """[Compiled] Compiled templates return an HTMLsafestring"""
+    template = self.tmpl('Hello [name]')
+    template.Compile()
+    result = template.Parse(name='<b>')
+    self.assertIsInstance(result, templateparser.HTMLsafestring)
+    self.assertEqual(result, 'Hello &lt;b&gt;')
+
+
+class PersistentTagFolding(unittest.TestCase):
+  """Tests the folding of persistent tags into the compiled templates."""
+  def setUp(self):
+    """Sets up a parser with persistent tags."""
+    self.parser = templateparser.Parser()
+    self.parser.RegisterTag('site', '<Site>', persistent=True)
+    self.parser.RegisterTag('level', 3, persistent=True)
+    self.parser.RegisterTag('menu', ['a', 'b'], persistent=True)
+
+  def Template(self, template):
+    template = templateparser.Template(template, parser=self.parser)
+    template.COMPILE_AFTER = 0
+    return template
+
+  def Parse(self, template, **replacements):
+    return template.ParseScope(
+        templateparser.TemplateScope(self.parser.requesttags, replacements))
+
+  def Source(self, template):
+    return templateparser.TemplateCompiler(template).Source()
+
+  def testFoldedTags(self):
+    """[Folding] Persistent tags are folded into the literal text"""
+    template = self.Template('[site] [site|raw] [site|url] [name]')
+    self.assertIn("_tmpl_a('&lt;Site&gt; <Site> %3CSite%3E ')",
+                  self.Source(template))
+    self.assertEqual(self.Parse(template, name='x'),
+                     '&lt;Site&gt; <Site> %3CSite%3E x')
+
+  def testFoldedConditional(self):
+    """[Folding] Conditionals on persistent tags are folded"""
+    template = self.Template(
+        '{{ if [level] > 5 }}high{{ elif [level] > 2 }}mid [site]'
+        '{{ else }}low{{ endif }}!')
+    source = self.Source(template)
+    self.assertNotIn('if (', source)
+    self.assertIn("_tmpl_a('mid &lt;Site&gt;!')", source)
+    self.assertEqual(self.Parse(template), 'mid &lt;Site&gt;!')
+
+  def testPartiallyFoldedConditional(self):
+    """[Folding] Folding stops at the first non-persistent condition"""
+    template = self.Template('{{ if [level] > 5 }}high{{ elif [a] }}a'
+                             '{{ elif [level] }}level{{ endif }}')
+    source = self.Source(template)
+    self.assertNotIn('high', source)
+    self.assertIn('elif (', source)
+    self.assertEqual(self.Parse(template, a=1), 'a')
+    self.assertEqual(self.Parse(template, a=0), 'level')
+
+  def testNotFolded(self):
+    """[Folding] Mutable values, loop aliases and tag functions aren't folded"""
+    self.parser.RegisterTag('jit', templateparser.JITTag(lambda: 'jit'),
+                            persistent=True)
+    template = self.Template(
+        '[menu:0] [jit] [site|len] {{ for site in [menu] }}[site]{{ endfor }}')
+    self.assertNotIn('if _tmpl_r0.get(', self.Source(template))
+    self.assertEqual(self.Parse(template), 'a jit 6 ab')
+
+  def testOverridden(self):
+    """[Folding] Replacements and request tags override persistent tags"""
+    template = self.Template('[site] {{ if [level] > 2 }}high{{ endif }}')
+    for _parse in range(2):
+      self.assertEqual(self.Parse(template), '&lt;Site&gt; high')
+      self.assertEqual(self.Parse(template, site='mine', level=1), 'mine ')
+      self.parser.RegisterTag('site', 'request')
+      self.assertEqual(self.Parse(template), 'request high')
+      self.assertEqual(template.Parse(site='<b>', level=5), '&lt;b&gt; high')
+      self.parser.ClearRequestTags()
+
+  def testOverriddenStream(self):
+    """[Folding] Streamed templates fall back to the unfolded output too"""
+    template = self.Template('[site]!')
+    for _parse in range(2):
+      self.assertEqual(b''.join(template.Stream(
+          templateparser.TemplateScope(self.parser.requesttags, {}))),
+                       b'&lt;Site&gt;!')
+      self.assertEqual(b''.join(template.Stream({'site': 'x'})), b'x!')
+
+  def testReregistered(self):
+    """[Folding] Templates are compiled again when persistent tags change"""
+    template = self.Template('[site] [level]')
+    self.assertEqual(self.Parse(template), '&lt;Site&gt; 3')
+    compiled = template._compiled
+    self.parser.RegisterTag('site', 'New', persistent=True)
+    self.assertEqual(self.Parse(template), 'New 3')
+    self.assertIsNot(template._compiled, compiled)
+    compiled = template._compiled
+    self.parser.RegisterTag('site', self.parser.tags['site'], persistent=True)
+    self.assertEqual(self.Parse(template), 'New 3')
+    self.assertIs(template._compiled, compiled)
+
+
+if __name__ == '__main__':
+  unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
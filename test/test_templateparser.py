@@ -5,10 +5,16 @@
 # pylint: disable=R0904
 
 # Standard modules
+import gc
+import inspect
 import os
 import re
+import sys
+import tempfile
+import threading
 import time
 import unittest
+from unittest import mock
 
 # Unittest target
 from uweb3 import templateparser
@@ -72,6 +78,41 @@ class Parser(unittest.TestCase):
     self.assertEqual(result_parse, result_parse_string)
 
 
+class ParserTags(unittest.TestCase):
+  """Tests the tags registered on the Parser for use in all templates."""
+  def setUp(self):
+    """Sets up a parser instance with a persistent and a request tag."""
+    self.parser = templateparser.Parser()
+    self.parser.RegisterTag('site', 'persistent', persistent=True)
+    self.parser.RegisterTag('user', 'request')
+    self.parse = self.parser.ParseString
+
+  def testRegisteredTags(self):
+    """[ParserTags] Persistent and request tags are available to templates"""
+    self.assertEqual(self.parse('[site] [user]'), 'persistent request')
+
+  def testTagPrecedence(self):
+    """[ParserTags] Replacements override request tags, which override persistent tags"""
+    self.parser.RegisterTag('site', 'request')
+    self.assertEqual(self.parse('[site]'), 'request')
+    self.assertEqual(self.parse('[site] [user]', user='call'), 'request call')
+
+  def testClearRequestTags(self):
+    """[ParserTags] Clearing the request tags keeps the persistent tags"""
+    self.parser.ClearRequestTags()
+    self.assertEqual(self.parse('[site] [user]'), 'persistent [user]')
+    self.parser.RegisterTag('later', 'persistent', persistent=True)
+    self.assertEqual(self.parse('[later]'), 'persistent')
+
+  def testNestedRequestTag(self):
+    """[ParserTags] Nested request tags don't modify the persistent tags"""
+    self.parser.RegisterTag('page:title', 'Home', persistent=True)
+    self.parser.RegisterTag('page:user', 'Elmer')
+    self.assertEqual(self.parse('[page:title] [page:user]'), '[page:title] Elmer')
+    self.parser.ClearRequestTags()
+    self.assertEqual(self.parse('[page:title] [page:user]'), 'Home [page:user]')
+
+
 class ParserPerformance(unittest.TestCase):
   """Basic performance test of the Template's initialization and Parsing."""
   @staticmethod
@@ -84,6 +125,54 @@ class ParserPerformance(unittest.TestCase):
         tmpl.Parse(obj={'foo': 'template'}, bar='hack')
 
 
+def CountReplacementCopies(function, *args, **kwds):
+  """Returns the result of the function, and the keyword dicts built for it.
+
+  Every call to a function that takes **kwds builds a new dictionary, for the
+  template nodes this is a copy of the replacements. The number of these dicts
+  and the total number of entries copied into them is counted.
+  """
+  counts = {'dicts': 0, 'entries': 0}
+  def Profile(frame, event, _arg):
+    code = frame.f_code
+    if event == 'call' and code.co_flags & inspect.CO_VARKEYWORDS:
+      kwds_name = code.co_varnames[code.co_argcount + code.co_kwonlyargcount +
+                                   bool(code.co_flags & inspect.CO_VARARGS)]
+      if frame.f_locals[kwds_name]:
+        counts['dicts'] += 1
+        counts['entries'] += len(frame.f_locals[kwds_name])
+  sys.setprofile(Profile)
+  try:
+    return function(*args, **kwds), counts
+  finally:
+    sys.setprofile(None)
+
+
+class TemplateScopePerformance(unittest.TestCase):
+  """Loops don't copy the replacements for every node and item they render."""
+  def testLoopAllocations(self):
+    """[Scope] A loop of 10k rows is rendered without copying replacements"""
+    template = templateparser.Template(
+        '{{ for row in [rows] }}<tr><td>[row:0]</td><td>[row:1]</td>'
+        '{{ if [row:0] > 5 }}<td>[tag1]</td>{{ endif }}</tr>{{ endfor }}')
+    replacements = {'tag%d' % tag: tag for tag in range(100)}
+    replacements['rows'] = [(row, 'x') for row in range(10000)]
+    template.Parse(**replacements)
+    result, counts = CountReplacementCopies(template.Parse, **replacements)
+    self.assertEqual(result.count('<tr>'), 10000)
+    # Only the call to Parse itself receives the replacements as a new dict.
+    self.assertEqual(counts, {'dicts': 1, 'entries': len(replacements)})
+
+  def testKeywordReplacements(self):
+    """[Scope] Iterator and Expression still accept keyword replacements"""
+    tag = templateparser.TemplateTag.FromString('[rows]')
+    self.assertEqual(list(tag.Iterator(rows=[1, 2])), [1, 2])
+    self.assertEqual(list(tag.Iterator({'rows': [1, 2]})), [1, 2])
+    presence = templateparser.TemplateConditionalPresence
+    self.assertTrue(presence.Expression([tag], rows=()))
+    self.assertFalse(presence.Expression([tag], other=()))
+
+
 class TemplateTagBasic(unittest.TestCase):
   """Tests validity and parsing of simple tags."""
   def setUp(self):
@@ -500,6 +589,31 @@ class TemplateTagFunctionClosures(unittest.TestCase):
     self.assertRaises(templateparser.TemplateSyntaxError,
                       self.parse, template, tag=self.tag)
 
+  def testClosureResolvedOnce(self):
+    """[TagClosures] Closures are created once, not on every parse"""
+    closures = []
+    def Limit(length):
+      closures.append(length)
+      return lambda string: string[:length]
+
+    self.parser.RegisterFunction('limit', Limit)
+    template = templateparser.Template('[tag|limit(5)]', parser=self.parser)
+    for _parse in range(3):
+      self.assertEqual(template.Parse(tag=self.tag), self.tag[:5])
+    self.assertEqual(closures, [5])
+
+  def testClosureReregistered(self):
+    """[TagClosures] Registering a function again replaces resolved closures"""
+    template = templateparser.Template('[tag|limit(5)]', parser=self.parser)
+    self.assertEqual(template.Parse(tag=self.tag), self.tag[:5])
+    self.parser.RegisterFunction('limit', lambda length: lambda string: length)
+    self.assertEqual(template.Parse(tag=self.tag), '5')
+
+  def testClosureInLoop(self):
+    """[TagClosures] Closures can be applied to the iterable of a loop"""
+    template = '{{ for char in [tag|limit(3)] }}[char].{{ endfor }}'
+    self.assertEqual(self.parse(template, tag=self.tag), 'h.e.l.')
+
 
 class TemplateUnicodeSupport(unittest.TestCase):
   """TemplateParser handles Unicode gracefully."""
@@ -697,6 +811,40 @@ class TemplateConditionals(unittest.TestCase):
     template = '{{ if [var:present] or [var:absent] }}~{{ endif }}'
     self.assertEqual(self.parse(template, var={'present': 1}), '~')
 
+  def testExpressionCompiledOnce(self):
+    """{{ if }} Expressions are compiled when building, not for every parse"""
+    compiled = []
+    limited_compile = templateparser.LimitedCompile
+    def CountingCompile(expr, astvisitor):
+      """Registers the compilation of an expression."""
+      compiled.append(expr)
+      return limited_compile(expr, astvisitor)
+
+    templateparser.LimitedCompile = CountingCompile
+    try:
+      template = templateparser.Template(
+          '{{ for i in [items] }}{{ if [i] > 1 }}[i]{{ endif }}{{ endfor }}')
+      self.assertEqual(len(compiled), 1)
+      for _parse in range(3):
+        self.assertEqual(template.Parse(items=range(4)), '23')
+      self.assertEqual(len(compiled), 1)
+    finally:
+      templateparser.LimitedCompile = limited_compile
+
+  def testEvalWhitelistChange(self):
+    """{{ if }} Changing the eval whitelist applies to existing templates"""
+    parser = templateparser.Parser()
+    template = templateparser.Template(
+        '{{ if sum([numbers]) > 3 }}big{{ endif }}', parser=parser)
+    self.assertRaises(templateparser.TemplateEvaluationError,
+                      template.Parse, numbers=[1, 2, 3])
+    parser.SetEvalWhitelist({'functions': {'sum': sum}}, append=True)
+    for _parse in range(2):
+      self.assertEqual(template.Parse(numbers=[1, 2, 3]), 'big')
+    parser.SetEvalWhitelist()
+    self.assertRaises(templateparser.TemplateEvaluationError,
+                      template.Parse, numbers=[1, 2, 3])
+
 
 class TemplateLoops(unittest.TestCase):
   """TemplateParser properly handles for-loops."""
@@ -778,6 +926,136 @@ class TemplateLoops(unittest.TestCase):
     self.assertFalse(self.parse(template, tag='absent'))
 
 
+class TemplateMinification(unittest.TestCase):
+  """Tests the collapsing of whitespace in the text of templates."""
+  def setUp(self):
+    """Sets up a parser that minifies its templates."""
+    self.parser = templateparser.Parser(minify=True)
+
+  def Parse(self, template, **replacements):
+    return self.parser.ParseString(template, **replacements)
+
+  def testCollapsed(self):
+    """[Minify] Whitespace is collapsed to a line break or a single space"""
+    template = '<ul>\n    <li>[a]   [b]</li>\n\n  </ul>'
+    self.assertEqual(self.Parse(template, a=1, b=2),
+                     '<ul>\n<li>1 2</li>\n</ul>')
+
+  def testNotMinified(self):
+    """[Minify] Templates keep their whitespace unless minify is enabled"""
+    template = '<p>\n    [a]</p>'
+    self.assertEqual(templateparser.Parser().ParseString(template, a=1),
+                     '<p>\n    1</p>')
+    self.assertEqual(templateparser.Template(template).Parse(a=1),
+                     '<p>\n    1</p>')
+
+  def testPreserved(self):
+    """[Minify] Whitespace in pre, textarea and script elements is kept"""
+    for element in ('pre', 'textarea', 'script', 'PRE'):
+      template = '<div>  <%s class="x">  a\n  b </%s>  </div>' % (
+          element, element)
+      self.assertEqual(
+          self.Parse(template),
+          '<div> <%s class="x">  a\n  b </%s> </div>' % (element, element))
+
+  def testPreservedAcrossFunctions(self):
+    """[Minify] Preserved elements may contain tags and template functions"""
+    template = ('<pre>  [a]  {{ if [a] }}  x  {{ endif }}  </pre>  '
+                '{{ if [a] }}  y  {{ endif }}')
+    self.assertEqual(self.Parse(template, a=1), '<pre>  1    x    </pre>  y ')
+
+  def testTagsKept(self):
+    """[Minify] Whitespace in the arguments of tag functions is kept"""
+    self.parser.RegisterFunction(
+        'wrap', lambda padding: lambda value: padding + value + padding)
+    self.assertEqual(self.Parse('  [name|wrap("  ")]  ', name='x'),
+                     '   x   ')
+
+  def testMinifyMethod(self):
+    """[Minify] Minify returns the element that is still open"""
+    self.assertEqual(templateparser.Template.Minify('a  <pre> b'),
+                     ('a <pre> b', 'pre'))
+    self.assertEqual(templateparser.Template.Minify(' b </pre>  c', 'pre'),
+                     (' b </pre> c', None))
+
+
+class TemplateJITTags(unittest.TestCase):
+  """Tests the evaluation and memoization of JITTags."""
+  def setUp(self):
+    """Sets up a parser, and a function that counts its calls."""
+    self.parser = templateparser.Parser()
+    self.calls = []
+
+  def Count(self):
+    self.calls.append(1)
+    return len(self.calls)
+
+  def Parse(self, template, **replacements):
+    return self.parser.ParseString(template, **replacements)
+
+  def testRenderMemoized(self):
+    """[JITTag] The function is called once for every parse of a template"""
+    jit = templateparser.JITTag(self.Count, memoize='render')
+    template = '[jit] {{ for i in [items] }}[jit]{{ endfor }} [jit]'
+    self.assertEqual(self.Parse(template, jit=jit, items='abc'), '1 111 1')
+    self.assertEqual(self.Parse(template, jit=jit, items='ab'), '2 22 2')
+
+  def testRequestMemoized(self):
+    """[JITTag] Request memoized functions are called once per request"""
+    self.parser.RegisterTag('jit', templateparser.JITTag(
+        self.Count, memoize='request'), persistent=True)
+    self.assertEqual(self.Parse('[jit] [jit]'), '1 1')
+    self.assertEqual(self.Parse('[jit]'), '1')
+    self.parser.ClearRequestTags()
+    self.assertEqual(self.Parse('[jit]'), '2')
+
+  def testNotMemoized(self):
+    """[JITTag] By default, the function is called for every tag"""
+    jit = templateparser.JITTag(lambda item=None, **_kwds: item * 2)
+    self.assertEqual(
+        self.Parse('{{ for item in [items] }}[jit]{{ endfor }}', jit=jit,
+                   items=(1, 2, 3)), '246')
+    jit = templateparser.JITTag(self.Count)
+    self.assertEqual(self.Parse('[jit] [jit]', jit=jit), '1 2')
+
+  def testMemoizedOnce(self):
+    """[JITTag] A memoized result is reused without calling the function"""
+    jit = templateparser.JITTag(self.Count, memoize='render')
+    scope = templateparser.TemplateScope({})
+    self.assertEqual(jit.Evaluate(scope), 1)
+    self.assertEqual(jit.Evaluate(templateparser.TemplateScope.Nested(scope)), 1)
+    self.assertEqual(self.calls, [1])
+
+  def testInvalidPolicy(self):
+    """[JITTag] Unknown memoize policies raise ValueError"""
+    self.assertRaises(ValueError, templateparser.JITTag, self.Count, 'forever')
+
+  def testIndexedResult(self):
+    """[JITTag] Indices are looked up on the result of the function"""
+    jit = templateparser.JITTag(lambda: {'name': 'Elmer'})
+    self.assertEqual(self.Parse('[jit:name]', jit=jit), 'Elmer')
+
+  def testNotStoredOnTag(self):
+    """[JITTag] Results are not kept on the tag, which parsers may share"""
+    jit = templateparser.JITTag(self.Count, memoize='request')
+    self.assertEqual(self.Parse('[jit]', jit=jit), '1')
+    self.assertEqual(templateparser.Template('[jit]').Parse(jit=jit), '2')
+    self.assertEqual(jit(), 3)
+
+  def testThreadRequestTags(self):
+    """[JITTag] Request tags and their memoized results are per thread"""
+    self.parser.RegisterTag('jit', templateparser.JITTag(
+        self.Count, memoize='request'), persistent=True)
+    self.parser.RegisterTag('user', 'main')
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        self.Parse('[user] [jit]')))
+    thread.start()
+    thread.join()
+    self.assertEqual(results, ['[user] 1'])
+    self.assertEqual(self.Parse('[user] [jit]'), 'main 2')
+
+
 class TemplateTagPresenceCheck(unittest.TestCase):
   """Test cases for the `ifpresent` TemplateParser construct."""
   def setUp(self):
@@ -984,6 +1262,518 @@ class TemplateReloading(unittest.TestCase):
     os.mkdir(self.simple)
     self.assertEqual(self.parser[self.simple].Parse(), self.simple_raw)
 
+  def Modify(self):
+    """Writes new content to the simple template file."""
+    time.sleep(.01) # short pause so that mtime will actually be different
+    with open(self.simple, 'w') as new_template:
+      new_template.write('new content')
+
+  def testReloadNever(self):
+    """[Reload] Templates are not reloaded with the 'never' reload policy"""
+    self.parser.SetReloadPolicy('never')
+    self.Modify()
+    self.assertEqual(self.parser[self.simple].Parse(), self.simple_raw)
+    self.assertEqual(self.parser[self.loop].Parse(blob='1'), self.simple_raw)
+
+  def testReloadInterval(self):
+    """[Reload] Templates are checked at most once per reload interval"""
+    self.parser.SetReloadPolicy('interval', 60)
+    self.Modify()
+    self.assertEqual(self.parser[self.simple].Parse(), self.simple_raw)
+    self.parser.SetReloadPolicy('interval', 0)
+    self.assertEqual(self.parser[self.simple].Parse(), 'new content')
+
+  def testReloadWatch(self):
+    """[Reload] Watched templates are reloaded after a change is detected"""
+    self.parser.SetReloadPolicy('watch', .01)
+    try:
+      self.assertEqual(self.parser[self.simple].Parse(), self.simple_raw)
+      self.Modify()
+      for _wait in range(100):
+        if self.parser._modified:
+          break
+        time.sleep(.01)
+      self.assertEqual(self.parser[self.simple].Parse(), 'new content')
+    finally:
+      self.parser.SetReloadPolicy('always')
+
+  def testWatcherStops(self):
+    """[Reload] The watcher thread stops when its parser is discarded"""
+    parser = templateparser.Parser(reload='watch', reload_interval=.01)
+    watcher = parser._watcher
+    del parser
+    gc.collect()
+    watcher.thread.join(1)
+    self.assertFalse(watcher.thread.is_alive())
+    self.assertIsNone(watcher.parser)
+
+  @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+  def testWatcherForked(self):
+    """[Reload] The watcher thread is started again in a forked process"""
+    self.parser.SetReloadPolicy('watch', .01)
+    try:
+      self.assertEqual(self.parser[self.simple].Parse(), self.simple_raw)
+      pid = os.fork()
+      if not pid:
+        # The child reports by its exit status, whatever happens.
+        status = 1
+        try:
+          self.parser[self.simple].Parse()
+          self.Modify()
+          for _wait in range(100):
+            if self.parser._modified:
+              break
+            time.sleep(.01)
+          if self.parser[self.simple].Parse() == 'new content':
+            status = 0
+        finally:
+          os._exit(status)
+      self.assertEqual(os.waitpid(pid, 0)[1], 0)
+    finally:
+      self.parser.SetReloadPolicy('always')
+
+  def testInlineReplaced(self):
+    """[Reload] Templates inlining a replaced template are rebuilt"""
+    self.parser.SetReloadPolicy('never')
+    self.assertEqual(self.parser[self.loop].Parse(blob='1'), self.simple_raw)
+    self.Modify()
+    self.parser.AddTemplate(self.simple)
+    self.assertTrue(self.parser[self.loop]._stale)
+    self.assertEqual(self.parser[self.loop].Parse(blob='1'), 'new content')
+    self.assertFalse(self.parser[self.loop]._stale)
+
+  def testInlineDependencies(self):
+    """[Reload] Only templates that inline a changed template are rebuilt"""
+    with open('outer.html', 'w') as outer, open('other.html', 'w') as other:
+      outer.write('<{{ inline loop.html }}>')
+      other.write('other')
+    try:
+      self.parser.AddTemplate('outer.html')
+      self.parser.AddTemplate('other.html')
+      self.parser.TemplateChanged(os.path.abspath(self.simple))
+      self.assertTrue(self.parser[self.loop]._stale)
+      self.assertTrue(self.parser['outer.html']._stale)
+      self.assertFalse(self.parser['other.html']._stale)
+      self.assertFalse(self.parser[self.simple]._stale)
+      self.assertEqual(self.parser['outer.html'].Parse(blob='1'),
+                       '<%s>' % self.simple_raw)
+    finally:
+      os.unlink('outer.html')
+      os.unlink('other.html')
+
+  def testInlineShared(self):
+    """[Reload] Templates inlined under different names share one template"""
+    with open('other.html', 'w') as other:
+      other.write('{{ inline ./simple.html }}')
+    try:
+      self.assertIs(self.parser['other.html'][0], self.parser[self.loop][0][0])
+      self.assertIs(self.parser['./simple.html'], self.parser[self.simple])
+    finally:
+      os.unlink('other.html')
+
+  def testStats(self):
+    """[Reload] Parser statistics report the inlined templates"""
+    stats = self.parser.Stats()
+    self.assertEqual(stats['templates'], 2)
+    self.assertEqual(stats['files'], 2)
+    self.assertEqual(stats['inlined'], {os.path.abspath(self.simple): 1})
+    self.assertGreater(stats['nodes'], 0)
+    self.assertGreater(stats['saved'], 0)
+    self.assertLess(stats['saved'], stats['size'])
+
+  def testReloadPolicyInvalid(self):
+    """[Reload] Unknown reload policies are not accepted"""
+    self.assertRaises(ValueError, self.parser.SetReloadPolicy, 'sometimes')
+
+
+class TemplateCache(unittest.TestCase):
+  """Tests for the on-disk cache of parsed templates."""
+  def setUp(self):
+    """Creates a template dir with a page that inlines a partial."""
+    self.tempdir = tempfile.TemporaryDirectory()
+    self.template_dir = os.path.join(self.tempdir.name, 'templates')
+    self.cache_dir = os.path.join(self.tempdir.name, 'cache')
+    os.mkdir(self.template_dir)
+    self.Write('page.html',
+               '[title] {{ inline part.html }}{{ if [a] > 1 }}big{{ endif }}')
+    self.Write('part.html', '<[name|len]>')
+
+  def tearDown(self):
+    self.tempdir.cleanup()
+
+  def Write(self, name, content):
+    """Writes a template file in the template dir."""
+    with open(os.path.join(self.template_dir, name), 'w',
+              encoding='utf-8') as template:
+      template.write(content)
+
+  def Parser(self):
+    """Returns a new parser using the template and cache dirs."""
+    return templateparser.Parser(self.template_dir, cache_dir=self.cache_dir)
+
+  def testCacheUsed(self):
+    """[Cache] Templates are loaded from the cache without parsing them"""
+    expected = self.Parser().Parse('page.html', title='T', name='abc', a=2)
+    self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+    parsed = []
+    add_string = templateparser.Template.AddString
+    def CountingAddString(template, raw_template, *args):
+      """Registers the parsing of a template string."""
+      parsed.append(raw_template)
+      return add_string(template, raw_template, *args)
+
+    templateparser.Template.AddString = CountingAddString
+    try:
+      parser = self.Parser()
+      self.assertEqual(
+          parser.Parse('page.html', title='T', name='abc', a=2), expected)
+      self.assertEqual(parsed, [])
+    finally:
+      templateparser.Template.AddString = add_string
+    self.assertIs(parser['page.html'][2], parser['part.html'])
+
+  def testCacheOutdated(self):
+    """[Cache] Templates whose file changed are parsed again"""
+    self.assertEqual(self.Parser().Parse('part.html', name='abc'), '<3>')
+    self.Write('part.html', '[name]!')
+    self.assertEqual(self.Parser().Parse('part.html', name='abc'), 'abc!')
+
+  def testCacheVersion(self):
+    """[Cache] Templates cached by another version of the parser are ignored"""
+    self.Parser()['part.html']
+    path = os.path.join(self.template_dir, 'part.html')
+    parser = self.Parser()
+    self.assertIsNotNone(parser._LoadCached(*parser._CacheKey(path)))
+    with mock.patch.object(templateparser.Parser, 'CACHE_VERSION', 'other'):
+      self.assertIsNone(parser._LoadCached(*parser._CacheKey(path)))
+    self.assertIn(templateparser._SourceHash(), parser.CACHE_VERSION)
+
+  def testCacheEncoding(self):
+    """[Cache] Templates cached with another encoding are parsed again"""
+    self.Write('part.html', '\xe9')
+    self.assertEqual(self.Parser().Parse('part.html'), '\xe9')
+    parser = templateparser.Parser(self.template_dir, cache_dir=self.cache_dir,
+                                   templateEncoding='latin-1')
+    self.assertEqual(parser.Parse('part.html'), '\xc3\xa9')
+
+  def testCacheInlineDependencies(self):
+    """[Cache] Inline dependencies are restored for cached templates"""
+    self.Parser()['page.html']
+    parser = self.Parser()
+    parser['page.html']
+    parser.TemplateChanged(os.path.join(self.template_dir, 'part.html'))
+    self.assertTrue(parser['page.html']._stale)
+
+  def testPrewarmCache(self):
+    """[Cache] The cache can be prewarmed for all templates in a directory"""
+    names = templateparser.PrewarmCache([self.template_dir, self.cache_dir])
+    self.assertEqual(sorted(names), ['page.html', 'part.html'])
+    self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+  @unittest.skipUnless(hasattr(os, 'symlink'), 'requires os.symlink')
+  def testPrewarmCacheSymlink(self):
+    """[Cache] The cache can be prewarmed through a symlinked directory"""
+    current = os.path.join(self.tempdir.name, 'current')
+    os.symlink(self.template_dir, current)
+    names = templateparser.PrewarmCache([current, self.cache_dir])
+    self.assertEqual(sorted(names), ['page.html', 'part.html'])
+
+  def testPrewarmCompile(self):
+    """[Cache] Prewarming compiles the templates and reports failures"""
+    self.Write('broken.html', '{{ if [a] }}unclosed')
+    parser = self.Parser()
+    names, failures = parser.Prewarm(compile=True)
+    self.assertEqual(sorted(names), ['page.html', 'part.html'])
+    self.assertEqual(list(failures), ['broken.html'])
+    self.assertIsInstance(failures['broken.html'],
+                          templateparser.TemplateSyntaxError)
+    self.assertTrue(parser['page.html']._compiled)
+
+  def testPrewarmSkipsOtherFiles(self):
+    """[Cache] Prewarming skips binary, hidden and backup files"""
+    with open(os.path.join(self.template_dir, 'logo.png'), 'wb') as image:
+      image.write(b'\x89PNG\r\n\x1a\n\x00\xff')
+    self.Write('.page.html.swp', '{{ if [a] }}')
+    self.Write('page.html~', '{{ if [a] }}')
+    names, failures = self.Parser().Prewarm(compile=True)
+    self.assertEqual(sorted(names), ['page.html', 'part.html'])
+    self.assertEqual(failures, {})
+
+
+class TemplateFragmentCaching(unittest.TestCase):
+  """Tests the caching of template fragments with {{ cache }}."""
+  def setUp(self):
+    """Sets up a parser, and a tag function that counts its calls."""
+    self.parser = templateparser.Parser()
+    self.calls = []
+    self.parser.RegisterTag('menu', templateparser.JITTag(
+        lambda: self.calls.append(1) or 'menu %d' % len(self.calls)))
+
+  def Template(self, template):
+    return templateparser.Template(template, parser=self.parser)
+
+  def testCachedOutput(self):
+    """[Cache] The output of a cache block is reused by later parses"""
+    template = self.Template('[title]: {{ cache menu 60 }}[menu]{{ endcache }}')
+    scope = templateparser.TemplateScope(self.parser.requesttags)
+    for title in ('one', 'two', 'three'):
+      scope['title'] = title
+      self.assertEqual(template.ParseScope(scope), title + ': menu 1')
+    self.assertEqual(len(self.calls), 1)
+    self.assertEqual(self.parser.Stats()['fragments'],
+                     {'hits': 2, 'misses': 1})
+
+  def testKeyTags(self):
+    """[Cache] Tags in the cache key are replaced"""
+    template = self.Template(
+        '{{ cache menu-[lang] }}[lang] [menu]{{ endcache }}')
+    scope = templateparser.TemplateScope(self.parser.requesttags)
+    for lang, expected in (('nl', 'nl menu 1'), ('en', 'en menu 2'),
+                           ('nl', 'nl menu 1')):
+      scope['lang'] = lang
+      self.assertEqual(template.ParseScope(scope), expected)
+    self.assertIn('menu-nl', self.parser.fragment_cache._fragments)
+
+  def testSharedKey(self):
+    """[Cache] Templates share fragments with the same key"""
+    scope = templateparser.TemplateScope(self.parser.requesttags)
+    first = self.Template('{{ cache footer }}[menu]{{ endcache }}')
+    second = self.Template('<p>{{ cache footer }}[menu]{{ endcache }}</p>')
+    self.assertEqual(first.ParseScope(scope), 'menu 1')
+    self.assertEqual(second.ParseScope(scope), '<p>menu 1</p>')
+
+  def testExpiry(self):
+    """[Cache] Fragments are rendered again after their ttl"""
+    template = self.Template('{{ cache menu 0.05 }}[menu]{{ endcache }}')
+    scope = templateparser.TemplateScope(self.parser.requesttags)
+    self.assertEqual(template.ParseScope(scope), 'menu 1')
+    self.assertEqual(template.ParseScope(scope), 'menu 1')
+    time.sleep(0.06)
+    self.assertEqual(template.ParseScope(scope), 'menu 2')
+
+  def testLeastRecentlyUsed(self):
+    """[Cache] The least recently used fragments are evicted"""
+    cache = templateparser.FragmentCache(maxsize=2)
+    cache.Set('a', 'A')
+    cache.Set('b', 'B')
+    self.assertEqual(cache.Get('a'), 'A')
+    cache.Set('c', 'C')
+    self.assertEqual(len(cache), 2)
+    self.assertIsNone(cache.Get('b'))
+    self.assertEqual(cache.Get('a'), 'A')
+
+  def testPluggableStore(self):
+    """[Cache] The parser can be given any fragment store"""
+    class DictStore(dict):
+      def Get(self, key):
+        return self.get(key)
+      def Set(self, key, fragment, ttl=None):
+        self[key] = fragment
+      def Clear(self):
+        self.clear()
+    store = DictStore()
+    parser = templateparser.Parser(fragment_cache=store)
+    template = templateparser.Template(
+        '{{ cache x }}[a]{{ endcache }}', parser=parser)
+    self.assertEqual(template.Parse(a=1), '1')
+    self.assertEqual(template.Parse(a=2), '1')
+    self.assertEqual(store, {'x': '1'})
+
+  def testWithoutParser(self):
+    """[Cache] Templates without parser render cache blocks every time"""
+    template = templateparser.Template('{{ cache x }}[a]{{ endcache }}')
+    self.assertEqual(template.Parse(a=1), '1')
+    self.assertEqual(template.Parse(a=2), '2')
+
+  def testSyntax(self):
+    """[Cache] Cache blocks need a key, an optional numeric ttl and an end"""
+    for template in ('{{ cache }}x{{ endcache }}',
+                     '{{ cache a b c }}x{{ endcache }}',
+                     '{{ cache a soon }}x{{ endcache }}',
+                     '{{ cache a }}x',
+                     '{{ cache a }}{{ for x in [y] }}{{ endcache }}'):
+      self.assertRaises(templateparser.TemplateSyntaxError,
+                        self.Template, template)
+
+  def testStringRepresentation(self):
+    """[Cache] Cache blocks convert back to their template string"""
+    template = '{{ cache menu-[lang] 300 }}[menu]{{ endcache }}'
+    self.assertEqual(str(self.Template(template)), template)
+
+
+class TemplateStreaming(unittest.TestCase):
+  """Tests the streaming of template output as encoded chunks."""
+  def setUp(self):
+    """Sets up a parser and a template with a long loop."""
+    self.parser = templateparser.Parser()
+    self.template = templateparser.Template(
+        '<ul>{{ for item in [items] }}<li>[item]</li>{{ endfor }}</ul> [name]',
+        parser=self.parser)
+    self.replacements = {'items': range(1000), 'name': '<Élmer>'}
+
+  def testStreamOutput(self):
+    """[Stream] Streamed output is the encoded output of Parse"""
+    for _parse in range(3):
+      chunks = list(self.template.Stream(self.replacements))
+      self.assertEqual(b''.join(chunks),
+                       self.template.Parse(**self.replacements).encode('utf8'))
+
+  def testStreamEncoding(self):
+    """[Stream] Streamed output is encoded in the requested encoding"""
+    output = b''.join(self.template.Stream(self.replacements, 'latin-1'))
+    self.assertTrue(output.endswith('&lt;Élmer&gt;'.encode('latin-1')))
+
+  def testStreamChunks(self):
+    """[Stream] Output is yielded in chunks of at least STREAM_CHUNK_SIZE"""
+    self.template.STREAM_CHUNK_SIZE = 1000
+    for _parse in range(3):
+      chunks = list(self.template.Stream(self.replacements))
+      self.assertGreater(len(chunks), 5)
+      for chunk in chunks[:-1]:
+        self.assertGreaterEqual(len(chunk), 1000)
+
+  def testStreamLazy(self):
+    """[Stream] The template is rendered while the output is consumed"""
+    def Items():
+      for item in range(100000):
+        rendered.append(item)
+        yield item
+    rendered = []
+    for _parse in range(3):
+      del rendered[:]
+      stream = self.template.Stream({'items': Items(), 'name': ''})
+      next(stream)
+      self.assertLess(len(rendered), 100000)
+
+  def testStreamEmpty(self):
+    """[Stream] Empty templates yield no chunks"""
+    template = templateparser.Template('')
+    for _parse in range(3):
+      self.assertEqual(list(template.Stream({})), [])
+
+  def testRenderBytes(self):
+    """[Bytes] RenderBytes returns the encoded output as a list of chunks"""
+    for _parse in range(3):
+      chunks = self.template.RenderBytes(self.replacements)
+      self.assertIsInstance(chunks, list)
+      self.assertGreater(len(chunks), 1)
+      self.assertEqual(b''.join(chunks),
+                       self.template.Parse(**self.replacements).encode('utf8'))
+
+  def testRenderBytesLiteralText(self):
+    """[Bytes] Literal text is output as encoded when parsing the template"""
+    template = templateparser.Template('<p>[name]</p>')
+    self.assertEqual(template[0].encoded, b'<p>')
+    template[0].encoded = b'<div>'
+    template.COMPILE_AFTER = None
+    self.assertEqual(template.RenderBytes({'name': 'é'}),
+                     [b'<div>', 'é'.encode('utf8'), b'</p>'])
+    self.assertEqual(template.RenderBytes({'name': 'é'}, 'latin-1'),
+                     [b'<p>', 'é'.encode('latin-1'), b'</p>'])
+
+  def testParserParseBytes(self):
+    """[Bytes] The parser returns a template as list of encoded chunks"""
+    name = 'bytes_template'
+    with open(name, 'w') as template:
+      template.write('[greeting] [name]')
+    try:
+      self.parser.RegisterTag('greeting', 'Hello')
+      self.assertEqual(
+          b''.join(self.parser.ParseBytes(name, {'name': 'Elmer'})),
+          b'Hello Elmer')
+    finally:
+      os.unlink(name)
+
+  def testParserStreamRequestTags(self):
+    """[Stream] Request tags are available after ClearRequestTags"""
+    name = 'stream_template'
+    with open(name, 'w') as template:
+      template.write('[greeting] [name]')
+    try:
+      self.parser.RegisterTag('greeting', 'Hello')
+      stream = self.parser.Stream(name, {'name': 'Elmer'})
+      self.parser.ClearRequestTags()
+      self.assertEqual(b''.join(stream), b'Hello Elmer')
+    finally:
+      os.unlink(name)
+
+  def testStreamErrors(self):
+    """[Stream] Template errors are raised while streaming"""
+    template = templateparser.Template('[a|nonexistant]')
+    for _parse in range(3):
+      self.assertRaises(templateparser.TemplateFunctionError,
+                        b''.join, template.Stream({'a': 1}))
+
+
+class TemplateProfiling(unittest.TestCase):
+  """Tests the recording of template render times by the TemplateProfiler."""
+  def setUp(self):
+    """Sets up a parser with profiling enabled."""
+    self.parser = templateparser.Parser()
+    self.parser.SetProfiling()
+    self.template = templateparser.Template(
+        '{{ for item in [items] }}[item|upper]{{ endfor }}'
+        '{{ if [count] > 2 }}many{{ else }}few{{ endif }}', parser=self.parser)
+
+  def testProfilingOutput(self):
+    """[Profile] Profiled templates give the same output"""
+    for _parse in range(3):
+      self.assertEqual(self.template.Parse(items='abc', count=3), 'ABCmany')
+      self.assertEqual(self.template.Parse(items='', count=1), 'few')
+
+  def testProfilingDisabled(self):
+    """[Profile] Nothing is recorded unless profiling is enabled"""
+    self.assertIsNone(templateparser.Parser().profiler)
+    self.parser.SetProfiling(False)
+    self.template.Parse(items='abc', count=3)
+    self.assertIsNone(self.parser.profiler)
+
+  def testProfilingStats(self):
+    """[Profile] Calls are counted for templates, loops, branches and functions"""
+    self.template.Parse(items='abc', count=3)
+    self.template.Parse(items='ab', count=1)
+    stats = self.parser.profiler.Stats()
+    self.assertEqual(stats['templates']['string']['calls'], 2)
+    self.assertEqual(
+        stats['loops']['string: {{ for item in [items] }}']['calls'], 2)
+    self.assertEqual(stats['branches']['string: {{ if [count] > 2 }}'],
+                     {'calls': 1, 'time': mock.ANY})
+    self.assertEqual(stats['branches']['string: {{ else }}']['calls'], 1)
+    self.assertEqual(stats['functions']['upper']['calls'], 5)
+    self.assertGreaterEqual(stats['templates']['string']['time'],
+                            stats['functions']['upper']['time'])
+
+  def testProfilingJITTags(self):
+    """[Profile] The evaluation of JITTags is recorded by tag name"""
+    template = templateparser.Template('[slow] [slow]', parser=self.parser)
+    self.assertEqual(template.Parse(slow=templateparser.JITTag(lambda: 'x')),
+                     'x x')
+    self.assertEqual(self.parser.profiler.Stats()['jittags']['slow']['calls'],
+                     2)
+
+  def testProfilingHTMLTable(self):
+    """[Profile] The profile is available as an escaped HTML table"""
+    template = templateparser.Template('[a|html]', parser=self.parser)
+    template.name = '<script>'
+    template.Parse(a=1)
+    table = self.parser.profiler.HTMLTable()
+    self.assertIsInstance(table, templateparser.HTMLsafestring)
+    self.assertIn('<td>&lt;script&gt;</td>', table)
+    self.assertIn('<td>html</td>', table)
+
+  def testProfilingReset(self):
+    """[Profile] Resetting the profiler discards the recorded data"""
+    self.template.Parse(items='abc', count=3)
+    self.parser.profiler.Reset()
+    self.assertEqual(self.parser.profiler.Stats()['templates'], {})
+
+  def testProfilingStream(self):
+    """[Profile] Streamed templates are profiled as well"""
+    self.assertEqual(b''.join(self.template.Stream({'items': 'a', 'count': 3})),
+                     b'Amany')
+    self.assertEqual(
+        self.parser.profiler.Stats()['templates']['string']['calls'], 1)
+
 
 class DictTemplateTagBasic(unittest.TestCase):
   """Tests validity and parsing of simple tags with dict output."""
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+"""Tests for the uWeb WSGI application."""
+
+# Too many public methods
+# pylint: disable=R0904
+
+# Standard modules
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+# Unittest target
+import uweb3
+from uweb3 import templateparser
+from uweb3.pagemaker import decorators
+
+
+class StreamingResponseTest(unittest.TestCase):
+  """Tests the streaming of template output by the WSGI application."""
+
+  class Pages(uweb3.PageMaker):
+    """PageMaker with a handler that streams its template."""
+    TEMPLATE_DIR = 'templates'
+
+    @decorators.TemplateParser('rows.html', stream=True)
+    def Rows(self):
+      return {'rows': range(10)}
+
+  def setUp(self):
+    """Sets up an application with the template in a temporary directory."""
+    self.tempdir = tempfile.TemporaryDirectory()
+    os.mkdir(os.path.join(self.tempdir.name, 'templates'))
+    with open(os.path.join(self.tempdir.name, 'templates', 'rows.html'),
+              'w') as template:
+      template.write('{{ for row in [rows] }}<p>[row]</p>{{ endfor }}')
+    self.app = uweb3.uWeb(self.Pages, [('/', 'Rows')],
+                          executing_path=self.tempdir.name)
+
+  def tearDown(self):
+    """Removes the template directory, and the parser that reads from it."""
+    self.Pages.PERSISTENT.Del('__parser')
+    self.tempdir.cleanup()
+
+  def Request(self, started):
+    """Calls the application for the streaming page, returns the body."""
+    env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/', 'QUERY_STRING': '',
+           'HTTP_HOST': 'localhost', 'SERVER_NAME': 'localhost',
+           'SERVER_PORT': '80', 'REMOTE_ADDR': '127.0.0.1',
+           'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO()}
+    return self.app(env, lambda status, headers: started.append(
+        (status, headers)))
+
+  def testStreamedBody(self):
+    """Streamed template output is sent as an iterator of encoded chunks"""
+    started = []
+    with mock.patch.object(templateparser.Template, 'STREAM_CHUNK_SIZE', 16):
+      body = self.Request(started)
+      self.assertEqual(iter(body), body)
+      self.assertEqual(started, [])
+      first = next(body)
+      self.assertEqual(started, [
+          ('200 OK', [('Content-Type', 'text/html; charset=utf-8')])])
+      chunks = [first] + list(body)
+    self.assertGreater(len(chunks), 1)
+    self.assertTrue(all(isinstance(chunk, bytes) for chunk in chunks))
+    self.assertEqual(b''.join(chunks),
+                     b''.join(b'<p>%d</p>' % row for row in range(10)))
+
+
+if __name__ == '__main__':
+  unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
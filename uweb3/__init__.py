@@ -5,12 +5,15 @@
 __version__ = '3.0.7'
 
 # Standard modules
+import collections
 import configparser
 import datetime
+import heapq
 import logging
 import os
 import re
 import sys
+import threading
 import time
 from importlib import reload
 from wsgiref.simple_server import make_server
@@ -40,8 +43,392 @@ class NoRouteError(Error):
   """The server does not know how to route this request"""
 
 
+class RouteIndex:
+  """Indexes routes by the first segment of their path, and by their method.
+
+  Every route has a literal prefix: the start of its pattern, up to the first
+  regex syntax. A route is only tried for URLs that start with its prefix. If
+  the prefix holds the complete first segment of the path, like '/user/' does,
+  the route is only a candidate for URLs with that first segment. Other routes
+  are candidates for every URL.
+
+  The candidates are precomputed for every combination of segment and method.
+  They keep the order of the routes, so the first matching route is still the
+  one that is used.
+
+  This is the default routing engine, see Router for the others.
+  """
+  METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+  QUANTIFIERS = frozenset('*+?{')
+
+  def __init__(self, routes):
+    """Builds the index for the given routes.
+
+    Arguments:
+      @ routes: iterable of 2-tuples
+        The uncompiled pattern of each route, and the route tuple of the Router,
+        which holds the method of the route as its third item.
+    """
+    entries = []
+    for order, (pattern, route) in enumerate(routes):
+      prefix, literal = self.LiteralPrefix(pattern)
+      entries.append((self.Segment(prefix, literal), order,
+                      (prefix,) + tuple(route)))
+    self.methods = {entry[2][3] for entry in entries} - {'ALL'}
+    self.wildcard = {}
+    self.segments = {}
+    for method in self.methods | {None}:
+      wildcard = []
+      segments = collections.defaultdict(list)
+      for segment, order, route in entries:
+        if route[3] in ('ALL', method):
+          (wildcard if segment is None else segments[segment]).append(
+              (order, route))
+      self.wildcard[method] = tuple(route for _order, route in wildcard)
+      for name, candidates in segments.items():
+        self.segments[name, method] = tuple(
+            route for _order, route in heapq.merge(candidates, wildcard,
+                                                   key=lambda entry: entry[0]))
+
+  def Match(self, url, method, hosts):
+    """Returns the handler, groups, host groups and PageMaker for a request.
+
+    The `hosts` are the groups of the host patterns that match the host of the
+    request, as given by HostMatcher. Returns None if no route matches.
+    """
+    for (prefix, pattern, handler, routemethod, hostpattern,
+         page_maker) in self.Candidates(url, method):
+      if not url.startswith(prefix):
+        # clearly not the route we where looking for
+        continue
+      hostmatch = None
+      if hostpattern != '*':
+        hostmatch = hosts.get(hostpattern)
+        if hostmatch is None:
+          # clearly not the host we where looking for
+          continue
+      match = pattern.match(url)
+      if match:
+        # strip out optional groups, as they return '', which would override
+        # the handlers default argument values later on in the page_maker
+        groups = tuple(group for group in match.groups() if group)
+        return handler, groups, hostmatch, page_maker
+    return None
+
+  def Candidates(self, url, method):
+    """Returns the routes that may match `url`, in their original order.
+
+    Every route is a tuple of its literal prefix and the route of the Router.
+    """
+    if method not in self.methods:
+      method = None
+    if url.endswith('\n'):
+      # The '$' that ends the patterns also matches before a final line break.
+      url = url[:-1]
+    segment = url.split('/', 2)[1] if url.startswith('/') else None
+    return self.segments.get((segment, method), self.wildcard[method])
+
+  @classmethod
+  def LiteralPrefix(cls, pattern):
+    """Returns the literal start of a regex pattern, and whether that's all.
+
+    The prefix ends at the first regex syntax. A character that is followed by
+    a quantifier is optional, and not part of the prefix either. Patterns with
+    alternation have no prefix, as another branch might match at the start.
+    """
+    if '|' in pattern:
+      return '', False
+    for index, char in enumerate(pattern):
+      if char in cls.METACHARACTERS:
+        if char in cls.QUANTIFIERS:
+          index -= 1
+        return pattern[:max(index, 0)], False
+    return pattern, True
+
+  @staticmethod
+  def Segment(prefix, literal):
+    """Returns the first segment of the paths a route matches, if it has one.
+
+    The segment is only known if the prefix of the route holds all of it, or
+    if the whole pattern is literal.
+    """
+    if not prefix.startswith('/'):
+      return None
+    if literal:
+      return prefix.split('/', 2)[1]
+    if prefix.find('/', 1) > 0:
+      return prefix[1:prefix.find('/', 1)]
+    return None
+
+
+class CombinedRoutes:
+  """Matches all routes at once, with a single alternation regex.
+
+  Every route becomes a named group `r<n>` in the regex, in the order of the
+  routes, so `re` finds the first matching route in one pass. Its name is the
+  `lastgroup` of the match. The groups of the route itself are taken from the
+  match by their offset, which keeps them the same as with a separate regex.
+  The named groups of a route are renamed to keep them apart.
+
+  Routes that can't be part of the combined regex are matched on their own,
+  between the regexes of the routes before and after them. These are routes
+  for specific hosts, which need to be skipped if the host doesn't match, and
+  patterns with numbered backreferences, conditional groups or global flags.
+
+  There is a separate combined regex for every method of the routes. As `re`
+  still tries the alternatives one by one, this engine suits small route tables
+  best, test/benchmark_router.py compares it with the RouteIndex.
+  """
+  NAMED_GROUP = re.compile(r'\(\?P([<=])(\w+)')
+  UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?\(|^\(\?[aiLmsux]+\)')
+
+  def __init__(self, routes):
+    """Builds the combined regexes for the given routes.
+
+    Arguments:
+      @ routes: iterable of 2-tuples
+        The uncompiled pattern of each route, and the route tuple of the Router,
+        which holds the method of the route as its third item.
+    """
+    routes = [(pattern, tuple(route)) for pattern, route in routes]
+    methods = {route[2] for _pattern, route in routes} - {'ALL'}
+    self.methods = {}
+    for method in methods | {None}:
+      self.methods[method] = self.Combine(
+          (number, pattern, route)
+          for number, (pattern, route) in enumerate(routes)
+          if route[2] in ('ALL', method))
+
+  @classmethod
+  def Combine(cls, routes):
+    """Returns the steps to match the given routes, in the order of the routes.
+
+    Every step is a tuple of a compiled regex and a dictionary. The dictionary
+    holds, by group name, each route with the indices of its groups.
+    """
+    steps = []
+    alternatives = {}
+    def _Flush():
+      if alternatives:
+        steps.append(cls.CombinedStep(alternatives))
+        alternatives.clear()
+    for number, pattern, route in routes:
+      if route[3] != '*' or cls.UNCOMBINABLE.search(pattern):
+        _Flush()
+        steps.append((route[0], {None: (route, range(1, route[0].groups + 1))}))
+        continue
+      name = 'r%d' % number
+      renamed = cls.NAMED_GROUP.sub(
+          lambda match: '(?P%s%s_%s' % (match.group(1), name, match.group(2)),
+          pattern)
+      alternatives[name] = renamed, route
+    _Flush()
+    return steps
+
+  @staticmethod
+  def CombinedStep(alternatives):
+    """Returns the combined regex for the alternatives, and their groups."""
+    regex = re.compile('|'.join(
+        '(?P<%s>%s$)' % (name, pattern)
+        for name, (pattern, _route) in alternatives.items()), re.UNICODE)
+    routes = {}
+    for name, (_pattern, route) in alternatives.items():
+      start = regex.groupindex[name] + 1
+      routes[name] = route, range(start, start + route[0].groups)
+    return regex, routes
+
+  def Match(self, url, method, hosts):
+    """Returns the handler, groups, host groups and PageMaker for a request.
+
+    The `hosts` are the groups of the host patterns that match the host of the
+    request, as given by HostMatcher. Returns None if no route matches.
+    """
+    for regex, routes in self.methods.get(method, self.methods[None]):
+      match = regex.match(url)
+      if not match:
+        continue
+      # routes that are matched on their own are stored under None.
+      (_pattern, handler, _method, hostpattern, page_maker), groups = (
+          routes.get(match.lastgroup) or routes[None])
+      hostmatch = None
+      if hostpattern != '*':
+        hostmatch = hosts.get(hostpattern)
+        if hostmatch is None:
+          continue
+      # strip out optional groups, as they return '', which would override
+      # the handlers default argument values later on in the page_maker
+      groups = tuple(group for group in map(match.group, groups) if group)
+      return handler, groups, hostmatch, page_maker
+    return None
+
+
+class HostMatcher:
+  """Matches the host of a request with the host patterns of the routes.
+
+  The host patterns are regexes that must match the whole host, ignoring case.
+  They are compiled once, when the routes are set up. Patterns that are plain
+  host names are looked up by name instead. The host patterns that match a host
+  are kept for the `cache_size` most recently requested hosts.
+  """
+  HOSTNAME = re.compile(r'[\w.-]+')
+  PORT = re.compile(r':\d*$')
+
+  def __init__(self, patterns, cache_size=256):
+    """Compiles the given host patterns.
+
+    Arguments:
+      @ patterns: iterable of str
+        The host patterns of the routes.
+      % cache_size: int ~~ 256
+        The number of hosts to keep the matching host patterns for.
+    """
+    patterns = set(patterns)
+    self.hostnames = collections.defaultdict(list)
+    for pattern in sorted(patterns):
+      if self.HOSTNAME.fullmatch(pattern):
+        self.hostnames[pattern.lower()].append(pattern)
+    hostnames = {name for names in self.hostnames.values() for name in names}
+    self.regexes = [
+        (pattern, re.compile(pattern, re.UNICODE | re.IGNORECASE))
+        for pattern in sorted(patterns - hostnames)]
+    self.cache_size = cache_size
+    self._cache = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def Match(self, host):
+    """Returns a dict with the groups of every host pattern matching `host`."""
+    with self._lock:
+      try:
+        self._cache.move_to_end(host)
+        return self._cache[host]
+      except KeyError:
+        pass
+    matches = dict.fromkeys(self.hostnames.get(host, ()), ())
+    for pattern, regex in self.regexes:
+      match = regex.fullmatch(host)
+      if match:
+        matches[pattern] = match.groups()
+    with self._lock:
+      self._cache[host] = matches
+      while len(self._cache) > self.cache_size:
+        self._cache.popitem(last=False)
+    return matches
+
+  @classmethod
+  def Host(cls, host):
+    """Returns the Host header of a request in lowercase, without its port."""
+    return cls.PORT.sub('', host).lower()
+
+
+class RouteCache:
+  """Remembers the routes of the most recently requested urls.
+
+  The routes are kept by url, method and host, for the `size` most recently
+  requested combinations. A route is only admitted to these once it is
+  requested a second time. Until then it is kept apart, with the requests
+  without a route, each for the `miss_size` most recent ones. This way,
+  requests for random urls or hosts can't evict the routes that are actually
+  used, also not when they match a route with an open capture like '/(.*)'.
+  """
+  def __init__(self, size=4096, miss_size=256):
+    """Initializes an empty RouteCache.
+
+    Arguments:
+      % size: int ~~ 4096
+        The number of routes to keep.
+      % miss_size: int ~~ 256
+        The number of routes requested once, and of requests without a route,
+        to keep.
+    """
+    self.size = size
+    self.miss_size = miss_size
+    self.hits = 0
+    self.negative_hits = 0
+    self.misses = 0
+    self._routes = collections.OrderedDict()
+    self._candidates = collections.OrderedDict()
+    self._misses = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def Resolve(self, key, resolve, *args):
+    """Returns the cached route for `key`, or the result of `resolve(*args)`.
+
+    The result of `resolve` is cached, including None for no route. Routes
+    found in the candidates are moved to the routes on this second request.
+    """
+    with self._lock:
+      if key in self._routes:
+        self._routes.move_to_end(key)
+        self.hits += 1
+        return self._routes[key]
+      if key in self._candidates:
+        self.hits += 1
+        route = self._routes[key] = self._candidates.pop(key)
+        self._Trim(self._routes, self.size)
+        return route
+      if key in self._misses:
+        self._misses.move_to_end(key)
+        self.negative_hits += 1
+        return None
+      self.misses += 1
+    route = resolve(*args)
+    with self._lock:
+      store = self._candidates if route is not None else self._misses
+      store[key] = route
+      self._Trim(store, self.miss_size)
+    return route
+
+  @staticmethod
+  def _Trim(store, size):
+    """Removes the least recently used entries beyond `size` from `store`."""
+    while len(store) > size:
+      store.popitem(last=False)
+
+  def Clear(self):
+    """Removes all cached routes, and resets the counters."""
+    with self._lock:
+      self._routes.clear()
+      self._candidates.clear()
+      self._misses.clear()
+      self.hits = self.negative_hits = self.misses = 0
+
+  def Stats(self):
+    """Returns the hits, misses, hit rate and the number of cached entries."""
+    with self._lock:
+      lookups = self.hits + self.negative_hits + self.misses
+      return {'hits': self.hits,
+              'negative_hits': self.negative_hits,
+              'misses': self.misses,
+              'hit_rate': ((self.hits + self.negative_hits) / lookups
+                           if lookups else 0.0),
+              'routes': len(self._routes),
+              'candidates': len(self._candidates),
+              'no_routes': len(self._misses)}
+
+
 class Router:
-  def __init__(self, page_class):
+  """Builds the request router for the routes of an application.
+
+  The routes are matched by one of the ENGINES, which must give the same result
+  as trying every route in order:
+    * index: a RouteIndex, which only tries routes that can match the path
+    * combined: CombinedRoutes, which tries all routes in a single regex
+  The engine is chosen with `engine` in the [routing] section of the config.
+
+  With a `cache_size`, the routes of the most recently requested urls are kept
+  in a RouteCache, which is available as the `cache` of the Router.
+  """
+  ENGINES = {'index': RouteIndex, 'combined': CombinedRoutes}
+
+  def __init__(self, page_class, engine='index', cache_size=0,
+               miss_cache_size=256):
+    if engine not in self.ENGINES:
+      raise ValueError('Routing engine should be one of %s, not %r' % (
+          ', '.join(self.ENGINES), engine))
+    self.engine = self.ENGINES[engine]
+    self.cache_size = cache_size
+    self.miss_cache_size = miss_cache_size
+    self.cache = None
     self.pagemakers = page_class.LoadModules()
     self.pagemakers.append(page_class)
 
@@ -52,7 +439,12 @@ class Router:
     pattern (regex) and the name of the handler to use for matching requests.
 
     Before returning the closure, all regexp are compiled, and handler methods
-    are retrieved from the provided `page_class`.
+    are retrieved from the provided `page_class`. The routes are then prepared
+    for matching by the routing engine of the Router.
+
+    A route may also hold the request method it is for, and a host pattern. The
+    host pattern is a regex that must match the whole Host of the request, its
+    groups are returned as the host groups. See HostMatcher.
 
     Arguments:
       @ routes: iterable of 2-tuples.
@@ -62,6 +454,7 @@ class Router:
       request_router: Configured closure that processes urls.
     """
     req_routes = []
+    patterns = []
     # Variable used to store websocket pagemakers,
     # these pagemakers are only created at startup but can have multiple routes.
     # To prevent creating the same instance for each route we store them in a dict
@@ -85,16 +478,28 @@ class Router:
       req_routes.append((re.compile(pattern + '$', re.UNICODE),
                         details[0], #handler,
                         details[1].upper() if len(details) > 1 else 'ALL', #request types
-                        details[2].lower() if len(details) > 2 else '*', #host
+                        details[2] if len(details) > 2 else '*', #host
                         page_maker #pagemaker class
                         ))
+      patterns.append(pattern)
+    engine = self.engine(zip(patterns, req_routes))
+    hostpatterns = {route[3] for route in req_routes} - {'*'}
+    hostmatcher = HostMatcher(hostpatterns) if hostpatterns else None
+    cache = self.cache = (RouteCache(self.cache_size, self.miss_cache_size)
+                          if self.cache_size else None)
+
+    def _Match(url, method, host):
+      hosts = hostmatcher.Match(host) if hostmatcher else {}
+      return engine.Match(url, method, hosts)
 
     def request_router(url, method, host):
       """Returns the appropriate handler and arguments for the given `url`.
 
       The`url` is matched against the compiled patterns in the `req_routes`
-      provided by the outer scope. Upon finding a pattern that matches, the
-      match groups from the regex and the unbound handler method are returned.
+      provided by the outer scope, by the routing engine. Upon finding a
+      pattern that matches, the match groups from the regex and the unbound
+      handler method are returned. If the Router has a cache, known urls are
+      looked up there first.
 
       N.B. The rules are such that the first matching route will be used. There
       is no further concept of specificity. Routes should be written with this in
@@ -114,30 +519,14 @@ class Router:
       Returns:
         2-tuple: handler method (unbound), and tuple of pattern matches.
       """
-
-      for pattern, handler, routemethod, hostpattern, page_maker in req_routes:
-        if routemethod != 'ALL':
-          # clearly not the route we where looking for
-          if isinstance(routemethod, tuple) and method not in routemethod:
-            continue
-          if method != routemethod:
-            continue
-
-        hostmatch = None
-        if hostpattern != '*':
-          # see if we can match this host and extact any info from it.
-          hostmatch = re.compile(f"^{host}$").match(hostpattern)
-          if not hostmatch:
-            # clearly not the host we where looking for
-            continue
-          hostmatch = hostmatch.groups()
-        match = pattern.match(url)
-        if match:
-          # strip out optional groups, as they return '', which would override
-          # the handlers default argument values later on in the page_maker
-          groups = (group for group in match.groups() if group)
-          return handler, groups, hostmatch, page_maker
-      raise NoRouteError(url +' cannot be handled')
+      host = HostMatcher.Host(host)
+      if cache is None:
+        route = _Match(url, method, host)
+      else:
+        route = cache.Resolve((url, method, host), _Match, url, method, host)
+      if route is None:
+        raise NoRouteError(url +' cannot be handled')
+      return route
     return request_router
 
 
@@ -170,8 +559,14 @@ class uWeb:
     self._accesslogger = None
     self._errorlogger = None
     self.initial_pagemaker = page_class
-    self.router = Router(page_class).router(routes)
+    routing = self.config.options.get('routing', {})
+    self.routing = Router(
+        page_class, engine=routing.get('engine', 'index'),
+        cache_size=int(routing.get('cache_size', 0)),
+        miss_cache_size=int(routing.get('miss_cache_size', 256)))
+    self.router = self.routing.router(routes)
     self.setup_routing()
+    self.preload_templates()
     self.encoders = {
         'text/html': lambda x: HTMLsafestring(x, unsafe=True),
         'text/plain': str,
@@ -244,7 +639,7 @@ class uWeb:
       if req.noparse:
         response.content_type = 'application/json'
 
-      if not isinstance(response.text, Basesafestring):
+      if not (response.streaming or isinstance(response.text, Basesafestring)):
         # make sure we always output Safe Strings for our known content-types
         clean_content_type = response.clean_content_type()
         encoder = self.encoders.get(clean_content_type, self.encoders['application/xml'] if str(clean_content_type).endswith('xml') else self.encoders['default'])
@@ -258,6 +653,21 @@ class uWeb:
     # provide users with a PostRequest method to overide too
     if not static and hasattr(pagemaker_instance, 'PostRequest'):
       response = pagemaker_instance.PostRequest(response) or response
+
+    if response.streaming:
+      # the content is rendered while it is sent, so the request connections
+      # stay open until the client has received all of it.
+      self._logrequest(req, response)
+      start_response(response.status, response.headerlist)
+      try:
+        yield from response.text
+      except Exception:
+        # the headers are already sent, all we can do is log and abort.
+        self._logerror(req, pagemaker_instance, method, args)
+        raise
+      finally:
+        pagemaker_instance.CloseRequestConnections()
+      return
     pagemaker_instance.CloseRequestConnections()
 
     # we should at least send out something to make sure we are wsgi compliant.
@@ -397,6 +807,28 @@ class uWeb:
       self.initial_pagemaker.LoadModules(routes=default_route)
 
 
+  def preload_templates(self):
+    """Loads and compiles all templates when the application starts.
+
+    This is enabled by `preload = True` in the [templates] config section, so
+    the first requests don't have to parse templates. Templates that could not
+    be loaded, for instance because of a syntax error, are logged as errors.
+
+    Returns:
+      dict: the names of the failed templates, and their errors.
+    """
+    if self.config.options.get('templates', {}).get('preload', 'False') != 'True':
+      return {}
+    page_class = self.initial_pagemaker
+    parser = page_class.TemplateParser(
+        self.config.options, template_dir=os.path.realpath(
+            os.path.join(self.executing_path, page_class.TEMPLATE_DIR)))
+    _names, failures = parser.Prewarm(compile=True)
+    for name, error in sorted(failures.items()):
+      self.errorlogger.error('Could not preload template %s: %s', name, error)
+    return failures
+
+
 class HotReload:
     """This class handles the thread which scans for file changes in the
     execution path and restarts the server if needed"""
@@ -87,10 +87,10 @@ class Basesafestring(str):
     raise NotImplementedError
 
   def join(self, items):
-    output = []
-    for item in items:
-      output.append(self.__upgrade__(item))
-    return self.__class__(''.join(output))
+    cls = self.__class__
+    return cls(''.join([
+        item if type(item) is cls else self.__upgrade__(item)
+        for item in items]))
 
 
 class SQLSAFE(Basesafestring):
@@ -118,11 +118,22 @@ class SQLSAFE(Basesafestring):
     '\\\\': '\\'
   }
 
+  # Escaping is done by replacing each character in turn. The backslash goes
+  # first, so the backslashes added for the other characters stay as they are.
+  CHARS_ESCAPE_ORDER = tuple(sorted(CHARS_ESCAPE_DICT.items(),
+                                    key=lambda item: item[0] != '\\'))
   CHARS_ESCAPE_REGEX = re.compile(r"""[\0\b\t\n\r\x1a\"\'\\]""")
-  CHARS_UNESCAPE_REGEX = re.compile(r"""((\\t)|(\\0)|(\\n)|(\\b)|(\\r)|(\\Z)|(\\")|(\\\\')|(\\\\\\))""")
+  CHARS_UNESCAPE_REGEX = re.compile(r"""\\[0btnrZ"'\\]""")
   PLACEHOLDERS_REGEX = re.compile(r"""\?+""")
   QUOTES_REGEX = re.compile(r"""([\"'])(?:(?=(\\?))\2.)*?\1""", re.DOTALL)
 
+  def __new__(cls, data, values=(), **kwargs):
+    """Creates an SQLSAFE string, from the `values` and the placeholders in
+    `data` if the `unsafe` keyword is given."""
+    if 'unsafe' in kwargs:
+      data = cls.escape(cls, str(data), values)
+    return str.__new__(cls, data)
+
   def __upgrade__(self, other):
     """Upgrade a given object to be as safe, and in the same safety context as
     the current object
@@ -135,51 +146,36 @@ class SQLSAFE(Basesafestring):
 
   @classmethod
   def sanitize(cls, value, with_quotes=True):
-    index = 0
-    escaped = ""
-    if len(cls.CHARS_ESCAPE_REGEX.findall(value)) == 0:
-      if not str.isdigit(value):
-        if with_quotes:
-          return f"'{value}'"
-        return value
-      return value
-    for m in cls.CHARS_ESCAPE_REGEX.finditer(value):
-      escaped += value[index:m.span()[0]] + cls.CHARS_ESCAPE_DICT[m.group()]
-      index = m.span()[1]
-    escaped += value[index:]
-    if not str.isdigit(escaped):
-      if with_quotes:
-        return f"'{escaped}'"
-      return escaped
+    """Escapes the special characters in `value`, in time linear to its length.
+
+    Values that are not all digits are quoted, unless `with_quotes` is False.
+    """
+    escaped = value
+    for char, replacement in cls.CHARS_ESCAPE_ORDER:
+      escaped = escaped.replace(char, replacement)
+    if with_quotes and not escaped.isdigit():
+      return f"'{escaped}'"
     return escaped
 
   def escape(self, sql, values):
-    x = 0
-    escaped = ""
+    """Returns the `sql` with its placeholders replaced by the escaped values."""
     if not isinstance(values, tuple):
       raise ValueError("Values should be a tuple")
-
-    if len(self.PLACEHOLDERS_REGEX.findall(sql)) != len(values):
+    parts = self.PLACEHOLDERS_REGEX.split(sql)
+    if len(parts) - 1 != len(values):
       raise ValueError("Number of values does not match number of replacements")
-
-    for index, m in enumerate(self.PLACEHOLDERS_REGEX.finditer(sql)):
-      escaped += sql[x:m.span()[0]] + self.sanitize(values[index])
-      x = m.span()[1]
-    escaped += sql[x:]
-    return SQLSAFE(escaped)
+    escaped = [parts[0]]
+    for value, part in zip(values, parts[1:]):
+      escaped.append(self.sanitize(value))
+      escaped.append(part)
+    return SQLSAFE(''.join(escaped))
 
   def unescape(self, value):
+    """Returns the SQLSAFE `value` with the escaping of sanitize() undone."""
     if not isinstance(value, SQLSAFE):
       raise ValueError(f"The value needs to be an instance of the SQLSAFE class and not of type: {type(value)}")
-    x = 0
-    escaped = ""
-    for index, m in enumerate(self.CHARS_UNESCAPE_REGEX.finditer(value)):
-      escaped += value[x:m.span()[0]]
-      target = value[m.span()[0]:m.span()[1]]
-      escaped += self.CHARS_UNESCAPE_DICT.get(target)
-      x = m.span()[1]
-    escaped += value[x:]
-    return SQLSAFE(escaped)
+    return SQLSAFE(self.CHARS_UNESCAPE_REGEX.sub(
+        lambda match: self.CHARS_UNESCAPE_DICT[match.group()], value))
 
 
 # what follows are the actual useable classes that are safe in specific contexts
@@ -196,6 +192,24 @@ class Unsafestring(Basesafestring):
 class HTMLsafestring(Basesafestring):
   """This class signals that the content is HTML safe"""
 
+  @classmethod
+  def upgrade(cls, other):
+    """Returns `other` as HTMLsafestring, escaping it if it is not one already.
+
+    The result equals HTMLsafestring('') + other, but no intermediate strings
+    are created. Strings are escaped directly, numbers need no escaping.
+    """
+    othertype = type(other)
+    if othertype is cls:
+      return other
+    if othertype is str:
+      return str.__new__(cls, html.escape(other))
+    if othertype is int or othertype is float:
+      return str.__new__(cls, other)
+    if isinstance(other, Basesafestring):
+      other = other.unescape(other)
+    return str.__new__(cls, html.escape(str(other)))
+
   def escape(self, data):
     return html.escape(data)
 
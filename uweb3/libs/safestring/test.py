@@ -4,6 +4,7 @@ __author__ = 'Jan Klopper (jan@underdark.nl)'
 __version__ = 0.1
 
 # default modules
+import random
 import unittest
 
 #custom modules
@@ -85,6 +86,22 @@ class TestHTMLStringMethods(unittest.TestCase):
     self.assertIsInstance(testdata, HTMLsafestring)
 
 
+  def test_upgrade(self):
+    """Upgrade gives the same result as adding to an empty HTMLsafestring"""
+    for value in ('foo<test>', '"quoted" & \'single\'', '', 12, -1.5, True,
+                  None, b'<b>', ['<b>'], HTMLsafestring('<b>'),
+                  URLqueryargumentsafestring('a+%3Cb%3E'),
+                  JSONsafestring('"<b>"')):
+      testdata = HTMLsafestring.upgrade(value)
+      self.assertEqual(testdata, HTMLsafestring('') + value)
+      self.assertIsInstance(testdata, HTMLsafestring)
+
+  def test_upgrade_safe(self):
+    """Upgrading an HTMLsafestring returns it as it is"""
+    safe = HTMLsafestring('<b>')
+    self.assertIs(HTMLsafestring.upgrade(safe), safe)
+
+
 class TestJSonStringMethods(unittest.TestCase):
   def test_addition(self):
     testdata = JSONsafestring('foo') + '"test"'
@@ -168,5 +185,72 @@ class TestSQLSAFEMethods(unittest.TestCase):
     self.assertEqual(testdata.unescape(testdata), "SELECT * FROM users WHERE username = 'username\t \t'")
 
 
+def LegacySanitize(value, with_quotes=True):
+  """The SQLSAFE.sanitize implementation that builds its result by addition."""
+  index = 0
+  escaped = ""
+  if len(SQLSAFE.CHARS_ESCAPE_REGEX.findall(value)) == 0:
+    if not str.isdigit(value):
+      if with_quotes:
+        return f"'{value}'"
+      return value
+    return value
+  for m in SQLSAFE.CHARS_ESCAPE_REGEX.finditer(value):
+    escaped += value[index:m.span()[0]] + SQLSAFE.CHARS_ESCAPE_DICT[m.group()]
+    index = m.span()[1]
+  escaped += value[index:]
+  if not str.isdigit(escaped):
+    if with_quotes:
+      return f"'{escaped}'"
+    return escaped
+  return escaped
+
+
+class SQLSAFEProperties(unittest.TestCase):
+  """Checks SQLSAFE escaping against the previous implementation."""
+  ALPHABET = list(SQLSAFE.CHARS_ESCAPE_DICT) + ['a', '1', 'é', ' ', '?', 'Z']
+
+  def setUp(self):
+    self.random = random.Random(42)
+
+  def RandomText(self, length):
+    return ''.join(self.random.choice(self.ALPHABET) for _ in range(length))
+
+  def test_sanitize_equals_legacy(self):
+    """Sanitize gives the same output as the previous implementation"""
+    samples = ['', '123', '١٢٣', 'plain'] + list(SQLSAFE.CHARS_ESCAPE_DICT)
+    samples.extend(a + b for a in SQLSAFE.CHARS_ESCAPE_DICT
+                   for b in SQLSAFE.CHARS_ESCAPE_DICT)
+    samples.extend(self.RandomText(self.random.randint(0, 50))
+                   for _ in range(500))
+    for value in samples:
+      for with_quotes in (True, False):
+        self.assertEqual(SQLSAFE.sanitize(value, with_quotes=with_quotes),
+                         LegacySanitize(value, with_quotes=with_quotes), value)
+
+  def test_escape_placeholders(self):
+    """Escape replaces every run of placeholders by a sanitized value"""
+    for _ in range(200):
+      values = tuple(self.RandomText(10).replace('?', '')
+                     for _ in range(self.random.randint(0, 5)))
+      sql = ' AND '.join('c = ' + '?' * self.random.randint(1, 2)
+                         for _ in values)
+      expected = ' AND '.join('c = ' + LegacySanitize(value)
+                              for value in values)
+      self.assertEqual(SQLSAFE(sql, values=values, unsafe=True), expected)
+
+  def test_sanitize_large(self):
+    """Sanitize gives the same result for large text blobs"""
+    value = 'A user\'s "text" blob,\n with \\ and \t in it. ' * 1000
+    self.assertEqual(SQLSAFE.sanitize(value), LegacySanitize(value))
+
+  def test_unescape_roundtrip(self):
+    """Unescape undoes the escaping for every special character"""
+    for _ in range(200):
+      value = self.RandomText(30)
+      escaped = SQLSAFE(SQLSAFE.sanitize(value, with_quotes=False))
+      self.assertEqual(escaped.unescape(escaped), value)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -12,6 +12,8 @@ import threading
 import time
 import hashlib
 import glob
+import json
+import tempfile
 from base64 import b64encode
 from pymysql import Error as pymysqlerr
 
@@ -23,10 +25,28 @@ from .. import response, templateparser
 
 RFC_1123_DATE = '%a, %d %b %Y %T GMT'
 
+# PageMaker classes found by LoadModules, by working directory and route files.
+DISCOVERED_PAGEMAKERS = {}
+
+
 class ReloadModules(Exception):
   """Signals the handler that it should reload the pageclass"""
 
 
+def IsPageMakerClass(data):
+  """Returns whether a pyclbr class description is of a PageMaker class.
+
+  This is the case if the name of its first base class contains 'PageMaker',
+  or if that base is a PageMaker class defined in the same module.
+  """
+  if not getattr(data, 'super', None):
+    return False
+  base = data.super[0]
+  if isinstance(base, str):
+    return 'PageMaker' in base
+  return 'PageMaker' in base.name or IsPageMakerClass(base)
+
+
 class CacheStorage:
   """A (semi) persistent storage for the PageMaker."""
   def __init__(self):
@@ -189,14 +209,47 @@ class Base:
     If the config file specificied a [templates] section and a `path` is
     assigned in there, this path will be used.
     Otherwise, the `TEMPLATE_DIR` will be used to load templates from.
+
+    The same section may set `reload` to always, interval, watch or never, to
+    control when templates are reloaded from disk. The interval and watch
+    policies check the files every `reload_interval` seconds. Parsed templates
+    are stored in the `cache` directory, if one is given. The output of up to
+    `fragment_cache_size` {{ cache }} blocks is kept in memory. Setting
+    `profile` to True records the time spent rendering templates, see
+    templateparser.TemplateProfiler. Setting `minify` to True collapses the
+    whitespace in the templates when they are parsed.
     """
-    if '__parser' not in self.persistent:
-      self.persistent.Set('__parser', templateparser.Parser(
-          self.options.get('templates', {}).get('path', self.TEMPLATE_DIR)))
-    parser = self.persistent.Get('__parser')
+    parser = self.TemplateParser(self.options)
     parser.dictoutput = self.req.noparse
     return parser
 
+  @classmethod
+  def TemplateParser(cls, options, template_dir=None):
+    """Returns the templateparser.Parser shared by all PageMakers.
+
+    The parser is created on first use, configured by the [templates] section
+    of the given `options`, as described for the `parser` property.
+
+    Arguments:
+      @ options: dict
+        The configuration options of the application.
+      % template_dir: str ~~ None
+        The default template directory, instead of the `TEMPLATE_DIR`.
+    """
+    if '__parser' not in cls.PERSISTENT:
+      templates = options.get('templates', {})
+      cls.PERSISTENT.Set('__parser', templateparser.Parser(
+          templates.get('path', template_dir or cls.TEMPLATE_DIR),
+          reload=templates.get('reload', 'always'),
+          reload_interval=templates.get('reload_interval', 1),
+          cache_dir=templates.get('cache'),
+          minify=templates.get('minify', 'False') == 'True',
+          fragment_cache=templateparser.FragmentCache(
+              int(templates.get('fragment_cache_size', 1024)))))
+      if templates.get('profile', 'False') == 'True':
+        cls.PERSISTENT.Get('__parser').SetProfiling()
+    return cls.PERSISTENT.Get('__parser')
+
 
 class WebsocketPageMaker(Base):
   """Pagemaker for the websocket routes.
@@ -334,24 +387,80 @@ class BasePageMaker(Base):
     return str(type(self))
 
   @classmethod
-  def LoadModules(cls, routes='routes/*.py'):
+  def LoadModules(cls, routes='routes/*.py', cache=True):
     """Loops over all .py files apart from some exceptions in target directory
     Looks for classes that contain pagemaker
 
+    The files are searched for PageMaker classes only once per process. The
+    class names found in each file are also stored in a cache file, in the
+    __pycache__ directory next to the files. Files that have the same
+    modification time and size as before are not parsed again.
+
     Arguments:
-      % default_routes: str
+      % routes: str
         Location to your route files. Defaults to routes/*.py
-        Supports glob style syntax, non recursive.
+        Supports glob style syntax, non recursive. A directory is taken to mean
+        all .py files in it.
+      % cache: bool ~~ True
+        Whether to read and write the cache file of the found classes.
     """
-    bases = []
-    for file in glob.glob(routes):
+    if os.path.isdir(routes):
+      routes = os.path.join(routes, '*.py')
+    key = os.getcwd(), os.path.abspath(routes)
+    if key not in DISCOVERED_PAGEMAKERS:
+      bases = []
+      for module, names in cls._DiscoverPageMakers(routes, cache):
+        for name in names:
+          bases.append(getattr(__import__(module, fromlist=[name]), name))
+      DISCOVERED_PAGEMAKERS[key] = bases
+    return list(DISCOVERED_PAGEMAKERS[key])
+
+  @staticmethod
+  def _DiscoverPageMakers(routes, cache=True):
+    """Yields the route modules and the names of the PageMaker classes in them.
+
+    Files that are unchanged since they were recorded in the cache file are not
+    parsed, the cache file is rewritten if any of the files had to be parsed.
+    """
+    cache_file = os.path.join(
+        os.path.dirname(routes), '__pycache__', 'uweb3-pagemakers.json')
+    stored = {}
+    if cache:
+      try:
+        with open(cache_file) as cached:
+          stored = json.load(cached)
+        if stored.get('version') != uweb3.__version__:
+          stored = {}
+      except (OSError, ValueError):
+        # Missing or broken cache files are ignored, and overwritten.
+        stored = {}
+    files = {}
+    for file in sorted(glob.glob(routes)):
       module = os.path.relpath(os.path.join(os.getcwd(), file[:-3])).replace('/', '.')
-      classlist = pyclbr.readmodule_ex(module)
-      for name, data in classlist.items():
-        if hasattr(data, 'super') and 'PageMaker' in data.super[0]:
-          module = __import__(file, fromlist=[name])
-          bases.append(getattr(module, name))
-    return bases
+      stat = os.stat(file)
+      entry = stored.get('files', {}).get(file)
+      if entry is None or entry['stamp'] != [stat.st_mtime_ns, stat.st_size]:
+        classlist = pyclbr.readmodule_ex(module)
+        entry = {'stamp': [stat.st_mtime_ns, stat.st_size],
+                 'classes': [name for name, data in classlist.items()
+                             if IsPageMakerClass(data)]}
+      files[file] = entry
+      yield module, entry['classes']
+    if cache and files != stored.get('files'):
+      temporary = None
+      try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(cache_file), delete=False) as temporary:
+          json.dump({'version': uweb3.__version__, 'files': files}, temporary)
+        os.replace(temporary.name, cache_file)
+      except OSError:
+        # Discovery simply runs again next time if the cache can't be written.
+        if temporary is not None:
+          try:
+            os.unlink(temporary.name)
+          except OSError:
+            pass
 
   def _PostInit(self):
     """Method that gets called for derived classes of BasePageMaker."""
@@ -466,6 +575,34 @@ class DebuggerMixin:
   CACHE_DURATION = MimeTypeDict({})
   ERROR_TEMPLATE = 'http_500.html'
 
+  def PostRequest(self, response):
+    """Appends the template profile to HTML pages, if profiling is enabled.
+
+    The table with the time spent rendering templates (see the `profile` option
+    of the [templates] section) is placed before the closing body tag. Streamed
+    responses are left as they are. The PostRequest of the next class in the
+    MRO, if any, is called first.
+
+    Arguments:
+      @ response: response.Response
+        The response that is about to be sent to the client.
+    """
+    post_request = getattr(super(), 'PostRequest', None)
+    if post_request is not None:
+      response = post_request(response) or response
+    parser = self.PERSISTENT.Get('__parser', None)
+    if (parser is None or parser.profiler is None or response.streaming or
+        not isinstance(response.text, str) or
+        response.clean_content_type() != 'text/html'):
+      return response
+    table = parser.profiler.HTMLTable()
+    head, body, tail = response.text.rpartition('</body>')
+    if body:
+      response.text = type(response.text)(head + table + body + tail)
+    else:
+      response.text = type(response.text)(response.text + table)
+    return response
+
   def _ParseStackFrames(self, stack):
     """Generates list items for traceback information.
 
@@ -162,17 +162,28 @@ def CSP(resourcetype, urls, append=True):
     return wrapper
   return csp_decorator
 
-def TemplateParser(template, *t_args, **t_kwargs):
+def TemplateParser(template, *t_args, stream=False, encoded=False, **t_kwargs):
   """Decorator that wraps and returns the output.
 
   The output is wrapped in a templateparser call if its not already something
   that we prepared for direct output to the client.
+
+  With `stream` set, the template output is not returned as a whole but sent to
+  the client in chunks while it is rendered, see templateparser.Parser.Stream.
+  With `encoded` set, the template is rendered to a list of encoded chunks,
+  which are sent to the client without joining them, see Parser.ParseBytes.
   """
   def template_decorator(f):
     def wrapper(*args, **kwargs):
       pageresult = f(*args, **kwargs) or {}
       if not isinstance(pageresult, (str, uweb3.Response, uweb3.Redirect)):
-        return args[0].parser.Parse(template, **pageresult)
+        parser = args[0].parser
+        charset = args[0].req.response.charset
+        if stream and not parser.dictoutput:
+          return parser.Stream(template, pageresult, encoding=charset)
+        if encoded and not parser.dictoutput:
+          return iter(parser.ParseBytes(template, pageresult, encoding=charset))
+        return parser.Parse(template, **pageresult)
       return pageresult
     return wrapper
   return template_decorator
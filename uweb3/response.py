@@ -2,6 +2,7 @@
 """uWeb3 response classes."""
 
 # Standard modules
+import collections.abc
 try:
   import httplib
 except ImportError:
@@ -23,7 +24,9 @@ class Response(object):
     Arguments:
       @ content: str
         The content to return to the client. This can be either plain text, html
-        or the contents of a file (images for example).
+        or the contents of a file (images for example). This can also be an
+        iterator of bytes, such as Parser.Stream() returns, to stream the
+        content to the client as it is generated.
       % content_type: str ~~ CONTENT_TYPE ('text/html' by default)
         The Content-Type of the response. This should NOT be set in headers.
       % httpcode: int ~~ 200
@@ -85,6 +88,11 @@ class Response(object):
     """
     self.content = content
 
+  @property
+  def streaming(self):
+    """Returns whether the content is an iterator of bytes, to be streamed."""
+    return isinstance(self.content, collections.abc.Iterator)
+
   # Retrieve a header list
   @property
   def headerlist(self):
@@ -3,6 +3,10 @@
 
 Classes:
   Parser: Parses a template by replacing tags with their values.
+  TemplateWatcher: Watches the template files of a Parser for changes.
+  FragmentCache: Stores the output of {{ cache }} blocks in the template.
+  TemplateProfiler: Records the time spent on rendering parts of templates.
+  TemplateCompiler: Compiles a template into a Python render function.
 
 Error classes:
   Error: Base class for all errors generated by this module
@@ -11,16 +15,25 @@ Error classes:
 """
 __author__ = ('Elmer de Looff <elmer@underdark.nl>',
               'Jan Klopper <jan@underdark.nl>')
-__version__ = '1.7'
+__version__ = '1.8'
 
 # Standard modules
+import collections
+import fnmatch
 import os
 import re
+import sys
 import urllib.parse as urlparse
 from .libs.safestring import *
 import hashlib
 import itertools
 import ast, math
+import builtins
+import pickle
+import tempfile
+import threading
+import time
+import weakref
 
 class Error(Exception):
   """Superclass used for inheritance and external exception handling."""
@@ -58,6 +71,10 @@ class TemplateEvaluationError(Error):
   """Template condition was not within allowed set of operators."""
 
 
+# Marker for tags that have no replacement value, None is a valid replacement.
+MISSING = object()
+
+
 class LazyTagValueRetrieval:
   """Provides a means for lazy tag value retrieval.
 
@@ -109,6 +126,56 @@ class LazyTagValueRetrieval:
     return list(self.itervalues())
 
 
+class TemplateScope(dict):
+  """The replacements for a nested part of a template, such as a loop body.
+
+  A scope only holds its own names, like the aliases of a loop, and looks up
+  all other names in its parent. This way the replacements never have to be
+  copied to render a nested part of the template.
+
+  The `memo` dictionary stores the results of JITTags evaluated with the scope.
+  Scopes for nested parts of a template share the memo of their parent.
+  """
+  __slots__ = 'parent', 'memo'
+
+  def __init__(self, parent, replacements=(), memo=None):
+    super().__init__(replacements)
+    self.parent = parent
+    self.memo = {} if memo is None else memo
+
+  def __missing__(self, key):
+    return self.parent[key]
+
+  def __contains__(self, key):
+    return dict.__contains__(self, key) or key in self.parent
+
+  def get(self, key, default=None):
+    """Returns the value for `key` in this scope or its parents, or `default`."""
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  @classmethod
+  def Nested(cls, parent):
+    """Returns a new scope on top of `parent`, sharing its JITTag memo."""
+    return cls(parent, memo=getattr(parent, 'memo', None))
+
+  def Root(self):
+    """Returns the outermost TemplateScope, for the Parser its request tags."""
+    scope = self
+    while isinstance(scope.parent, TemplateScope):
+      scope = scope.parent
+    return scope
+
+  def Flatten(self):
+    """Returns a dictionary with the names of this scope and all its parents."""
+    parent = self.parent
+    if isinstance(parent, TemplateScope):
+      parent = parent.Flatten()
+    return {**parent, **self}
+
+
 EVALWHITELIST = {
         'functions': {"abs": abs, "complex": complex, "min": min, "max": max,
                       "pow": pow, "round": round, "len": len, "type": type,
@@ -122,6 +189,19 @@ EVALWHITELIST = {
                       ast.Eq, ast.NotEq, ast.Not, ast.Or, ast.BoolOp, ast.Str, ast.Constant, ast.IsNot, ast.Is)}
 
 
+def _SourceHash():
+  """Returns a hash of the source of this module, to version the cache files.
+
+  Parsed templates are pickled, changes to the template classes make any files
+  stored before them unusable, even if the version number stays the same.
+  """
+  try:
+    with open(__file__, 'rb') as source:
+      return hashlib.sha256(source.read()).hexdigest()[:16]
+  except (NameError, OSError):
+    return 'unknown'
+
+
 class Parser(dict):
   """A template parser that loads and caches templates and parses them by name.
 
@@ -140,11 +220,39 @@ class Parser(dict):
   way as the `Parse` method, but the first argument here is a raw template
   string instead.
 
+  Tags registered through `RegisterTag` are available to all parsed templates.
+  Names are looked up in the given replacements first, then in the request tags
+  and finally in the persistent tags. These layers are never merged or copied.
+
   Beyond parsing, the parser grants easy access to the TAG_FUNCTIONS dictionary,
   providing the `RegisterFunction` method to add or replace functions in this
   module constant.
+
+  Whether the templates are reloaded when their file changes is controlled by
+  the reload policy, refer to `SetReloadPolicy` for the available options.
+
+  Given a `cache_dir`, parsed templates are stored on disk, much like Python
+  does in __pycache__. A template is loaded from there as long as its file has
+  the same path, modification time and size, and the parser module the same
+  source. The cached templates are pickles, so the `cache_dir` must only be
+  writable by trusted users: anyone who can write it can run code as the app.
+
+  The output of {{ cache }} blocks in templates is stored in the parser's
+  `fragment_cache`, and shared by all templates and requests. The hits and
+  misses on this cache are counted by the parser and reported by `Stats`.
+
+  With `minify` enabled, the whitespace in the literal text of templates is
+  collapsed when they are parsed, see Template.Minify.
   """
-  def __init__(self, path=None, templates=(), dictoutput=False, templateEncoding='utf-8'):
+  RELOAD_POLICIES = 'always', 'interval', 'watch', 'never'
+  # Hidden, backup and editor swap files, which Prewarm doesn't load.
+  PREWARM_IGNORED = '.*', '*~', '#*#'
+  CACHE_VERSION = '%s-py%d.%d-%s' % (
+      (__version__,) + sys.version_info[:2] + (_SourceHash(),))
+
+  def __init__(self, path=None, templates=(), dictoutput=False,
+               templateEncoding='utf-8', reload='always', reload_interval=1,
+               cache_dir=None, fragment_cache=None, minify=False):
     """Initializes a Parser instance.
 
     This sets up the template directory and preloads any templates given.
@@ -159,17 +267,58 @@ class Parser(dict):
         structure and replaced values as a dict
       % templateEncoding: str ~~ utf-8
         Encoding of the template, used when reading the file.
+      % reload: str ~~ 'always'
+        The reload policy for the templates, see SetReloadPolicy.
+      % reload_interval: float ~~ 1
+        Seconds between checks for modified templates, see SetReloadPolicy.
+      % cache_dir: str ~~ None
+        Directory to store parsed templates in, for faster loading by other
+        processes. Parsed templates are not stored on disk if this is None.
+        Only trusted users should be able to write to this directory.
+      % fragment_cache: FragmentCache ~~ None
+        Store for the output of {{ cache }} blocks, any object with the methods
+        of FragmentCache will do. By default, a new FragmentCache is used.
+      % minify: bool ~~ False
+        Collapse the whitespace in the text of templates when parsing them.
     """
     super().__init__()
     self.template_dir = path
     self.dictoutput = dictoutput
     self.tags = {}
-    self.requesttags = {}
+    self.tags_version = 0
+    self._local = threading.local()
     self.astvisitor = AstVisitor(EVALWHITELIST)
     self.templateEncoding = templateEncoding
+    self.reload = None
+    self.reload_interval = None
+    self._modified = set()
+    self._watcher = None
+    self._included_by = {}
+    self._files = {}
+    self.cache_dir = cache_dir
+    self.minify = minify
+    self.fragment_cache = (FragmentCache() if fragment_cache is None
+                           else fragment_cache)
+    self.fragment_hits = 0
+    self.fragment_misses = 0
+    self.profiler = None
+    self.SetReloadPolicy(reload, reload_interval)
     for template in templates:
       self.AddTemplate(template)
 
+  @property
+  def requesttags(self):
+    """Returns the tags registered for the current request.
+
+    Every thread has its own request tags, so concurrent requests that share
+    the parser never see each other's tags or memoized JITTag results.
+    """
+    try:
+      return self._local.requesttags
+    except AttributeError:
+      self._local.requesttags = TemplateScope(self.tags)
+      return self._local.requesttags
+
   def __getitem__(self, template):
     """Retrieves a stored template by name.
 
@@ -188,9 +337,22 @@ class Parser(dict):
       Template: A template object, created from a previously loaded file.
     """
     if template not in self:
-      self.AddTemplate(template)
+      shared = self._files.get(os.path.realpath(self._TemplatePath(template)))
+      if shared is None:
+        self.AddTemplate(template)
+      else:
+        self[template] = shared
     return super().__getitem__(template)
 
+  def _TemplatePath(self, location):
+    """Returns the path of the template file, resolved in the template dir."""
+    if self.template_dir:
+      template_path = os.path.realpath(os.path.join(self.template_dir, location))
+      if os.path.commonprefix((template_path, self.template_dir)) != self.template_dir:
+        raise TemplateReadError('Could not load template %r, not in template dir' % template_path)
+      return template_path
+    return location
+
   def AddTemplate(self, location, name=None):
     """Reads the given `template` filename and adds it to the cache.
 
@@ -208,16 +370,193 @@ class Parser(dict):
     Raises:
       TemplateReadError: When the template file cannot be read
     """
-    if self.template_dir:
-      template_path = os.path.realpath(os.path.join(self.template_dir, location))
-      if os.path.commonprefix((template_path, self.template_dir)) != self.template_dir:
-        raise TemplateReadError('Could not load template %r, not in template dir' % template_path)
-    else:
-      template_path = location
+    template_path = self._TemplatePath(location)
+    replaced = super().get(name or location)
+    cache_key = self._CacheKey(template_path)
+    template = self._LoadCached(*cache_key)
+    if template is None:
+      try:
+        template = FileTemplate(template_path, parser=self, encoding=None)
+      except IOError:
+        raise TemplateReadError('Could not load template %r' % template_path)
+      self._StoreCached(template, *cache_key)
+    self[name or location] = template
+    self._files[os.path.realpath(template_path)] = template
+    if isinstance(replaced, FileTemplate):
+      # Other names for the replaced template now refer to the new one.
+      for key, cached in list(self.items()):
+        if cached is replaced:
+          self[key] = template
+      self.TemplateChanged(replaced._file_name)
+
+  def _CacheKey(self, template_path):
+    """Returns the cache file name and the key the stored template must match.
+
+    The key is taken before the template file is read, so a change during the
+    parsing of the file results in a key that doesn't match the new file.
+    """
+    if self.cache_dir is None:
+      return None, None
+    file_name = os.path.abspath(template_path)
+    try:
+      stat = os.stat(file_name)
+    except OSError:
+      return None, None
+    cache_name = hashlib.sha256(file_name.encode('utf-8')).hexdigest()
+    return (os.path.join(self.cache_dir, cache_name + '.pickle'),
+            (self.CACHE_VERSION, file_name, stat.st_mtime_ns, stat.st_size,
+             self.minify, self.templateEncoding))
+
+  def _LoadCached(self, cache_name, key):
+    """Returns the parsed template from the cache dir, if it is up to date.
+
+    Templates inlined by the cached template are not part of the cache file,
+    they are retrieved from the parser (and possibly its cache) by file name.
+    """
+    if cache_name is None:
+      return None
+    try:
+      with open(cache_name, 'rb') as cache_file:
+        unpickler = pickle.Unpickler(cache_file)
+        unpickler.persistent_load = lambda pid: self._CachedReference(pid, key[1])
+        if unpickler.load() != key:
+          return None
+        template = unpickler.load()
+    except Exception:
+      # Missing, outdated or broken cache files are ignored, and overwritten.
+      return None
+    template._file_checked = time.time()
+    return template
+
+  def _CachedReference(self, pid, file_name):
+    """Returns the parser object for a reference in a template cache file."""
+    kind, value = pid
+    if kind == 'parser':
+      return self
+    if kind == 'astvisitor':
+      return self.astvisitor
+    included = self[value]
+    self.AddInclude(file_name, included._file_name)
+    return included
+
+  def _StoreCached(self, template, cache_name, key):
+    """Writes the parsed template to the cache dir, when one is configured."""
+    if cache_name is None:
+      return
+    def Reference(obj):
+      if obj is self:
+        return 'parser', None
+      if obj is self.astvisitor:
+        return 'astvisitor', None
+      if isinstance(obj, FileTemplate) and obj is not template:
+        return 'template', obj._file_name
+      return None
+
     try:
-      self[name or location] = FileTemplate(template_path, parser=self, encoding=None)
-    except IOError:
-      raise TemplateReadError('Could not load template %r' % template_path)
+      os.makedirs(self.cache_dir, exist_ok=True)
+      with tempfile.NamedTemporaryFile(
+          'wb', dir=self.cache_dir, delete=False) as cache_file:
+        pickler = pickle.Pickler(cache_file, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = Reference
+        pickler.dump(key)
+        pickler.dump(template)
+      os.replace(cache_file.name, cache_name)
+    except Exception:
+      # Templates that can't be stored are simply parsed again next time.
+      try:
+        os.unlink(cache_file.name)
+      except (NameError, OSError):
+        pass
+
+  def Prewarm(self, compile=False):
+    """Loads all templates in the template dir, storing them in the cache dir.
+
+    Files matching PREWARM_IGNORED are skipped, as are files that can't be
+    decoded as text, like images. These are not templates, nor failures.
+
+    Arguments:
+      % compile: bool ~~ False
+        Whether the templates should also be compiled after loading them.
+
+    Returns:
+      2-tuple: the list of names of all loaded templates, and a dictionary with
+      the names of the files that could not be loaded, and their errors.
+    """
+    names = []
+    failures = {}
+    cache_dir = self.cache_dir and os.path.abspath(self.cache_dir)
+    ignored = lambda name: any(fnmatch.fnmatch(name, pattern)
+                               for pattern in self.PREWARM_IGNORED)
+    for dirpath, dirnames, filenames in os.walk(self.template_dir or '.'):
+      dirnames[:] = [dirname for dirname in dirnames if not ignored(dirname) and
+                     os.path.abspath(os.path.join(dirpath, dirname)) != cache_dir]
+      for filename in filenames:
+        if ignored(filename):
+          continue
+        name = os.path.relpath(os.path.join(dirpath, filename),
+                               self.template_dir or '.')
+        try:
+          template = self[name]
+          if compile:
+            template.Compile()
+          names.append(name)
+        except UnicodeDecodeError:
+          continue
+        except Exception as error:
+          # Malformed template constructs don't always raise a template Error.
+          failures[name] = error
+    return names, failures
+
+  def AddInclude(self, parent, included):
+    """Records that the template file `parent` inlines the file `included`."""
+    self._included_by.setdefault(included, set()).add(parent)
+
+  def ClearIncludes(self, parent):
+    """Forgets all files inlined by the template file `parent`."""
+    for parents in self._included_by.values():
+      parents.discard(parent)
+
+  def TemplateChanged(self, file_name):
+    """Marks all templates that inline the given template file as stale.
+
+    Templates that inline the file, directly or through other templates, are
+    rebuilt from their own file the next time they are parsed. This way they
+    pick up the changed (or replaced) template, while all others are left alone.
+
+    The cached fragments are cleared, as they may be the output of the template.
+    """
+    self.fragment_cache.Clear()
+    stale = set()
+    changed = [file_name]
+    while changed:
+      for parent in self._included_by.get(changed.pop(), ()):
+        if parent not in stale:
+          stale.add(parent)
+          changed.append(parent)
+    if stale:
+      for template in list(self.values()):
+        if isinstance(template, FileTemplate) and template._file_name in stale:
+          template._stale = True
+
+  def CachedFragment(self, key, ttl, render):
+    """Returns the cached fragment for `key`, rendering and storing it if absent.
+
+    Arguments:
+      @ key: str
+        The key of the fragment in the fragment cache.
+      @ ttl: float
+        Seconds the fragment is kept in the cache, None keeps it until evicted.
+      @ render: function
+        Called without arguments to render the fragment if it isn't cached.
+    """
+    fragment = self.fragment_cache.Get(key)
+    if fragment is None:
+      self.fragment_misses += 1
+      fragment = render()
+      self.fragment_cache.Set(key, fragment, ttl)
+    else:
+      self.fragment_hits += 1
+    return fragment
 
   def Parse(self, template, **replacements):
     """Returns the referenced template with its tags replaced by **replacements.
@@ -234,11 +573,49 @@ class Parser(dict):
     Returns:
       str: The template with relevant tags replaced by the replacement dict.
     """
-    output = {}
-    output.update(self.tags)
-    output.update(self.requesttags)
-    output.update(replacements)
-    return self[template].Parse(**output)
+    return self[template].ParseScope(TemplateScope(self.requesttags, replacements))
+
+  def ParseBytes(self, template, replacements, encoding='utf-8'):
+    """Returns the referenced template as a list of encoded chunks.
+
+    This is Parse() for output that is sent out as bytes, see
+    Template.RenderBytes. Only the values of the tags are encoded while parsing.
+
+    Arguments:
+      @ template: str
+        Template name, or the relative path to find it on.
+      @ replacements: dict
+        Dictionary of replacement objects. Tags are looked up in here.
+      % encoding: str ~~ 'utf-8'
+        The encoding of the output.
+
+    Returns:
+      list of bytes: The template with relevant tags replaced.
+    """
+    return self[template].RenderBytes(
+        TemplateScope(self.requesttags, replacements), encoding)
+
+  def Stream(self, template, replacements, encoding='utf-8'):
+    """Returns an iterator of encoded chunks for the referenced template.
+
+    This is Parse() for large outputs, which are yielded in parts while they are
+    rendered, see Template.Stream. The template is loaded and the request tags
+    are looked up right away, so they remain available while the output is
+    consumed, also after ClearRequestTags().
+
+    Arguments:
+      @ template: str
+        Template name, or the relative path to find it on.
+      @ replacements: dict
+        Dictionary of replacement objects. Tags are looked up in here.
+      % encoding: str ~~ 'utf-8'
+        The encoding of the output.
+
+    Returns:
+      iterator of bytes: The template with relevant tags replaced.
+    """
+    return self[template].Stream(
+        TemplateScope(self.requesttags, replacements), encoding)
 
   def ParseString(self, template, **replacements):
     """Returns the given `template` with its tags replaced by **replacements.
@@ -253,11 +630,8 @@ class Parser(dict):
     Returns:
       str: template with replaced tags.
     """
-    output = {}
-    output.update(self.tags)
-    output.update(self.requesttags)
-    output.update(replacements)
-    return Template(template, parser=self).Parse(**output)
+    return Template(template, parser=self).ParseScope(
+        TemplateScope(self.requesttags, replacements))
 
   @staticmethod
   def RegisterFunction(name, function):
@@ -270,6 +644,7 @@ class Parser(dict):
         The function that should be used. Ideally this returns a string.
     """
     TAG_FUNCTIONS[name] = function
+    TemplateTag.FUNCTIONS_VERSION += 1
 
   def RegisterTag(self, tag, value, persistent=False):
     """Registers a `value`, allowing use in templates by `tag`.
@@ -283,6 +658,9 @@ class Parser(dict):
         will this tag be present for multiple requests?
     """
     storage = self.tags if persistent else self.requesttags
+    if persistent and (':' in tag or self.tags.get(tag, MISSING) is not value):
+      # Compiled templates fold the persistent tags, and need to be recompiled.
+      self.tags_version += 1
     if ':' not in tag:
       storage[tag] = value
       return
@@ -290,7 +668,6 @@ class Parser(dict):
     # if we are dealing with a tag consisting of multiple path parts, lets reconstruct the path
     obj = storage
     prevnode = tag.name
-    d = storage
     for node in tag.indices:
       try:
         node = int(node)
@@ -298,8 +675,13 @@ class Parser(dict):
       except ValueError:
         subtype = {}
 
-      # add the new sublist to the path if not existant
-      if prevnode not in obj:
+      # add the new sublist to the path if not existant, request tags never
+      # extend the persistent tags that are looked up below them.
+      if obj is storage:
+        exists = dict.__contains__(storage, prevnode)
+      else:
+        exists = prevnode in obj
+      if not exists:
         obj[prevnode] = subtype
 
       obj = obj[prevnode]
@@ -307,19 +689,155 @@ class Parser(dict):
     obj[node] = value
 
   @classmethod
-  def JITTag(cls, function):
+  def JITTag(cls, function, memoize=None):
     """Creates a JITTag instance of the given function
 
     Arguments:
       % function: reference
         Reference to the function
+      % memoize: str ~~ None
+        How long the result of the function is reused, see JITTag. By default
+        it is not reused, as existing JITTags may depend on loop aliases. Pass
+        'request' or 'render' to call the function only once.
     """
-    return JITTag(function)
+    return JITTag(function, memoize=memoize)
 
   def ClearRequestTags(self):
     """Resets the non persistent tags to None, is to be called after each
-    completed request"""
-    self.requesttags = {}
+    completed request. This also discards JITTag results memoized for the
+    request."""
+    self._local.requesttags = TemplateScope(self.tags)
+
+  def SetProfiling(self, enabled=True):
+    """Enables or disables the profiling of template rendering.
+
+    While enabled, templates are not rendered by their compiled functions but
+    by the TemplateProfiler in the `profiler` attribute. This records the time
+    spent on templates, loops, conditional branches, JITTags and tag functions.
+    Enabling it again starts a new profile.
+    """
+    self.profiler = TemplateProfiler() if enabled else None
+
+  def SetReloadPolicy(self, policy='always', interval=1):
+    """Sets when the templates are checked for modifications on disk.
+
+    The available policies are:
+      * always: The template file is checked every time it is parsed.
+      * interval: The file is checked when parsed, at most once per interval.
+      * watch: A background thread checks all files once per interval, the
+               templates that changed are reloaded when next parsed.
+      * never: Templates are never reloaded, this is best for production.
+
+    Arguments:
+      % policy: str ~~ 'always'
+        One of the policies listed above.
+      % interval: float ~~ 1
+        Number of seconds between checks for the interval and watch policies.
+
+    Raises:
+      ValueError: The policy is not one of the RELOAD_POLICIES.
+    """
+    if policy not in self.RELOAD_POLICIES:
+      raise ValueError('Reload policy should be one of %s, not %r' % (
+          ', '.join(self.RELOAD_POLICIES), policy))
+    if self._watcher is not None:
+      self._watcher.Stop()
+      self._watcher = None
+    self.reload = policy
+    self.reload_interval = float(interval)
+    self._modified.clear()
+    if policy == 'watch':
+      self._watcher = TemplateWatcher(self, self.reload_interval)
+
+  def ReloadDue(self, template):
+    """Returns whether the FileTemplate should check its file for changes now."""
+    if self.reload == 'always':
+      return True
+    if self.reload == 'never':
+      return False
+    if self.reload == 'watch':
+      if self._watcher.pid != os.getpid():
+        self._watcher.Start()
+      try:
+        self._modified.remove(template._file_name)
+        return True
+      except KeyError:
+        return False
+    now = time.time()
+    if now - template._file_checked < self.reload_interval:
+      return False
+    template._file_checked = now
+    return True
+
+  def Stats(self):
+    """Returns statistics about the templates in the parser cache.
+
+    Every template file is loaded once, and inlined by reference into all the
+    templates that use it. The memory sizes are approximations that add up the
+    `sys.getsizeof` of all template nodes.
+
+    Returns:
+      dict: with the following keys:
+        templates: number of names in the cache
+        files: number of distinct template files loaded
+        inlined: dict of inlined template file names, and their reference count
+        nodes: number of template nodes, counting shared templates once
+        size: memory used by these template nodes
+        saved: memory that would be used by copies of all inlined templates
+        fragments: dict with the hits and misses of the fragment cache
+    """
+    templates = {id(template): template for template in self.values()}
+    trees = {key: self._TemplateNodes(template)
+             for key, template in templates.items()}
+    inlined = {}
+    for _nodes, _size, children in trees.values():
+      for child in children:
+        if isinstance(child, FileTemplate):
+          inlined[child._file_name] = inlined.get(child._file_name, 0) + 1
+
+    def ExpandedSize(template):
+      _nodes, size, children = trees.get(id(template)) or self._TemplateNodes(template)
+      return size + sum(map(ExpandedSize, children))
+
+    size = sum(size for _nodes, size, _children in trees.values())
+    return {'templates': len(self),
+            'files': len(templates),
+            'inlined': inlined,
+            'nodes': sum(nodes for nodes, _size, _children in trees.values()),
+            'size': size,
+            'saved': sum(map(ExpandedSize, templates.values())) - size,
+            'fragments': {'hits': self.fragment_hits,
+                          'misses': self.fragment_misses}}
+
+  @staticmethod
+  def _TemplateNodes(template):
+    """Returns the number of nodes and their size, and the inlined templates."""
+    count = 0
+    size = 0
+    inlined = []
+    nodes = [template]
+    while nodes:
+      node = nodes.pop()
+      if isinstance(node, Template) and node is not template:
+        inlined.append(node)
+        continue
+      count += 1
+      size += sys.getsizeof(node)
+      if hasattr(node, '__dict__'):
+        size += sys.getsizeof(node.__dict__)
+      if isinstance(node, (Template, TemplateLoop)):
+        nodes.extend(node)
+      elif isinstance(node, TemplateCachedBlock):
+        nodes.extend(node.key)
+        nodes.extend(node)
+      elif isinstance(node, TemplateConditional):
+        for expr, branch in node.branches:
+          nodes.extend(expr)
+          nodes.extend(branch)
+        nodes.extend(node.default or ())
+      elif isinstance(node, TemplateComment):
+        nodes.extend(node.default)
+    return count, size, inlined
 
   def SetTemplateEncoding(self, templateEncoding='utf-8'):
     """Allows the user to set the templateEncoding for this parser instance's
@@ -339,13 +857,22 @@ class Parser(dict):
 
     Arguments:
       % evalwhitelist: Dict ~~ None
-        The new Dict of whitelisted eval AST items.
+        The new Dict of whitelisted eval AST items, None restores the default.
       % append: bool ~~ False
         When true, add the new items to the current list, else overwrite.
     """
-    if append:
-      evalwhitelist = EVALWHITELIST.update(evalwhitelist)
-    self.astvisitor = AstVisitor(evalwhitelist)
+    if evalwhitelist is None:
+      evalwhitelist = EVALWHITELIST
+    elif append:
+      current = self.astvisitor.whitelists
+      evalwhitelist = {
+          'functions': {**current['functions'],
+                        **evalwhitelist.get('functions', {})},
+          'operators': (tuple(current['operators']) +
+                        tuple(evalwhitelist.get('operators', ())))}
+    # Templates share the parser's visitor, replacing its whitelists invalidates
+    # the cached code of their conditional expressions.
+    self.astvisitor.whitelists = evalwhitelist
 
   TemplateReadError = TemplateReadError
 
@@ -363,6 +890,15 @@ class Template(list):
       \])                         # end of tag""",
       re.VERBOSE)
 
+  # Number of interpreted parses before the template is compiled, None disables.
+  COMPILE_AFTER = 1
+  # Minimum size in bytes of the chunks yielded by Stream(), except the last.
+  STREAM_CHUNK_SIZE = 16384
+  # Elements in which Minify() leaves the whitespace as it is.
+  PRESERVE_WHITESPACE = re.compile(
+      r'<(/?)(pre|textarea|script)\b[^>]*>', re.IGNORECASE)
+  WHITESPACE = re.compile(r'\s+')
+
   def __init__(self, raw_template, parser=None, dictoutput=False):
     """Initializes a Template from a string.
 
@@ -382,6 +918,11 @@ class Template(list):
     self.parser = parser
     self.dictoutput = dictoutput
     self.scopes = [self]
+    self._compiled = None
+    self._compiled_whitelists = ()
+    self._compiled_version = None
+    self._interpreted = 0
+    self._encoded = {}
     self.AddString(raw_template)
     self.name = None
 
@@ -393,6 +934,16 @@ class Template(list):
     """
     return isinstance(other, Template) and str(other) == str(self)
 
+  def __getstate__(self):
+    """Returns the state for pickling, without the compiled render function."""
+    state = self.__dict__.copy()
+    state['_compiled'] = None
+    state['_compiled_whitelists'] = ()
+    state['_compiled_version'] = None
+    state['_interpreted'] = 0
+    state['_encoded'] = {}
+    return state
+
   def __mod__(self, kwds):
     """Syntactic sugar that enables percent-sign template parsing.
 
@@ -419,7 +970,13 @@ class Template(list):
     self.name = name
     if self.parser is None:
       raise TypeError('The template requires parser for adding template files.')
-    return self._AddToOpenScope(self.parser[name])
+    self._compiled = None
+    self._compiled_whitelists = ()
+    self._compiled_version = None
+    template = self.parser[name]
+    if isinstance(self, FileTemplate) and isinstance(template, FileTemplate):
+      self.parser.AddInclude(self._file_name, template._file_name)
+    return self._AddToOpenScope(template)
 
   def AddString(self, raw_template, filename=None):
     """Extends the Template by adding a raw template string.
@@ -429,24 +986,81 @@ class Template(list):
     Raises:
       TemplateSyntaxError: Unbalanced number of scopes in added template.
     """
+    self._compiled = None
+    self._compiled_whitelists = ()
+    self._compiled_version = None
     scope_depth = len(self.scopes)
+    minify = self.parser is not None and self.parser.minify
+    preserved = None
     nodes = self.FUNCTION.split(raw_template)
     for index, node in enumerate(nodes):
       if index % 2:
         self._ExtendFunction(node)
       else:
-        self._ExtendText(node)
+        preserved = self._ExtendText(node, minify, preserved)
     if len(self.scopes) != scope_depth:
       scope_diff = len(self.scopes) - scope_depth
       if scope_diff < 0:
         raise TemplateSyntaxError('Closed %d scopes too many in "%s"' % (abs(scope_diff), filename or raw_template))
       raise TemplateSyntaxError('TemplateString left %d open scopes in "%s"' % (scope_diff, filename or raw_template))
 
+  @classmethod
+  def Minify(cls, text, preserved=None):
+    """Returns the text with its whitespace collapsed, and the open element.
+
+    Whitespace that includes a line break is replaced by a single line break,
+    other whitespace by a single space. Inside <pre>, <textarea> and <script>
+    elements the text is left as it is.
+
+    Arguments:
+      @ text: str
+        Literal text of the template, between its tags and {{ }} functions.
+      % preserved: str ~~ None
+        Name of the element that preserves whitespace that the text starts in,
+        as returned for the preceding text.
+
+    Returns:
+      tuple: the minified text, and the name of the element that preserves
+      whitespace that is still open at the end of the text, or None.
+    """
+    output = []
+    position = 0
+    for match in cls.PRESERVE_WHITESPACE.finditer(text):
+      closing, name = match.group(1), match.group(2).lower()
+      if preserved is None and not closing:
+        output.append(cls._CollapseWhitespace(text[position:match.start()]))
+        output.append(match.group())
+        position = match.end()
+        preserved = name
+      elif preserved == name and closing:
+        output.append(text[position:match.end()])
+        position = match.end()
+        preserved = None
+    if preserved is None:
+      output.append(cls._CollapseWhitespace(text[position:]))
+    else:
+      output.append(text[position:])
+    return ''.join(output), preserved
+
+  @classmethod
+  def _CollapseWhitespace(cls, text):
+    """Replaces runs of whitespace by a line break or a single space."""
+    return cls.WHITESPACE.sub(
+        lambda match: '\n' if '\n' in match.group() else ' ', text)
+
   def Parse(self, **kwds):
     """Returns the parsed template as HTMLsafestring.
 
     The template is parsed by parsing each of its members and combining that.
     """
+    return self.ParseScope(TemplateScope({}, kwds))
+
+  def ParseScope(self, scope):
+    """Returns the parsed template as HTMLsafestring, using the mapping `scope`.
+
+    This is Parse() for replacements that are already in a mapping, such as the
+    TemplateScope with the registered tags that the Parser provides.
+    """
     dictoutput = self.parser and self.parser.dictoutput or self.dictoutput
     if dictoutput:
       output = {'tags': {}}
@@ -459,11 +1073,157 @@ class Template(list):
           for flattend_branch in list(itertools.chain(*tag.branches)):
             for branch_tag in flattend_branch:
               if isinstance(branch_tag, TemplateTag):
-                output['tags'][str(branch_tag)] = branch_tag.Parse(**kwds)
+                output['tags'][str(branch_tag)] = branch_tag.Render(scope)
         if isinstance(tag, TemplateTag):
-          output['tags'][str(tag)] = tag.Parse(**kwds)
+          output['tags'][str(tag)] = tag.Render(scope)
       return output
-    return HTMLsafestring('').join(HTMLsafestring(tag.Parse(**kwds)) for tag in self)
+    return HTMLsafestring(self.Render(scope))
+
+  def Render(self, scope):
+    """Returns the parsed template as string, using the replacements `scope`.
+
+    Unlike Parse, all nodes are given the same replacements mapping, which is
+    never copied. Nested parts of the template use a TemplateScope on top.
+    """
+    profiler = self._Profiler()
+    if profiler is not None:
+      return profiler.RenderTemplate(self, scope)
+    renderer = self._Renderer()
+    if renderer:
+      return ''.join(renderer(scope))
+    return ''.join(node.Render(scope) for node in self)
+
+  def RenderBytes(self, scope, encoding='utf-8'):
+    """Returns the parsed template as a list of encoded chunks, using `scope`.
+
+    The literal text of the template is encoded when the template is parsed,
+    only the values of the tags are encoded while rendering. The chunks are
+    never joined, they can be sent out as they are.
+
+    Arguments:
+      @ scope: mapping
+        The replacements to parse the template with.
+      % encoding: str ~~ 'utf-8'
+        The encoding of the returned bytes.
+    """
+    renderer = self._EncodedRenderer(encoding)
+    if renderer:
+      return renderer(scope)
+    return list(self._EncodeNodes(scope, encoding))
+
+  def Stream(self, scope, encoding='utf-8'):
+    """Yields the parsed template as encoded chunks, using the mapping `scope`.
+
+    Unlike Render, the output is never built in memory as a whole. The pieces
+    are encoded as they are rendered, and yielded in chunks of at least
+    STREAM_CHUNK_SIZE bytes. Compiled templates use a generator version of
+    their render function, in which the literal text is encoded only once.
+
+    Arguments:
+      @ scope: mapping
+        The replacements to parse the template with.
+      % encoding: str ~~ 'utf-8'
+        The encoding of the yielded bytes.
+    """
+    renderer = self._EncodedRenderer(encoding, stream=True)
+    chunk = []
+    size = 0
+    pieces = renderer(scope) if renderer else self._EncodeNodes(scope, encoding)
+    for piece in pieces:
+      chunk.append(piece)
+      size += len(piece)
+      if size >= self.STREAM_CHUNK_SIZE:
+        yield b''.join(chunk)
+        chunk = []
+        size = 0
+    if chunk:
+      yield b''.join(chunk)
+
+  def _EncodedRenderer(self, encoding, stream=False):
+    """Returns the compiled render function that outputs bytes, if there is one.
+
+    These are compiled alongside the render function of the template, for each
+    `encoding` that the template is rendered in. With `stream` set, the render
+    function is a generator.
+    """
+    if self._Profiler() is not None or not self._Renderer():
+      return None
+    key = encoding, stream
+    if key not in self._encoded:
+      try:
+        self._encoded[key] = TemplateCompiler(self, encoding, stream).Compile()
+      except (SyntaxError, RecursionError):
+        self._encoded[key] = None
+    return self._encoded[key]
+
+  def _EncodeNodes(self, scope, encoding):
+    """Yields the encoded output of the template, walking its node tree.
+
+    Literal text is yielded as it was encoded when parsing the template. Loops
+    on the top level of the template yield the output of every item separately.
+    """
+    if self._Profiler() is not None:
+      yield self.Render(scope).encode(encoding)
+      return
+    for node in self:
+      if isinstance(node, TemplateText):
+        yield node.Encode(encoding)
+      elif isinstance(node, TemplateLoop):
+        for output in node.RenderItems(scope):
+          yield output.encode(encoding)
+      else:
+        yield node.Render(scope).encode(encoding)
+
+  def Compile(self):
+    """Compiles the template into a Python function, used for all later parsing.
+
+    Templates that cannot be compiled (for instance because their nesting is too
+    deep for Python) keep being parsed by walking their node tree.
+
+    Returns:
+      function: the render function, or None if the template can't be compiled.
+    """
+    compiler = TemplateCompiler(self)
+    self._encoded = {}
+    try:
+      compiled = compiler.Compile()
+    except (SyntaxError, RecursionError):
+      compiled = False
+    self._compiled_whitelists = tuple(compiler.whitelists.values())
+    self._compiled_version = self._FoldVersion()
+    # Published last, other threads may render the template meanwhile.
+    self._compiled = compiled
+    return compiled or None
+
+  def _Profiler(self):
+    """Returns the TemplateProfiler of the parser, if profiling is enabled."""
+    return self.parser.profiler if self.parser is not None else None
+
+  def _FoldVersion(self):
+    """Returns the versions of the persistent tags and tag functions, which the
+    compiled template depends on as they are folded into its text."""
+    tags_version = self.parser.tags_version if self.parser is not None else 0
+    return tags_version, TemplateTag.FUNCTIONS_VERSION
+
+  def _Renderer(self):
+    """Returns the compiled render function for the template, if there is one.
+
+    Templates are compiled after they have been interpreted COMPILE_AFTER times,
+    which avoids paying the compile cost for one-off templates.
+    """
+    if self._compiled is None and self.COMPILE_AFTER is not None:
+      if self._interpreted >= self.COMPILE_AFTER:
+        return self.Compile()
+      self._interpreted += 1
+    elif self._compiled:
+      for visitor, whitelists in self._compiled_whitelists:
+        if visitor.whitelists is not whitelists:
+          # The eval whitelist was changed after compiling the template.
+          return self.Compile()
+      if self._compiled_version != self._FoldVersion():
+        # Persistent tags or tag functions were registered after compiling.
+        return self.Compile()
+    return self._compiled
 
   @classmethod
   def TagSplit(cls, template):
@@ -494,10 +1254,19 @@ class Template(list):
         (function,
          ' in template "%s"' % self._template_path if self._template_path else ''))
 
-  def _ExtendText(self, node):
-    """Processes a text node and adds its tags and texts to the Template."""
+  def _ExtendText(self, node, minify=False, preserved=None):
+    """Processes a text node and adds its tags and texts to the Template.
+
+    With `minify`, the whitespace of the texts is collapsed, that of the tags is
+    left as it is. Returns the element preserving whitespace that is still open
+    at the end of the node, see Minify.
+    """
     for node in self.TagSplit(node):
+      if minify and isinstance(node, TemplateText):
+        text, preserved = self.Minify(node, preserved)
+        node = TemplateText(text)
       self._AddToOpenScope(node)
+    return preserved
 
   # ############################################################################
   # Template syntax constructs
@@ -515,9 +1284,19 @@ class Template(list):
     """Processing for {{ endfor }} template syntax."""
     self._CloseScope(TemplateLoop)
 
+  def _TemplateConstructCache(self, *nodes):
+    """Processing for {{ cache }} template syntax."""
+    if not 1 <= len(nodes) <= 2:
+      raise TemplateSyntaxError('{{ cache }} requires a key and optional ttl')
+    self._StartScope(TemplateCachedBlock(self.parser, *nodes))
+
+  def _TemplateConstructEndcache(self):
+    """Processing for {{ endcache }} template syntax."""
+    self._CloseScope(TemplateCachedBlock)
+
   def _TemplateConstructComment(self, *nodes):
     self._StartScope(TemplateComment(' '.join(nodes),
-        self.parser.astvisitor if self.parser else AstVisitor(EVALWHITELIST)))
+        self._AstVisitor()))
 
   def _TemplateConstructEndcomment(self):
     self._CloseScope(TemplateComment)
@@ -525,17 +1304,17 @@ class Template(list):
   def _TemplateConstructIf(self, *nodes):
     """Processing for {{ if }} template syntax."""
     self._StartScope(TemplateConditional(' '.join(nodes),
-        self.parser.astvisitor if self.parser else AstVisitor(EVALWHITELIST)))
+        self._AstVisitor()))
 
   def _TemplateConstructIfpresent(self, *nodes):
     """Processing for {{ ifpresent }} template syntax."""
     self._StartScope(TemplateConditionalPresence(' '.join(nodes),
-        self.parser.astvisitor if self.parser else AstVisitor(EVALWHITELIST)))
+        self._AstVisitor()))
 
   def _TemplateConstructIfnotpresent(self, *nodes):
     """Processing for {{ ifnotpresent }} template syntax."""
     self._StartScope(TemplateConditionalNotPresence(' '.join(nodes),
-        self.parser.astvisitor if self.parser else AstVisitor(EVALWHITELIST)))
+        self._AstVisitor()))
 
   def _TemplateConstructElif(self, *nodes):
     """Processing for {{ elif }} template syntax."""
@@ -551,6 +1330,12 @@ class Template(list):
     """Processing for {{ endif }} template syntax."""
     self._CloseScope(TemplateConditional)
 
+  def _AstVisitor(self):
+    """Returns the AstVisitor of the parser, which validates expressions."""
+    if self.parser is not None:
+      return self.parser.astvisitor
+    return AstVisitor(EVALWHITELIST)
+
   # ############################################################################
   # Methods for scope management
   #
@@ -599,10 +1384,12 @@ class FileTemplate(Template):
     """
     self._template_path = template_path
     self.parser = parser
-    self.templateEncoding = encoding or (self.parser.templateEncoding if self.parser else 'utf-8')
+    self.templateEncoding = encoding or (self.parser.templateEncoding if self.parser is not None else 'utf-8')
     try:
       self._file_name = os.path.abspath(template_path)
       self._file_mtime = os.path.getmtime(self._file_name)
+      self._file_checked = time.time()
+      self._stale = False
       with open(self._file_name, encoding=self.templateEncoding) as templatefile:
         raw_template = templatefile.read()
         self._template_hash = HashContent(raw_template)
@@ -610,27 +1397,71 @@ class FileTemplate(Template):
     except (IOError, OSError) as error:
       raise TemplateReadError('Cannot open: %r %r' % (template_path, error))
 
-  def Parse(self, **kwds):
-    """Returns the parsed template as SafeString.
+  def ParseScope(self, scope):
+    """Returns the parsed template as SafeString, using the mapping `scope`.
 
     The template is parsed by parsing each of its members and combining that.
     """
-    self.ReloadIfModified()
-    try:
-      result = super().Parse(**kwds)
-    except TemplateFunctionError as error:
-      raise TemplateFunctionError('%s in %s' % (error, self._template_path))
     if self.parser and self.parser.dictoutput:
+      if self._stale or self.parser.ReloadDue(self):
+        self.ReloadIfModified()
+      try:
+        result = super().ParseScope(scope)
+      except TemplateFunctionError as error:
+        raise TemplateFunctionError('%s in %s' % (error, self._template_path))
       return {'template': self._template_path[len(self.parser.template_dir):],
               'replacements': result['tags'],
               'template_hash': self._template_hash}#,
               #              'content_hash': result.content_hash,
               #              'page_hash': result.page_hash}
-    return result
+    return super().ParseScope(scope)
+
+  def Render(self, scope):
+    """Returns the parsed template as string, using the replacements `scope`.
+
+    The template is reloaded first if the file was modified, this also applies
+    to FileTemplates that are inlined in other templates. How often the file is
+    checked is determined by the reload policy of the parser. Templates that
+    inline a changed template are always rebuilt.
+    """
+    if self._stale or self.parser is None or self.parser.ReloadDue(self):
+      self.ReloadIfModified()
+    try:
+      return super().Render(scope)
+    except TemplateFunctionError as error:
+      raise TemplateFunctionError('%s in %s' % (error, self._template_path))
+
+  def RenderBytes(self, scope, encoding='utf-8'):
+    """Returns the parsed template as a list of encoded chunks, using `scope`.
+
+    Like Render, this reloads the template first if the file was modified.
+    """
+    if self._stale or self.parser is None or self.parser.ReloadDue(self):
+      self.ReloadIfModified()
+    try:
+      return super().RenderBytes(scope, encoding)
+    except TemplateFunctionError as error:
+      raise TemplateFunctionError('%s in %s' % (error, self._template_path))
+
+  def Stream(self, scope, encoding='utf-8'):
+    """Yields the parsed template as encoded chunks, using the mapping `scope`.
+
+    Like Render, this reloads the template first if the file was modified.
+    """
+    if self._stale or self.parser is None or self.parser.ReloadDue(self):
+      self.ReloadIfModified()
+    try:
+      yield from super().Stream(scope, encoding)
+    except TemplateFunctionError as error:
+      raise TemplateFunctionError('%s in %s' % (error, self._template_path))
 
   def ReloadIfModified(self):
     """Reloads the template file if it was modified on disk.
 
+    Templates marked as stale by the parser, because a template they inline
+    changed, are reloaded as well. Afterwards, the parser is notified so the
+    templates inlining this one are marked as stale in turn.
+
     If the template is not present, cannot be read, or there is another error
     accessing the file, the operation is aborted and the old template is left
     in place.
@@ -640,19 +1471,268 @@ class FileTemplate(Template):
     """
     try:
       mtime = os.path.getmtime(self._file_name)
-      if mtime > self._file_mtime:
+      if mtime > self._file_mtime or self._stale:
         with open(self._file_name, encoding=self.templateEncoding) as templatefile:
           template = templatefile.read()
         del self[:]
         self.scopes = [self]
+        self._stale = False
+        if self.parser is not None:
+          self.parser.ClearIncludes(self._file_name)
         self.AddString(template, self._file_name)
         self._file_mtime = mtime
+        self._template_hash = HashContent(template)
+        if self.parser is not None:
+          self.parser.TemplateChanged(self._file_name)
     except (IOError, OSError):
       # File cannot be stat'd or read. No longer exists or we lack permissions.
       # We shouldn't error in this case, but carry on with the template we have.
       pass
 
 
+class TemplateWatcher:
+  """Watches the template files of a Parser for modifications.
+
+  A background thread checks the modification time of all FileTemplates in the
+  parser once per interval. Templates whose file changed are marked, so they
+  are reloaded by the thread rendering them, the next time they are parsed.
+
+  The watcher only holds a weak reference to the parser, the thread stops once
+  the parser is discarded, or when Stop is called.
+
+  Threads don't survive a fork, so a parser created before the server forks
+  its workers would not be watched in them. The parser therefore calls Start
+  when it is used, which starts the thread again in a forked process.
+  """
+  def __init__(self, parser, interval=1):
+    """Starts watching the templates of the given parser.
+
+    Arguments:
+      @ parser: Parser
+        The parser whose FileTemplates are watched.
+      % interval: float ~~ 1
+        Number of seconds between checks.
+    """
+    self._parser = weakref.ref(parser)
+    self.interval = interval
+    self.stopped = threading.Event()
+    self.pid = None
+    self.thread = None
+    self._lock = threading.Lock()
+    self.Start()
+
+  @property
+  def parser(self):
+    """The watched Parser, or None if it has been discarded."""
+    return self._parser()
+
+  def Check(self):
+    """Marks the templates in the parser whose file was modified.
+
+    Returns False if the parser has been discarded, True otherwise.
+    """
+    parser = self.parser
+    if parser is None:
+      return False
+    for template in list(parser.values()):
+      if not isinstance(template, FileTemplate):
+        continue
+      try:
+        if os.path.getmtime(template._file_name) > template._file_mtime:
+          parser._modified.add(template._file_name)
+      except (IOError, OSError):
+        pass
+    return True
+
+  def Run(self):
+    """Checks the templates once per interval, until the watcher is stopped."""
+    while not self.stopped.wait(self.interval):
+      if not self.Check():
+        self.Stop()
+
+  def Start(self):
+    """Starts the watcher thread, unless it runs in the current process."""
+    with self._lock:
+      if self.pid == os.getpid():
+        return
+      self.pid = os.getpid()
+      self.thread = threading.Thread(target=self.Run, daemon=True)
+      self.thread.start()
+
+  def Stop(self):
+    """Stops watching the templates."""
+    self.stopped.set()
+
+
+class FragmentCache:
+  """In-process LRU store for the output of {{ cache }} template blocks.
+
+  Fragments expire after the number of seconds they are stored for, and the
+  least recently used fragments are evicted when there are more than `maxsize`.
+  Any object with the same Get, Set and Clear methods can be given to the Parser
+  instead, to store the fragments elsewhere.
+  """
+  def __init__(self, maxsize=1024):
+    """Initializes an empty FragmentCache holding up to `maxsize` fragments."""
+    self.maxsize = maxsize
+    self._fragments = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._fragments)
+
+  def Get(self, key):
+    """Returns the fragment stored under `key`, or None if it's not available."""
+    with self._lock:
+      try:
+        expires, fragment = self._fragments[key]
+      except KeyError:
+        return None
+      if expires is not None and expires <= time.monotonic():
+        del self._fragments[key]
+        return None
+      self._fragments.move_to_end(key)
+      return fragment
+
+  def Set(self, key, fragment, ttl=None):
+    """Stores the `fragment` under `key`, for `ttl` seconds if that is given."""
+    expires = None if ttl is None else time.monotonic() + ttl
+    with self._lock:
+      self._fragments[key] = expires, fragment
+      self._fragments.move_to_end(key)
+      while len(self._fragments) > self.maxsize:
+        self._fragments.popitem(last=False)
+
+  def Clear(self):
+    """Removes all fragments from the cache."""
+    with self._lock:
+      self._fragments.clear()
+
+
+class TemplateProfiler:
+  """Records the time spent rendering templates and their parts.
+
+  Templates are rendered by walking their node tree, recording the number of
+  calls and the cumulative time for the following categories:
+    * templates: every template, including those that are inlined
+    * loops: every {{ for }} loop, for all of its items together
+    * branches: the branch taken by a conditional, including its evaluation
+    * jittags: the evaluation of JITTags, by tag name
+    * functions: the tag functions, including the default escaping function
+  The time of every part includes that of the parts nested in it.
+  """
+  CATEGORIES = 'templates', 'loops', 'branches', 'jittags', 'functions'
+
+  def __init__(self):
+    """Initializes a TemplateProfiler with no recorded data."""
+    self._lock = threading.Lock()
+    self._stats = {category: {} for category in self.CATEGORIES}
+
+  def Record(self, category, key, seconds):
+    """Adds a call that took `seconds` for `key` in the given `category`."""
+    with self._lock:
+      entry = self._stats[category].setdefault(key, [0, 0.0])
+      entry[0] += 1
+      entry[1] += seconds
+
+  def Reset(self):
+    """Removes all recorded data."""
+    with self._lock:
+      self._stats = {category: {} for category in self.CATEGORIES}
+
+  def Stats(self):
+    """Returns the recorded data as a dictionary.
+
+    Returns:
+      dict: for each of the CATEGORIES a dictionary, with for each key a dict
+      holding the number of `calls` and the cumulative `time` in seconds.
+    """
+    with self._lock:
+      return {category: {key: {'calls': calls, 'time': seconds}
+                         for key, (calls, seconds) in entries.items()}
+              for category, entries in self._stats.items()}
+
+  def HTMLTable(self):
+    """Returns the recorded data as an HTML table, slowest parts first."""
+    row = HTMLsafestring('<tr><td>{}</td><td>{}</td><td>{}</td>'
+                         '<td>{} ms</td></tr>')
+    rows = []
+    for category, entries in self.Stats().items():
+      for key, entry in sorted(entries.items(),
+                               key=lambda item: -item[1]['time']):
+        rows.append(HTMLsafestring(row.format(
+            category, key, entry['calls'], '%.3f' % (entry['time'] * 1000))))
+    return HTMLsafestring(HTMLsafestring(
+        '<table class="template-profile"><thead><tr><th>Category</th>'
+        '<th>Part</th><th>Calls</th><th>Time</th></tr></thead><tbody>{}'
+        '</tbody></table>').format(HTMLsafestring('').join(rows)))
+
+  def RenderTemplate(self, template, scope):
+    """Returns the rendered `template`, recording the time spent on it."""
+    name = (getattr(template, '_template_path', None) or template.name or
+            'string')
+    start = time.perf_counter()
+    try:
+      return self.RenderNodes(template, scope, name)
+    finally:
+      self.Record('templates', name, time.perf_counter() - start)
+
+  def RenderNodes(self, nodes, scope, name):
+    """Returns the rendered `nodes` of the template with the given `name`."""
+    return ''.join([self.RenderNode(node, scope, name) for node in nodes])
+
+  def RenderNode(self, node, scope, name):
+    """Returns a single rendered node, recording the time spent on it."""
+    if isinstance(node, TemplateTag):
+      return self.RenderTag(node, scope)
+    if isinstance(node, TemplateLoop):
+      start = time.perf_counter()
+      try:
+        return ''.join([self.RenderNodes(node, inner, name)
+                        for inner in node.Scopes(scope)])
+      finally:
+        self.Record('loops', '%s: {{ for %s in %s }}' % (
+            name, ', '.join(node.aliases), node.tag),
+            time.perf_counter() - start)
+    if isinstance(node, TemplateConditional):
+      start = time.perf_counter()
+      index, branch = node.Branch(scope)
+      try:
+        return self.RenderNodes(branch, scope, name)
+      finally:
+        self.Record('branches', '%s: %s' % (name, self.BranchName(node, index)),
+                    time.perf_counter() - start)
+    if isinstance(node, TemplateCachedBlock) and node.parser is not None:
+      return node.parser.CachedFragment(
+          node.Key(scope), node.ttl,
+          lambda: self.RenderNodes(node, scope, name))
+    return node.Render(scope)
+
+  def RenderTag(self, tag, scope):
+    """Returns the rendered tag, recording its JITTag and function calls."""
+    start = time.perf_counter()
+    try:
+      value = tag.GetValue(scope)
+    except (TemplateKeyError, TemplateNameError):
+      return str(tag)
+    if isinstance(scope.get(tag.name), JITTag):
+      self.Record('jittags', tag.name, time.perf_counter() - start)
+    return tag._ApplyFunctions(
+        value, lambda func, seconds: self.Record('functions', func, seconds))
+
+  @staticmethod
+  def BranchName(conditional, index):
+    """Returns the template syntax for the branch of the conditional."""
+    if index is None:
+      return '{{ else }}'
+    expr = conditional.branches[index][0]
+    if isinstance(conditional, TemplateConditionalPresence):
+      keyword = ('ifnotpresent' if isinstance(
+          conditional, TemplateConditionalNotPresence) else 'ifpresent')
+      return '{{ %s %s }}' % (keyword, ' '.join(map(str, expr)))
+    return '{{ %s %s }}' % ('elif' if index else 'if', ''.join(map(str, expr)))
+
+
 class TemplateComment(object):
   def __init__(self, expr, astvisitor):
     self.default = []
@@ -664,14 +1744,24 @@ class TemplateComment(object):
   def Parse(self, **kwds):
     return ''
 
+  def Render(self, _scope):
+    return ''
+
 
 class TemplateConditional(object):
   """A template construct to control flow based on the value of a tag."""
   def __init__(self, expr, astvisitor):
     self.branches = []
     self.default = None
-    self.NewBranch(expr)
     self.astvisitor = astvisitor
+    self._code = {}
+    self.NewBranch(expr)
+
+  def __getstate__(self):
+    """Returns the state for pickling, without the compiled expressions."""
+    state = self.__dict__.copy()
+    state['_code'] = {}
+    return state
 
   def __repr__(self):
     repr_branches = []
@@ -723,30 +1813,83 @@ class TemplateConditional(object):
       raise TemplateSyntaxError('Only one {{ else }} clause is allowed.')
     self.default = []
 
-  def Expression(self, expr, **kwds):
-    """Returns the evaluated result of a tag expression."""
-    nodes = []
-    local_vars = LazyTagValueRetrieval(kwds)
-    for num, node in enumerate(expr):
-      if isinstance(node, TemplateTag):
-        if node.functions:
-          nodes.append(node.Parse(**kwds))
-          continue
-        node_name = '__tmpl_var_%d' % num
+  def Expression(self, expr, scope=None, **kwds):
+    """Returns the evaluated result of a tag expression, using `scope`.
+
+    The code object for the expression is cached per eval whitelist, so it is
+    only validated and compiled again after the whitelist changes. Expressions
+    using tag functions include the parsed tag values in their source, these
+    are validated and compiled upon every evaluation.
+
+    For backward compatibility, the replacements may also be given as keyword
+    arguments instead of the `scope` mapping.
+    """
+    if scope is None:
+      scope = kwds
+    whitelists = self.astvisitor.whitelists
+    cached = self._code.get(expr)
+    if cached is None or cached[0] is not whitelists:
+      cached = self._code[expr] = self._CompileExpression(expr)
+    _whitelists, source, tags, code = cached
+    local_vars = LazyTagValueRetrieval(scope)
+    if source is None:
+      nodes = []
+      for num, node in enumerate(expr):
+        if isinstance(node, TemplateTag):
+          if node.functions:
+            nodes.append(node.Render(scope))
+            continue
+          node_name = '__tmpl_var_%d' % num
+          local_vars[node_name] = node
+          nodes.append(node_name)
+        else:
+          nodes.append(node)
+      source = ''.join(nodes)
+    else:
+      for node_name, node in tags:
         local_vars[node_name] = node
-        nodes.append(node_name)
-      else:
-        nodes.append(node)
     try:
-      return LimitedEval(''.join(nodes), self.astvisitor, local_vars)
+      if code is None:
+        return LimitedEval(source, self.astvisitor, local_vars)
+      if isinstance(code, Exception):
+        raise code.with_traceback(None)
+      return eval(code, whitelists['functions'], local_vars)
     except NameError as error:
       raise TemplateNameError(str(error).capitalize() + '. Try it as [tagname]?')
     except SyntaxError as error:
-      raise TemplateSyntaxError('%s while evaluating: %s' % (str(error).capitalize(), ''.join(nodes)))
+      raise TemplateSyntaxError('%s while evaluating: %s' % (str(error).capitalize(), source))
 
   def NewBranch(self, expr):
     """Begins a new branch based on the given expression."""
-    self.branches.append((tuple(Template.TagSplit(expr)), []))
+    expr = tuple(Template.TagSplit(expr))
+    self.branches.append((expr, []))
+    self._code[expr] = self._CompileExpression(expr)
+
+  def _CompileExpression(self, expr):
+    """Validates and compiles the expression for a branch.
+
+    Returns:
+      4-tuple: the eval whitelist used, the source of the expression, the tags
+      used in it, and the code object. The source and code are None if the
+      expression uses tag functions. If the expression is invalid, the error is
+      returned instead of the code, so it is raised when it is evaluated.
+    """
+    whitelists = self.astvisitor.whitelists
+    nodes = []
+    tags = []
+    for num, node in enumerate(expr):
+      if isinstance(node, TemplateTag):
+        if node.functions:
+          return whitelists, None, (), None
+        tags.append(('__tmpl_var_%d' % num, node))
+        nodes.append('__tmpl_var_%d' % num)
+      else:
+        nodes.append(node)
+    source = ''.join(nodes)
+    try:
+      return whitelists, source, tuple(tags), LimitedCompile(source, self.astvisitor)
+    except Exception as error:
+      return whitelists, source, tuple(tags), error
 
   def Parse(self, **kwds):
     """Returns the TemplateConditional parsed as string.
@@ -762,23 +1905,35 @@ class TemplateConditional(object):
     is True, the `else` branch is parsed and returned (where available, if no
     `else` branch exists '' is returned.
     """
-    for expr, branch in self.branches:
-      if self.Expression(expr, **kwds):
-        return ''.join(part.Parse(**kwds) for part in branch)
-    if self.default:
-      return ''.join(part.Parse(**kwds) for part in self.default)
-    return ''
+    return self.Render(kwds)
+
+  def Render(self, scope):
+    """Returns the TemplateConditional parsed as string, using `scope`."""
+    _index, branch = self.Branch(scope)
+    return ''.join(part.Render(scope) for part in branch)
+
+  def Branch(self, scope):
+    """Returns the index and nodes of the branch taken for `scope`.
+
+    The index is None for the else branch, or if no branch is taken at all.
+    """
+    for index, (expr, branch) in enumerate(self.branches):
+      if self.Expression(expr, scope):
+        return index, branch
+    return None, self.default or ()
 
 
 class TemplateConditionalPresence(TemplateConditional):
   """A template construct to safely check for the presence of tags."""
 
   @staticmethod
-  def Expression(tags, **kwds):
+  def Expression(tags, scope=None, **kwds):
     """Checks the presence of all tags named on the branch."""
+    if scope is None:
+      scope = kwds
     try:
       for tag in tags:
-        tag.GetValue(kwds)
+        tag.GetValue(scope)
       return True
     except (TemplateKeyError, TemplateNameError):
       return False
@@ -792,11 +1947,13 @@ class TemplateConditionalNotPresence(TemplateConditionalPresence):
   """A template construct to safely check for the presence of tags."""
 
   @staticmethod
-  def Expression(tags, **kwds):
+  def Expression(tags, scope=None, **kwds):
     """Checks the presence of all tags named on the branch."""
+    if scope is None:
+      scope = kwds
     try:
       for tag in tags:
-        tag.GetValue(kwds)
+        tag.GetValue(scope)
       return False
     except (TemplateKeyError, TemplateNameError):
       return True
@@ -841,22 +1998,105 @@ class TemplateLoop(list):
     iterable, all members of the TemplateLoop body will be parsed, with the
     item from the iterable added to the replacements dict as alias(es).
     """
-    output = []
-    replacements = kwds.copy()
-    for item in self.tag.Iterator(**kwds):
+    return self.Render(kwds)
+
+  def Render(self, scope):
+    """Returns the TemplateLoop parsed as string, using `scope`.
+
+    The alias(es) are set on a single TemplateScope on top of `scope`, which is
+    used to render the loop body for every item.
+    """
+    return ''.join(self.RenderItems(scope))
+
+  def RenderItems(self, scope):
+    """Yields the loop body parsed as string for each item, using `scope`."""
+    for inner in self.Scopes(scope):
+      yield ''.join(node.Render(inner) for node in self)
+
+  def Scopes(self, scope):
+    """Yields the scope for the loop body for each item, holding its aliases."""
+    inner = TemplateScope.Nested(scope)
+    for item in self.tag.Iterator(scope):
       if self.aliascount == 1:
-        replacements[self.aliases[0]] = item
+        inner[self.aliases[0]] = item
       else:
-        try:
-          if self.aliascount != len(item):
-            raise TemplateValueError('Cannot unpack %d values into %d tags' % (
-                len(item), self.aliascount))
-        except TypeError:
-          raise TemplateValueError(
-              'Cannot unpack %s into %d tags' % (type(item), self.aliascount))
-        replacements.update(zip(self.aliases, item))
-      output.append(''.join(tag.Parse(**replacements) for tag in self))
-    return ''.join(output)
+        inner.update(zip(self.aliases, self.Unpack(item)))
+      yield inner
+
+  def Unpack(self, item):
+    """Returns the loop `item` as a tuple with a value for each of the aliases.
+
+    Raises:
+      TemplateValueError: The item cannot be unpacked into the aliases.
+    """
+    try:
+      if self.aliascount != len(item):
+        raise TemplateValueError('Cannot unpack %d values into %d tags' % (
+            len(item), self.aliascount))
+    except TypeError:
+      raise TemplateValueError(
+          'Cannot unpack %s into %d tags' % (type(item), self.aliascount))
+    return tuple(item)
+
+
+class TemplateCachedBlock(list):
+  """A part of the template of which the output is cached for later parses.
+
+  The output is stored in the fragment cache of the parser, under the key given
+  in the template. This key may contain tags, so that for instance a menu is
+  cached per language: {{ cache menu-[language] 300 }}. The optional ttl sets
+  the number of seconds the output is cached.
+  """
+  def __init__(self, parser, key, ttl=None):
+    """Initializes a TemplateCachedBlock instance.
+
+    Arguments:
+      @ parser: Parser
+        The parser that holds the fragment cache. Without one, the output of
+        the block is never cached.
+      @ key: str
+        The key to cache the output under, tags in it are replaced.
+      % ttl: str ~~ None
+        Number of seconds to cache the output for.
+
+    Raises:
+      TemplateSyntaxError: The ttl is not a number.
+    """
+    super().__init__()
+    self.parser = parser
+    self.key = list(Template.TagSplit(key))
+    try:
+      self.ttl = None if ttl is None else float(ttl)
+    except ValueError:
+      raise TemplateSyntaxError('Cache ttl %r is not a number of seconds' % ttl)
+
+  def __repr__(self):
+    return '%s(%s)' % (type(self).__name__, list(self))
+
+  def __str__(self):
+    return '{{ cache %s%s }}%s{{ endcache }}' % (
+        ''.join(map(str, self.key)),
+        '' if self.ttl is None else ' %g' % self.ttl, ''.join(map(str, self)))
+
+  def Parse(self, **kwds):
+    """Returns the cached output of the block, parsing it if needed."""
+    return self.Render(kwds)
+
+  def Render(self, scope):
+    """Returns the cached output of the block, rendering it with `scope` if the
+    fragment cache does not hold it."""
+    if self.parser is None:
+      return self.RenderBlock(scope)
+    return self.parser.CachedFragment(
+        self.Key(scope), self.ttl, lambda: self.RenderBlock(scope))
+
+  def Key(self, scope):
+    """Returns the key for the fragment cache, with its tags replaced."""
+    return ''.join(node.Render(scope) for node in self.key)
+
+  def RenderBlock(self, scope):
+    """Returns the parsed contents of the block, ignoring the cache."""
+    return ''.join(node.Render(scope) for node in self)
 
 
 class TemplateTag(object):
@@ -879,6 +2119,7 @@ class TemplateTag(object):
   FUNC_FINDER = re.compile('\|([\w-]+(?:\([^()]*?\))?)')
   FUNC_CLOSURE = re.compile('(\w+)\((.*)\)')
   ALLOWPRIVATE = False # will we allow access to private members for object lookup
+  FUNCTIONS_VERSION = 0 # raised by Parser.RegisterFunction on every change
 
   def __init__(self, name, indices=(), functions=()):
     """Initializes a TemplateTag instant.
@@ -897,6 +2138,14 @@ class TemplateTag(object):
         if not index.startswith('_') or not index.endswith('_')
     ])
     self.functions = functions
+    self._closures = tuple(map(self._ParseFunction, functions))
+    self._resolved = None, ()
+
+  def __getstate__(self):
+    """Returns the state for pickling, without the resolved functions."""
+    state = self.__dict__.copy()
+    state['_resolved'] = None, ()
+    return state
 
   def __repr__(self):
     return '%s(%r)' % (type(self).__name__, str(self))
@@ -945,10 +2194,24 @@ class TemplateTag(object):
     """
     try:
       value = replacements[self.name]
+    except KeyError:
+      raise TemplateNameError('No replacement with name %r' % self.name)
+    return self.ReduceValue(value, replacements)
+
+  def ReduceValue(self, value, replacements):
+    """Returns the tag value after reducing indices on an already found `value`.
+
+    This is the second half of GetValue(), used by compiled templates which look
+    up the tag's name only once. JITTags are evaluated using `replacements`,
+    also when they are found halfway the indices.
+    """
+    try:
       for index in self.indices:
+        if isinstance(value, JITTag):
+          value = value.Evaluate(replacements)
         value = self._GetIndex(value, index)
       if isinstance(value, JITTag):
-        return value.PassReplacements(**replacements)
+        return value.Evaluate(replacements)
       return value
     except KeyError:
       raise TemplateNameError('No replacement with name %r' % self.name)
@@ -956,19 +2219,69 @@ class TemplateTag(object):
       raise TemplateKeyError('%s on %r' % (error, self.name))
 
   @classmethod
-  def ApplyFunction(cls, func, value):
+  def _ParseFunction(cls, func):
+    """Returns the name and the literal arguments of a tag function.
+
+    Functions that are not closures have None for their arguments. Arguments
+    that cannot be evaluated result in the error instead, which is raised when
+    the function is applied; a tag without value never applies its functions.
+    """
     closure = cls.FUNC_CLOSURE.match(func)
+    if not closure:
+      return func, None
+    func, args = closure.groups()
     try:
-      if not closure:
-        return TAG_FUNCTIONS[func](value)
-      func, args = closure.groups()
       #XXX(Elmer): This uses eval, it's so much easier than lexing and parsing
       # the regex leading up to this point make sure no function calls end up in
       # here, nor variables, Math might show up though
-      args = eval(args + ',', {'__builtins__': {}}, {}) if args.strip() else ()
-      return TAG_FUNCTIONS[func](*args)(value)
+      return func, (eval(args + ',', {'__builtins__': {}}, {})
+                    if args.strip() else ())
     except SyntaxError:
-      raise TemplateSyntaxError('Invalid argument syntax: %r' % args)
+      return func, TemplateSyntaxError('Invalid argument syntax: %r' % args)
+    except Exception as error:
+      return func, error
+
+  @staticmethod
+  def _ResolveFunction(func, args):
+    """Returns the callable for a parsed tag function.
+
+    Closures are called with their arguments, returning the actual function.
+    """
+    if isinstance(args, Exception):
+      raise args.with_traceback(None)
+    if args is None:
+      return TAG_FUNCTIONS[func]
+    return TAG_FUNCTIONS[func](*args)
+
+  @classmethod
+  def ApplyFunction(cls, func, value):
+    """Applies the tag function `func`, as written in a tag, to the value."""
+    return cls('', functions=(func,))._CallFunctions(value)
+
+  def _CallFunctions(self, value, record=None):
+    """Applies the tag's functions to the value, one after the other.
+
+    The callables for the functions are resolved on first use, and again only
+    after functions were registered with Parser.RegisterFunction. If given,
+    `record` is called with the name and duration of every function call.
+    """
+    func = None
+    try:
+      version, resolved = self._resolved
+      if version != TemplateTag.FUNCTIONS_VERSION:
+        version = TemplateTag.FUNCTIONS_VERSION
+        resolved = []
+        for func, args in self._closures:
+          resolved.append((func, self._ResolveFunction(func, args)))
+        self._resolved = version, resolved
+      for func, function in resolved:
+        if record is None:
+          value = function(value)
+        else:
+          start = time.perf_counter()
+          value = function(value)
+          record(func, time.perf_counter() - start)
+      return value
     except TypeError as err_obj:
       raise TemplateTypeError(
           ('Templatefunction raised an TypeError %s(%s) ' % (func, value), err_obj))
@@ -995,40 +2308,73 @@ class TemplateTag(object):
     They will only be acted upon by functions as specified in the tag.
 
     All tag functions are derived from the module constant TAG_FUNCTIONS, and
-    are looked up when requested. This means that if a function is changed after
-    the template has been created, the new function will be used instead.
+    are looked up when first applied. This means that if a function is changed
+    through Parser.RegisterFunction after the template has been created, the
+    new function will be used instead.
     """
+    return self.Render(kwds)
+
+  def Render(self, scope):
+    """Returns the parsed string of the tag, using the replacements `scope`."""
     try:
-      value = self.GetValue(kwds)
+      value = self.GetValue(scope)
     except (TemplateKeyError, TemplateNameError):
       # On any failure to get the given index, return the unmodified tag.
       return str(self)
+    return self._ApplyFunctions(value)
+
+  def ParseValue(self, value, replacements):
+    """Returns the parsed string of the tag for a previously looked up `value`.
+
+    This behaves exactly like Parse(), but the tag's name has already been
+    retrieved from the replacements. The `value` is MISSING if there was none.
+    """
+    if value is MISSING:
+      return str(self)
+    try:
+      value = self.ReduceValue(value, replacements)
+    except (TemplateKeyError, TemplateNameError):
+      return str(self)
+    return self._ApplyFunctions(value)
+
+  def _ApplyFunctions(self, value, record=None):
+    """Applies the tag's functions to the value, or the default function.
+
+    If given, `record` is called with the name and duration of every function.
+    """
     # Process functions, or apply default if value is not Basesafestring
     if self.functions:
-      for func in self.functions:
-        try:
-          value = self.ApplyFunction(func, value)
-        except TemplateFunctionError as error:
-          raise TemplateFunctionError('%s on %s' % (error, self))
-        except TemplateSyntaxError as error:
-          raise TemplateSyntaxError('%s on %s' % (error, self))
+      try:
+        value = self._CallFunctions(value, record)
+      except TemplateFunctionError as error:
+        raise TemplateFunctionError('%s on %s' % (error, self))
+      except TemplateSyntaxError as error:
+        raise TemplateSyntaxError('%s on %s' % (error, self))
     if not isinstance(value, Basesafestring):
-      value = TAG_FUNCTIONS['default'](value)
+      if record is None:
+        value = TAG_FUNCTIONS['default'](value)
+      else:
+        start = time.perf_counter()
+        value = TAG_FUNCTIONS['default'](value)
+        record('default', time.perf_counter() - start)
     return value
 
-  def Iterator(self, **kwds):
-    """Parses the tag for iteration purposes.
+  def Iterator(self, scope=None, **kwds):
+    """Parses the tag for iteration purposes, using the replacements `scope`.
 
     Functions are processed, but no defaults or other conversion is done. Tags
-    that cannot be resolved result in empty iterators.
+    that cannot be resolved result in empty iterators. For backward
+    compatibility, the replacements may also be given as keyword arguments.
     """
+    if scope is None:
+      scope = kwds
     try:
-      value = self.GetValue(kwds)
+      value = self.GetValue(scope)
     except TemplateKeyError:
       # On any failure to get the given index, return an empty iterator
       return ()
-    for func in self.functions:
-      value = TAG_FUNCTIONS[func](value)
+    if self.functions:
+      value = self._CallFunctions(value)
     return iter(value)
 
   @staticmethod
@@ -1067,9 +2413,21 @@ class TemplateTag(object):
 
 
 class TemplateText(str):
-  """A raw piece of template text, upon which no replacements will be done."""
+  """A raw piece of template text, upon which no replacements will be done.
+
+  The text is also kept encoded in ENCODING, so it needn't be encoded for every
+  parse of the template.
+  """
+  ENCODING = 'utf-8'
+
   def __new__(cls, string):
-    return super().__new__(cls, string)
+    text = super().__new__(cls, string)
+    try:
+      text.encoded = string.encode(cls.ENCODING)
+    except UnicodeEncodeError:
+      # Raised again when the text is encoded while rendering the template.
+      text.encoded = None
+    return text
 
   def __repr__(self):
     """Returns the object representation of the TemplateText."""
@@ -1079,47 +2437,448 @@ class TemplateText(str):
     """Returns the string value of the TemplateText."""
     return str(self)
 
+  def Render(self, _scope):
+    """Returns the TemplateText itself, there is nothing to replace."""
+    return self
+
+  def Encode(self, encoding):
+    """Returns the TemplateText as bytes in the given `encoding`."""
+    if encoding == self.ENCODING and self.encoded is not None:
+      return self.encoded
+    return self.encode(encoding)
+
+
+class TemplateCompiler:
+  """Compiles a Template into a single Python render function.
+
+  The generated function no longer walks the node tree: consecutive pieces of
+  literal text are joined into one constant, tag names are looked up once into
+  local variables, loops become native `for` loops and conditionals native `if`
+  statements. Nodes that the compiler does not inline are rendered by calling
+  their own Render method, so the output is always that of the interpreter.
+
+  The render function takes the replacements mapping and returns a list of
+  strings, which joined together form the parsed template. Given an `encoding`,
+  the list holds bytes in that encoding instead, where the literal text was
+  encoded when the template was parsed. With `stream` set as well, the render
+  function is a generator that yields these bytes.
+
+  Compiled expressions are only valid for the eval whitelists they were
+  validated against, these are listed in the `whitelists` attribute after
+  compilation.
+
+  Tags whose value is a persistent tag of the parser are folded into the literal
+  text, as are conditionals that only depend on these tags. The render function
+  first checks that the persistent values were not overridden by replacements
+  or request tags. If they were, it renders with a version of the template that
+  has nothing folded. Only immutable values are folded, and only tags without
+  functions or with the built-in escaping functions, which are in FOLDABLE.
+  """
+  PREFIX = '_tmpl_'
+  FOLDABLE = frozenset(('default', 'html', 'htmlsource', 'raw', 'url'))
+
+  def __init__(self, template, encoding=None, stream=False, fold=True):
+    """Initializes a TemplateCompiler for the given `template`."""
+    self.template = template
+    self.encoding = encoding
+    self.stream = stream and encoding is not None
+    parser = getattr(template, 'parser', None)
+    self.persistent = parser.tags if fold and parser is not None else {}
+    self.folded = {}
+    self.namespace = {'_tmpl_missing': MISSING,
+                      '_tmpl_scope': TemplateScope.Nested,
+                      '_tmpl_value': self.ConditionValue,
+                      '_tmpl_undefined': self.Undefined}
+    self.constants = {}
+    self.scopes = [{}]
+    self.lines = []
+    self.source = None
+    self.whitelists = {}
+
+  def Compile(self):
+    """Returns the render function for the template."""
+    name = getattr(self.template, '_template_path', None) or 'string'
+    source = self.Source()
+    if self.folded:
+      self.namespace['_tmpl_unfolded'] = TemplateCompiler(
+          self.template, self.encoding, self.stream, fold=False).Compile()
+    exec(compile(source, '<template %s>' % name, 'exec'), self.namespace)
+    return self.namespace['_tmpl_render']
+
+  def Source(self):
+    """Returns the Python source code of the render function."""
+    if self.source is None:
+      self._CompileNodes(self.template, 1)
+      header = ['def _tmpl_render(_tmpl_r0):']
+      for name, value in self.folded.items():
+        header.append('  if _tmpl_r0.get(%r, _tmpl_missing) is not %s:' % (
+            name, self._Constant(value)))
+        header.append('    %s _tmpl_unfolded(_tmpl_r0)' % (
+            'yield from' if self.stream else 'return'))
+        if self.stream:
+          header.append('    return')
+      if self.stream:
+        # Makes the function a generator, even if it never yields any output.
+        footer = ['  yield from ()']
+      else:
+        header.extend(['  _tmpl_o = []', '  _tmpl_a = _tmpl_o.append'])
+        footer = ['  return _tmpl_o']
+      header.extend('  %s = _tmpl_r0.get(%r, _tmpl_missing)' % (local, name)
+                    for name, local in self.scopes[0].items())
+      self.lines = header + self.lines + footer
+      self.source = '\n'.join(self.lines) + '\n'
+    return self.source
+
+  @staticmethod
+  def ConditionValue(tag, value, replacements):
+    """Returns the value of a tag used in a compiled conditional expression.
+
+    This mirrors the lazy retrieval done by LazyTagValueRetrieval for
+    TemplateConditional.Expression, including the translation of NameErrors.
+    """
+    if value is MISSING:
+      raise TemplateNameError('No replacement with name %r' % tag.name)
+    try:
+      return tag.ReduceValue(value, replacements)
+    except NameError as error:
+      raise TemplateNameError(str(error).capitalize() + '. Try it as [tagname]?')
+
+  @staticmethod
+  def Undefined(name):
+    """Raises the error for a name in a conditional that is not defined."""
+    raise TemplateNameError(
+        ('name %r is not defined' % name).capitalize() + '. Try it as [tagname]?')
+
+  # ############################################################################
+  # Code generation for the various template parts
+  #
+  def _CompileNodes(self, nodes, indent):
+    """Adds the code for a list of template parts at the given indent level.
+
+    Folded tags are added to the literal text, and the nodes of the branch that
+    a folded conditional takes are compiled in place of the conditional.
+    """
+    start = len(self.lines)
+    text = []
+    pending = list(reversed(nodes))
+    while pending:
+      node = pending.pop()
+      if isinstance(node, TemplateText):
+        text.append(node)
+        continue
+      if isinstance(node, TemplateComment):
+        continue
+      if isinstance(node, TemplateTag):
+        folded = self._FoldTag(node)
+        if folded is not None:
+          text.append(TemplateText(folded))
+          continue
+      elif type(node) is TemplateConditional:
+        branches, default = self._FoldConditional(node)
+        if not branches:
+          pending.extend(reversed(default))
+          continue
+      self._CompileText(text, indent)
+      if isinstance(node, TemplateTag):
+        self._CompileTag(node, indent)
+      elif isinstance(node, TemplateLoop):
+        self._CompileLoop(node, indent)
+      elif isinstance(node, TemplateConditionalPresence):
+        self._CompileConditional(node, indent, native=False)
+      elif type(node) is TemplateConditional:
+        self._CompileConditional(node, indent, branches=branches,
+                                 default=default)
+      else:
+        self._OutputString(indent, '%s.Render(%s)' % (
+            self._Constant(node), self._Replacements()))
+    self._CompileText(text, indent)
+    if len(self.lines) == start:
+      self._Emit(indent, 'pass')
+
+  def _CompileText(self, text, indent):
+    """Adds a single constant for the collected pieces of literal `text`."""
+    if text:
+      if self.encoding is None:
+        self._Output(indent, repr(''.join(text)))
+      else:
+        self._Output(indent, repr(b''.join(
+            node.Encode(self.encoding) for node in text)))
+      del text[:]
+
+  def _CompileTag(self, tag, indent):
+    """Adds the code that parses a TemplateTag from its local variable."""
+    self._OutputString(indent, '%s.ParseValue(%s, %s)' % (
+        self._Constant(tag), self._Local(tag.name), self._Replacements()))
+
+  def _CompileLoop(self, loop, indent):
+    """Adds a native for-loop, with the loop aliases as local variables.
+
+    The replacements for the loop body are a TemplateScope on top of those
+    outside the loop, holding the aliases, exactly like TemplateLoop.Render().
+    """
+    outer = self._Replacements()
+    depth = len(self.scopes)
+    inner = '_tmpl_r%d' % depth
+    item = '_tmpl_i%d' % depth
+    scope = {}
+    targets = []
+    for index, alias in enumerate(loop.aliases):
+      scope[alias] = '_tmpl_v%d_%d' % (depth, index)
+      targets.append((alias, '_tmpl_v%d_%d' % (depth, index)))
+    self._Emit(indent, '%s = _tmpl_scope(%s)' % (inner, outer))
+    self._Emit(indent, 'for %s in %s.Iterator(%s):' % (
+        item, self._Constant(loop.tag), outer))
+    if loop.aliascount == 1:
+      self._Emit(indent + 1, '%s = %s' % (targets[0][1], item))
+    else:
+      self._Emit(indent + 1, '%s, = %s.Unpack(%s)' % (
+          ', '.join(local for _alias, local in targets),
+          self._Constant(loop), item))
+    for alias, local in targets:
+      self._Emit(indent + 1, '%s[%r] = %s' % (inner, alias, local))
+    self.scopes.append(scope)
+    try:
+      self._CompileNodes(loop, indent + 1)
+    finally:
+      self.scopes.pop()
+
+  def _CompileConditional(self, conditional, indent, native=True,
+                          branches=None, default=None):
+    """Adds a native if/elif/else chain for a TemplateConditional.
+
+    Expressions that can be compiled become Python expressions themselves, the
+    others are evaluated at render time by the conditional's Expression method.
+    The `branches` and `default` that remain after folding replace those of the
+    conditional, if they are given.
+    """
+    if branches is None:
+      branches, default = conditional.branches, conditional.default
+    for index, (expr, branch) in enumerate(branches):
+      condition = self._CompileExpression(conditional, expr) if native else None
+      if condition is None:
+        condition = '%s.Expression(%s, %s)' % (
+            self._Constant(conditional), self._Constant(expr),
+            self._Replacements())
+      self._Emit(indent, '%s %s:' % ('elif' if index else 'if', condition))
+      self._CompileNodes(branch, indent + 1)
+    if default:
+      self._Emit(indent, 'else:')
+      self._CompileNodes(default, indent + 1)
+
+  def _CompileExpression(self, conditional, expr):
+    """Returns the Python source for a conditional expression, or None.
+
+    The expression is validated exactly as LimitedEval would. Tags are replaced
+    by lazy lookups of their local variables, names by the whitelisted function
+    or builtin they would evaluate to. Expressions that use tag functions, or
+    that would fail validation, are not compiled so they fail at render time.
+    """
+    nodes = []
+    tags = {}
+    for num, node in enumerate(expr):
+      if isinstance(node, TemplateTag):
+        if node.functions:
+          return None
+        tags['__tmpl_var_%d' % num] = node
+        nodes.append('__tmpl_var_%d' % num)
+      else:
+        nodes.append(node)
+    try:
+      tree = ast.parse(''.join(nodes), mode='eval')
+      conditional.astvisitor.visit(tree)
+    except Exception:
+      return None
+    visitor = conditional.astvisitor
+    self.whitelists[id(visitor)] = visitor, visitor.whitelists
+    functions = visitor.whitelists['functions']
+    for node in ast.walk(tree):
+      if (isinstance(node, ast.Name) and node.id not in tags and
+          node.id.startswith(('__', self.PREFIX))):
+        return None
+
+    compiler = self
+    class NameTransformer(ast.NodeTransformer):
+      """Replaces names in the expression by their compiled counterparts."""
+      def visit_Name(self, node):
+        if node.id in tags:
+          tag = tags[node.id]
+          code = '_tmpl_value(%s, %s, %s)' % (
+              compiler._Constant(tag), compiler._Local(tag.name),
+              compiler._Replacements())
+        elif node.id in functions:
+          code = compiler._Constant(functions[node.id])
+        elif node.id in vars(builtins):
+          code = compiler._Constant(vars(builtins)[node.id])
+        else:
+          code = '_tmpl_undefined(%r)' % node.id
+        return ast.parse(code, mode='eval').body
+
+    return '(%s)' % ast.unparse(NameTransformer().visit(tree.body))
+
+  # ############################################################################
+  # Folding of the persistent tags into literal text
+  #
+  def _FoldValue(self, tag):
+    """Returns the persistent value for the `tag`, or MISSING if it can't be
+    folded: the name is a loop alias, or the value is not immutable."""
+    if any(tag.name in scope for scope in self.scopes[1:]):
+      return MISSING
+    value = self.persistent.get(tag.name, MISSING)
+    if (type(value) in (str, int, float, bool) or
+        isinstance(value, Basesafestring)):
+      return value
+    return MISSING
+
+  def _FoldTag(self, tag):
+    """Returns the output of the `tag` if it can be folded, or None."""
+    if not self.FOLDABLE.issuperset(tag.functions):
+      return None
+    value = self._FoldValue(tag)
+    if value is MISSING:
+      return None
+    try:
+      output = tag.ParseValue(value, self.persistent)
+    except Exception:
+      return None
+    self.folded[tag.name] = value
+    return output
+
+  def _FoldConditional(self, conditional):
+    """Returns the branches and default that remain after folding expressions.
+
+    Leading branches whose expression only depends on persistent tags are
+    evaluated now. Those that are false are dropped, one that is true becomes
+    the default with no branches before it.
+    """
+    branches = conditional.branches
+    for index, (expr, branch) in enumerate(branches):
+      tags = [node for node in expr if isinstance(node, TemplateTag)]
+      values = [self._FoldValue(tag) for tag in tags]
+      if MISSING in values or any(tag.functions for tag in tags):
+        return branches[index:], conditional.default
+      try:
+        result = conditional.Expression(expr, self.persistent)
+      except Exception:
+        return branches[index:], conditional.default
+      visitor = conditional.astvisitor
+      self.whitelists[id(visitor)] = visitor, visitor.whitelists
+      self.folded.update((tag.name, value) for tag, value in zip(tags, values))
+      if result:
+        return [], branch
+    return [], conditional.default or []
+
+  # ############################################################################
+  # Helpers for names in the generated code
+  #
+  def _Constant(self, obj):
+    """Returns the global name under which `obj` is available to the code."""
+    if id(obj) not in self.constants:
+      name = '_tmpl_g%d' % len(self.constants)
+      self.constants[id(obj)] = name
+      self.namespace[name] = obj
+    return self.constants[id(obj)]
+
+  def _Emit(self, indent, line):
+    """Adds a line of code at the given indent level."""
+    self.lines.append('  ' * indent + line)
+
+  def _Output(self, indent, code):
+    """Adds a line of code that outputs the result of `code` as it is."""
+    self._Emit(indent, ('yield %s' if self.stream else '_tmpl_a(%s)') % code)
+
+  def _OutputString(self, indent, code):
+    """Adds a line of code that outputs the string resulting from `code`."""
+    if self.encoding is not None:
+      code = '(%s).encode(%r)' % (code, self.encoding)
+    self._Output(indent, code)
+
+  def _Local(self, name):
+    """Returns the local variable that holds the value for tag `name`.
+
+    Loop aliases are looked up in their loop scope, all other names are
+    retrieved from the replacements once, at the start of the render function.
+    """
+    for scope in reversed(self.scopes[1:]):
+      if name in scope:
+        return scope[name]
+    if name not in self.scopes[0]:
+      self.scopes[0][name] = '_tmpl_v0_%d' % len(self.scopes[0])
+    return self.scopes[0][name]
+
+  def _Replacements(self):
+    """Returns the variable holding the replacements for the current scope."""
+    return '_tmpl_r%d' % (len(self.scopes) - 1)
+
 
 class JITTag(object):
   """This is a template Tag which is only evaulated on replacement.
   It is usefull for situations where not all all of this functions input vars
   are available just yet.
+
+  The function is called with the replacements of the template as keyword
+  arguments, or without arguments if it does not accept those. How long its
+  result is reused depends on the `memoize` policy:
+    * None: the function is called for every occurrence of the tag. This is
+      needed for functions that depend on the aliases of a loop. It is the
+      default for compatibility, as JITTags were always evaluated this way, so
+      JITTags only benefit from memoization if they are created with 'request'
+      or 'render'.
+    * 'render': the function is called once for every template that is parsed,
+      however often the tag occurs in the template and its loops.
+    * 'request': the function is called once until the request tags of the
+      Parser are cleared, which the PageMaker does for every request.
+  The results are stored in the TemplateScope of the template or request, never
+  on the JITTag. This keeps them apart for requests in different threads.
   """
+  MEMOIZE_POLICIES = 'render', 'request', None
 
-  def __init__(self, function):
+  def __init__(self, function, memoize=None):
     """Stores the function for later use"""
+    if memoize not in self.MEMOIZE_POLICIES:
+      raise ValueError('Memoize policy should be one of %s, not %r' % (
+          ', '.join(map(repr, self.MEMOIZE_POLICIES)), memoize))
     self.wrapped = function
-    self.result = None # cache for results
-    self.called = False # keep score of result cache usage, None and False might be correct results in the cache
+    self.memoize = memoize
 
   def __call__(self, *args, **kwargs):
-    """Returns the output of the earlier wrapped function"""
-    if not self.called:
-      # XXX: This is the issue. A JITTag is called a couple times when creating one in a pagemaker, at this time however no replacements are present.
-      # The JITTag should be parsed whenever its parent is being parsed, so that it can be parsed just in time.
-      try:
-        self.result = self.wrapped(*args, **kwargs)
-      except TypeError as msg: # the lambda does not expect params
-        self.result = self.wrapped()
-    self.called = True
-    return self.result
+    """Returns the output of the wrapped function, which is not memoized"""
+    return self.PassReplacements(*args, **kwargs)
+
+  def Evaluate(self, replacements):
+    """Returns the output of the wrapped function for the given replacements.
+
+    The result is memoized in the TemplateScope's memo according to the policy.
+    Plain dictionaries have no memo, with them the function is always called.
+    """
+    if self.memoize is None or not isinstance(replacements, TemplateScope):
+      return self._Call(replacements)
+    memo = (replacements.memo if self.memoize == 'render'
+            else replacements.Root().memo)
+    if self in memo:
+      return memo[self]
+    result = self._Call(replacements)
+    # Concurrent evaluations agree on the first result that was stored.
+    return memo.setdefault(self, result)
+
+  def _Call(self, replacements):
+    """Calls the wrapped function with the flattened replacements."""
+    if isinstance(replacements, TemplateScope):
+      replacements = replacements.Flatten()
+    return self.PassReplacements(**replacements)
 
   def PassReplacements(self, *args, **kwargs):
     try:
-      self.result = self.wrapped(*args, **kwargs)
+      return self.wrapped(*args, **kwargs)
     except TypeError as msg: # the lambda does not expect params
-      self.result = self.wrapped()
-    return self.result
+      return self.wrapped()
 
   def __getattr__(self, name):
-    if not self.result:
-      self()
-    if isinstance(self.result, dict):
-      attr_exists = name in self.result.keys()
-      if attr_exists:
-        return self.result[name]
-      raise AttributeError('Key does not exist')
-    return getattr(super(), name)
+    if name.startswith('__') or name in ('wrapped', 'memoize'):
+      raise AttributeError(name)
+    result = self()
+    if isinstance(result, dict) and name in result:
+      return result[name]
+    raise AttributeError('Key does not exist')
 
 class SparseList(list):
   """A spare list implementation to allow us to set the nth item on a list"""
@@ -1153,11 +2912,15 @@ class AstVisitor(ast.NodeVisitor):
     if call.func.id not in self.whitelists['functions']:
       raise TemplateEvaluationError('`%s` is not an allowed function call' % call.func.id)
 
-def LimitedEval(expr, astvisitor, evallocals = {}):
-  """A limited Eval function which only allows certain operations"""
+def LimitedCompile(expr, astvisitor):
+  """Returns the code object for `expr` if it only uses allowed operations."""
   tree = ast.parse(expr, mode='eval')
   astvisitor.visit(tree)
-  return eval(compile(tree, "<string>", "eval"),
+  return compile(tree, "<string>", "eval")
+
+def LimitedEval(expr, astvisitor, evallocals = {}):
+  """A limited Eval function which only allows certain operations"""
+  return eval(LimitedCompile(expr, astvisitor),
       astvisitor.whitelists['functions'],
       evallocals)
 
@@ -1168,8 +2931,8 @@ def HashContent(string):
 
 
 TAG_FUNCTIONS = {
-    'default': lambda d: HTMLsafestring('') + d,
-    'html': lambda d: HTMLsafestring('') + d,
+    'default': HTMLsafestring.upgrade,
+    'html': HTMLsafestring.upgrade,
     'htmlsource': lambda d: HTMLsafestring(d, unsafe=True),
     'raw': lambda d: Unsafestring(d),
     'url': lambda d: HTMLsafestring(URLqueryargumentsafestring(d, unsafe=True)),
@@ -1178,3 +2941,28 @@ TAG_FUNCTIONS = {
     'values': lambda d: list(d.values()),
     'sorted': sorted,
     'len': len}
+
+
+def PrewarmCache(args=None):
+  """Command line entry point that stores all templates in a cache dir.
+
+  This is meant to be run at deploy time, so that worker processes load their
+  templates from the cache dir instead of parsing them upon first request.
+  """
+  import argparse
+  argparser = argparse.ArgumentParser(
+      description='Parses all templates and stores them in the cache dir.')
+  argparser.add_argument('template_dir', help='directory with the templates')
+  argparser.add_argument('cache_dir', help='directory to store the cache in')
+  argparser.add_argument('--minify', action='store_true',
+                         help='collapse the whitespace in the templates')
+  argparser.add_argument('--encoding', default='utf-8',
+                         help='encoding of the template files')
+  args = argparser.parse_args(args)
+  parser = Parser(os.path.realpath(args.template_dir), cache_dir=args.cache_dir,
+                  templateEncoding=args.encoding, minify=args.minify)
+  names, failures = parser.Prewarm()
+  for name, error in sorted(failures.items()):
+    print('Could not load %s: %s' % (name, error))
+  print('Stored %d templates in %s' % (len(names), args.cache_dir))
+  return names